@@ -0,0 +1,251 @@
+# Name:        benchmarks
+# Purpose:     time the poker and puzzle hot paths
+
+"""
+Benchmark suite for poker.py and the udacity puzzles.
+
+Every benchmark is run for a few input sizes. After a warm-up, the number
+of calls per round is calibrated to take at least min_time seconds, and
+the rounds are repeated to give the mean ops/sec and its spread.
+
+    python benchmarks.py                      # run everything, print a table
+    python benchmarks.py -k shuffle           # only names containing 'shuffle'
+    python benchmarks.py --save base.json     # keep the results
+    python benchmarks.py --compare base.json  # flag regressions against them
+"""
+
+import argparse
+import imp
+import json
+import math
+import os
+import platform
+import random
+import sys
+import time
+
+import poker
+
+UDACITY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'udacity')
+
+def load_udacity(filename):
+    'import one of the udacity files, whose names are not valid modules'
+    name = os.path.splitext(filename)[0].replace('-', '_')
+    if name in sys.modules:
+        return sys.modules[name]
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w') # some of them print their tests
+    try:
+        return imp.load_source(name, os.path.join(UDACITY, filename))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+# ------------------
+# The benchmarks. Each one takes an input size and returns (func, ops):
+# calling func() does ops operations, e.g. ranks ops hands.
+
+def random_hands(n, size=5, seed=0):
+    rng = random.Random(seed)
+    return [rng.sample(poker.CARDS, size) for _ in range(n)]
+
+def bench_shuffle(method):
+    def setup(num_decks):
+        s = poker.Shoe(num_decks)
+        return (lambda: method(s)), 1
+    return setup
+
+def bench_deal(num_decks):
+    'deal a whole shoe out in 5-card hands'
+    s = poker.Shoe(num_decks)
+    cards = s.shoe[:]
+    def run():
+        s.shoe = cards[:]
+        while len(s.shoe) >= 5:
+            s.deal()
+    return run, len(cards) // 5
+
+def bench_hand(method):
+    def setup(n):
+        hands = [poker.Hand(h) for h in random_hands(n)]
+        return (lambda: [method(h) for h in hands]), n
+    return setup
+
+def bench_udacity(filename, func, size=5):
+    def setup(n):
+        f = getattr(load_udacity(filename), func)
+        hands = random_hands(n, size)
+        return (lambda: [f(h) for h in hands]), n
+    return setup
+
+def bench_floor_puzzle(func):
+    'the puzzle has no size to vary, so n is the number of solves per call'
+    def setup(n):
+        f = getattr(load_udacity('hw2-2.py'), func)
+        return (lambda: [f() for _ in xrange(n)]), n
+    return setup
+
+def bench_palindrome(kind, func='longest_subpalindrome_slice'):
+    def setup(n):
+        f = getattr(load_udacity('hw2-3.py'), func)
+        if kind == 'same':
+            text = 'x' * n # worst case for growing around every center
+        else:
+            rng = random.Random(0)
+            text = ''.join(rng.choice('abc ') for _ in range(n))
+        return (lambda: f(text)), 1
+    return setup
+
+# name --> (setup, input sizes)
+BENCHMARKS = [
+    ('Shoe.shuffle1', bench_shuffle(poker.Shoe.shuffle1), [1, 6]),
+    ('Shoe.shuffle2', bench_shuffle(poker.Shoe.shuffle2), [1, 6]),
+    ('Shoe.shuffle3', bench_shuffle(poker.Shoe.shuffle3), [1, 6]),
+    ('Shoe.deal', bench_deal, [1, 6]),
+    ('Hand.rank', bench_hand(poker.Hand.rank), [1000]),
+    ('Hand.strength', bench_hand(poker.Hand.strength), [1000]),
+    ('hand_rank', bench_udacity('hw1-1.py', 'hand_rank'), [1000]),
+    ('hand_rank_fast', bench_udacity('hw1-1.py', 'hand_rank_fast'), [1000]),
+    ('rank_features', bench_udacity('hw1-1.py', 'rank_features'), [1000]),
+    ('best_hand', bench_udacity('hw1-1.py', 'best_hand', 7), [100]),
+    ('hand_rank7', bench_udacity('hw1-1.py', 'hand_rank7', 7), [100]),
+    ('floor_puzzle', bench_floor_puzzle('floor_puzzle'), [5]),
+    ('floor_puzzle_solver', bench_floor_puzzle('floor_puzzle_solver'), [5]),
+    ('longest_subpalindrome_slice', bench_palindrome('random'), [100, 1000]),
+    ('longest_subpalindrome_slice.same', bench_palindrome('same'), [100, 1000]),
+    ('longest_subpalindrome_fast',
+     bench_palindrome('random', 'longest_subpalindrome_fast'), [100, 1000]),
+    ('longest_subpalindrome_fast.same',
+     bench_palindrome('same', 'longest_subpalindrome_fast'), [100, 1000]),
+]
+
+def measure(func, ops, repeat=5, min_time=0.1):
+    '''time func: returns the ops/sec of each of repeat rounds, after a
+    warm-up call and calibrating the calls per round to take min_time'''
+    func() # warm up
+    number = 1
+    while True:
+        t0 = time.time()
+        for _ in xrange(number):
+            func()
+        elapsed = time.time() - t0
+        if elapsed >= min_time:
+            break
+        number *= 2
+    rounds = [number * ops / elapsed]
+    for _ in range(repeat - 1):
+        t0 = time.time()
+        for _ in xrange(number):
+            func()
+        rounds.append(number * ops / (time.time() - t0))
+    return rounds
+
+def summarize(rounds):
+    'ops/sec rounds --> dict of mean, stdev and relative stdev'
+    mean = sum(rounds) / len(rounds)
+    stdev = math.sqrt(sum((r - mean) ** 2 for r in rounds) / len(rounds))
+    return {'mean': mean, 'stdev': stdev, 'rsd': stdev / mean,
+            'rounds': rounds}
+
+def run(pattern='', repeat=5, min_time=0.1, out=sys.stdout):
+    'run the benchmarks whose name contains pattern --> results dict'
+    results = {}
+    for (name, setup, sizes) in BENCHMARKS:
+        if pattern not in name:
+            continue
+        for size in sizes:
+            key = '%s[%s]' % (name, size)
+            func, ops = setup(size)
+            results[key] = summarize(measure(func, ops, repeat, min_time))
+            r = results[key]
+            out.write('%-44s %14.1f ops/sec  +/- %5.1f%%\n' % (
+                key, r['mean'], 100 * r['rsd']))
+    return results
+
+def save(results, filename):
+    data = {'python': platform.python_version(),
+            'machine': platform.machine(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'results': results}
+    with open(filename, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+
+def compare(results, baseline, threshold=0.1, out=sys.stdout):
+    '''compare results with a baseline loaded from a saved file. A benchmark
+    regressed if it got slower by more than threshold (10%) and by more
+    than the noise of both runs. Returns the names that regressed.'''
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        new, old = results[key], baseline[key]
+        change = new['mean'] / old['mean'] - 1
+        noise = 2 * max(new['rsd'], old['rsd'])
+        flag = ''
+        if change < -max(threshold, noise):
+            flag = 'REGRESSION'
+            regressions.append(key)
+        elif change > max(threshold, noise):
+            flag = 'faster'
+        out.write('%-44s %14.1f -> %14.1f ops/sec %+7.1f%%  %s\n' % (
+            key, old['mean'], new['mean'], 100 * change, flag))
+    return regressions
+
+def run_tests():
+    '''testing is very important'''
+    calls = []
+    rounds = measure(lambda: calls.append(1), 10, repeat=3, min_time=0.001)
+    assert len(rounds) == 3 and all(r > 0 for r in rounds)
+    r = summarize([90.0, 110.0])
+    assert r['mean'] == 100.0 and r['stdev'] == 10.0 and r['rsd'] == 0.1
+
+    baseline = {'a[1]': summarize([100.0, 100.0]),
+                'b[1]': summarize([100.0, 100.0]),
+                'c[1]': summarize([100.0, 100.0])}
+    results = {'a[1]': summarize([50.0, 50.0]),
+               'b[1]': summarize([95.0, 95.0]),
+               'c[1]': summarize([200.0, 200.0]),
+               'd[1]': summarize([1.0, 1.0])}
+    out = open(os.devnull, 'w')
+    assert compare(results, baseline, out=out) == ['a[1]']
+    # too noisy to call
+    results['a[1]'] = summarize([10.0, 90.0])
+    assert compare(results, baseline, out=out) == []
+
+    import StringIO
+    results = run('floor_puzzle', repeat=2, min_time=0.001,
+                  out=StringIO.StringIO())
+    assert sorted(results) == ['floor_puzzle[5]', 'floor_puzzle_solver[5]']
+    # n solves of the puzzle a call
+    func, ops = bench_floor_puzzle('floor_puzzle')(3)
+    assert ops == 3 and func() == [[3, 2, 4, 5, 1]] * 3
+    print 'Tests passed.'
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-k', dest='pattern', default='',
+                        help='only run benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.1,
+                        help='seconds per round')
+    parser.add_argument('--save', metavar='FILE',
+                        help='save the results as JSON')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare with results saved earlier')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slow-down that counts as a regression')
+    args = parser.parse_args()
+
+    results = run(args.pattern, args.repeat, args.min_time)
+    if args.save:
+        save(results, args.save)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -4,22 +4,38 @@ Telnet into D-Link router, gather broadband usage figures and log them to a
 database. This program should be scheduled to run at even intervals,
 e.g. each hour.
 
+Or it can stay resident, with --daemon: it then keeps its telnet session
+open and samples on the wall-clock boundaries of --interval seconds,
+which may be under a minute. See LoggerDaemon.
+
 Herminio Gonzalez, Sep 2013
 """
 
+import argparse
+import atexit
+import Queue
 import socket
+import sqlite3
+import threading
 import time
 import re
 
+import instrument
+import router_poller
+
+ROUTER_ADDR = "10.0.0.2"
+WAN_IFACE = "ppp0.1"
+
 class RouterQuery:
     """Encapsulate access to router"""
     def __init__(self):
-        self.router_addr = "10.0.0.2"
+        self.router_addr = ROUTER_ADDR
         self.telnet_port = 23
         self.username = "admin"
         self.password = open('pwd', 'r').read()
-        self.router_command = "ifconfig ppp0.1"
+        self.router_command = "ifconfig " + WAN_IFACE
         self.raw_data = None
+        self.instruments = instrument.DEFAULT
 
     def retrieve_data(self):
         """Connect to router using telnet and run the 'ifconfig' command,
@@ -31,30 +47,35 @@ class RouterQuery:
 
         socket.setdefaulttimeout(5) # 5 seconds is more than enough on this LAN
 
+        span = self.instruments.span
         try:
             # open a socket in streaming, blocking mode (the default)
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((self.router_addr, self.telnet_port))
+            with span('connect'):
+                s.connect((self.router_addr, self.telnet_port))
 
             # perform login
-            time.sleep(0.1)
-            s.recv(bufsize) # username prompt
-            s.send(self.username + "\n")
+            with span('login'):
+                time.sleep(0.1)
+                s.recv(bufsize) # username prompt
+                s.send(self.username + "\n")
 
-            time.sleep(0.1)
-            s.recv(bufsize) # password prompt
-            s.send(self.password + "\n")
+                time.sleep(0.1)
+                s.recv(bufsize) # password prompt
+                s.send(self.password + "\n")
 
-            time.sleep(0.1)
-            reply = s.recv(bufsize) # should get a '>' prompt if all went ok
+                time.sleep(0.1)
+                reply = s.recv(bufsize) # should get a '>' prompt if all went ok
 
-            if "Login incorrect" in reply:
-                raise Exception("Login incorrect.")
+                if "Login incorrect" in reply:
+                    raise Exception("Login incorrect.")
 
             # execute 'ifconfig' on WAN port, get back results
-            s.send(self.router_command + "\n")
-            time.sleep(0.2)
-            self.raw_data = s.recv(bufsize)
+            with span('command'):
+                s.send(self.router_command + "\n")
+                time.sleep(0.2)
+            with span('recv'):
+                self.raw_data = s.recv(bufsize)
 
             if not 'bytes' in self.raw_data:
                 raise Exception("Did not get byte counts from ifconfig.")
@@ -91,11 +112,12 @@ class RouterQuery:
             raise Exception("No data to parse.")
 
         # pull out the RX and TX values
-        results = re.findall(r'bytes:(\d+)', self.raw_data)
-        if len(results) == 2:
-            rxbytes, txbytes = [long(r) for r in results]
-        else:
-            raise Exception("Could not find the RX/TX values in the data.")
+        with self.instruments.span('parse'):
+            results = re.findall(r'bytes:(\d+)', self.raw_data)
+            if len(results) == 2:
+                rxbytes, txbytes = [long(r) for r in results]
+            else:
+                raise Exception("Could not find the RX/TX values in the data.")
 
         """ old method, not as succinct as using regexp:
         if "RX bytes:" in data_str:
@@ -123,31 +145,479 @@ class RouterQuery:
         print "All tests passed."
 
 
-def log_data(readings, dbfilepath):
+TRAFFIC_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS traffic(
+    device TEXT NOT NULL,
+    iface TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    rxbytes INTEGER,
+    txbytes INTEGER,
+    PRIMARY KEY (device, iface, timestamp));
+    """
+
+# covers the time-range queries, which then never touch the table itself
+TRAFFIC_INDEX = """
+    CREATE INDEX IF NOT EXISTS traffic_samples
+    ON traffic(device, iface, timestamp, rxbytes, txbytes);
+    """
+
+def create_schema(conn):
+    """Create the traffic table, keyed on (device, iface, timestamp) so that
+    readings of different interfaces in the same second don't collide.
+    Timestamps are UTC epoch seconds.
+    A traffic table of an older kind is moved over: one keyed on timestamp
+    alone, its rows taken to be from the WAN port of the router, or one
+    with 'YYYY-MM-DD HH:MM:SS' text timestamps. The rowids are kept, so
+    traffic_rollup carries on where it was."""
+    types = dict((row[1], row[2].upper())
+                 for row in conn.execute("PRAGMA table_info(traffic)"))
+    if types and ('device' not in types or types['timestamp'] != 'INTEGER'):
+        if 'device' in types:
+            source, params = "device, iface", ()
+        else:
+            source, params = "?, ?", (ROUTER_ADDR, WAN_IFACE)
+        # sqlite3 commits before every CREATE/ALTER on its own, so run the
+        # move as one explicit transaction
+        isolation_level = conn.isolation_level
+        conn.isolation_level = None
+        try:
+            conn.execute("BEGIN")
+            conn.execute("ALTER TABLE traffic RENAME TO traffic_old")
+            conn.execute(TRAFFIC_SCHEMA)
+            conn.execute("""INSERT INTO traffic(rowid, device, iface, timestamp,
+                                                rxbytes, txbytes)
+                            SELECT rowid, %s,
+                                   CAST(strftime('%%s', timestamp) AS INTEGER),
+                                   rxbytes, txbytes
+                            FROM traffic_old""" % source, params)
+            conn.execute("DROP TABLE traffic_old")
+            conn.execute(TRAFFIC_INDEX)
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.isolation_level = isolation_level
+    else:
+        conn.execute(TRAFFIC_SCHEMA)
+        conn.execute(TRAFFIC_INDEX)
+        conn.commit()
+
+def log_data(readings, dbfilepath, device=ROUTER_ADDR, iface=WAN_IFACE,
+             instruments=instrument.DEFAULT):
     """Do an SQL INSERT on the database table 'traffic'
     readings: tuple of received (rx) and transmitted (tx) bytes on the WAN port
     dbfilepath: path to sqlite database
 
-    the traffic table was created as follows:
-    CREATE TABLE IF NOT EXISTS traffic(
-    timestamp TEXT PRIMARY KEY,
-	rxbytes INTEGER,
-	txbytes INTEGER);
+    See create_schema for the traffic table. To log many readings, use
+    TrafficWriter instead. The insert is timed into instruments.
+    A reading for a device, iface and second that is already in the table
+    raises sqlite3.IntegrityError, and the one in the table is kept.
     """
-    import sqlite3
-
     rxbytes, txbytes = readings
 
-    conn = sqlite3.connect(dbfilepath)
-    c = conn.cursor()
+    with instruments.span('insert'):
+        conn = sqlite3.connect(dbfilepath)
+        try:
+            create_schema(conn)
+            c = conn.cursor()
 
-    c.execute("INSERT INTO traffic VALUES(datetime('now'), ?, ?)",
-              (rxbytes, txbytes))
+            c.execute("""INSERT INTO traffic
+                         VALUES(?, ?, CAST(strftime('%s', 'now') AS INTEGER), ?, ?)""",
+                      (device, iface, rxbytes, txbytes))
 
-    conn.commit()
-    conn.close()
+            conn.commit()
+        finally:
+            conn.close() # and roll back, if the insert failed
+
+class TrafficWriter:
+    """Long-lived writer for the traffic table. Keeps one connection open,
+    in WAL mode, and buffers the readings. The buffer is written out with
+    executemany() in a single transaction once it holds batch_size readings
+    or is flush_interval seconds old, and on close() or at exit.
+
+    A reading for a device, iface and second already in the table is
+    dropped, rather than failing the whole batch or overwriting the one
+    in the table, and counted in self.duplicates.
+
+    Another table can be written the same way by a subclass that sets
+    INSERT and create_schema, and adds rows with append()."""
+    INSERT = "INSERT OR IGNORE INTO traffic VALUES(?, ?, ?, ?, ?)"
+
+    def __init__(self, dbfilepath, batch_size=500, flush_interval=5.0):
+        self.conn = sqlite3.connect(dbfilepath, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # in WAL mode this is still safe against corruption, and only
+        # syncs at checkpoints instead of on every commit
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.create_schema(self.conn)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.duplicates = 0 # rows dropped as already in the table
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self.flush_periodically)
+        self.flusher.daemon = True
+        self.flusher.start()
+        atexit.register(self.close)
+
+    def add(self, rxbytes, txbytes, device=ROUTER_ADDR, iface=WAN_IFACE,
+            timestamp=None):
+        """buffer a reading. timestamp: epoch seconds, defaults to now"""
+        if timestamp is None:
+            timestamp = int(time.time())
+        self.append((device, iface, timestamp, rxbytes, txbytes))
+
+    def append(self, row):
+        'buffer a row for INSERT'
+        with self.lock:
+            self.buffer.append(row)
+            full = len(self.buffer) >= self.batch_size
+        if full:
+            self.flush()
+
+    def create_schema(self, conn):
+        create_schema(conn)
+
+    def flush(self):
+        '''write out the buffered readings in one transaction. Should that
+        fail, they go back to the front of the buffer for the next flush'''
+        with self.lock:
+            rows, self.buffer = self.buffer, []
+            if rows:
+                changes = self.conn.total_changes
+                try:
+                    with self.conn:
+                        self.conn.executemany(self.INSERT, rows)
+                except Exception:
+                    self.buffer[:0] = rows
+                    raise
+                self.duplicates += len(rows) - (self.conn.total_changes -
+                                                changes)
+
+    def flush_periodically(self):
+        while not self.closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                # keep flushing; the readings are still in the buffer
+                print "flush: %s" % e
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self.flusher.join()
+        self.flush()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class Scheduler:
+    """Ticks on the wall-clock multiples of interval seconds, e.g. on the
+    minute for 60 or at :00, :15, :30 and :45 for 15. The tick times are
+    computed from the boundary number rather than by adding up sleeps, so
+    they don't drift however late the sleeps wake up. Ticks missed while
+    the caller was busy are skipped and counted in self.missed."""
+    def __init__(self, interval, clock=time.time, sleep=time.sleep):
+        self.interval = interval
+        self.clock = clock
+        self.sleep = sleep
+        self.missed = 0
+
+    def ticks(self):
+        'generator of the tick times, each yielded once it has come'
+        n = int(self.clock() // self.interval) + 1
+        while True:
+            delay = n * self.interval - self.clock()
+            if delay > 0:
+                self.sleep(delay)
+            yield n * self.interval
+            n += 1
+            late = int(self.clock() // self.interval) + 1
+            if late > n:
+                self.missed += late - n
+                n = late
+
+class LoggerDaemon:
+    """Resident logger. Each router gets a thread that keeps its session
+    open and reads all its interfaces on every tick of a Scheduler, so a
+    slow or dead router only holds up itself. The readings go through a
+    queue to a single writer thread and a TrafficWriter, so the database
+    doesn't hold up the routers either. Readings are stamped with the tick
+    time; under 1 second apart they fall on the same timestamp, and all
+    but the first are dropped, with a warning.
+
+    self.instruments has the connect, command, parse and write times."""
+    def __init__(self, sessions, dbfilepath, interval=3600, ifaces=None,
+                 instruments=None):
+        self.sessions = sessions
+        self.dbfilepath = dbfilepath
+        self.interval = interval
+        self.ifaces = ifaces # None logs every interface
+        self.instruments = instruments or instrument.Instruments()
+        self.queue = Queue.Queue()
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def collect(self, session):
+        scheduler = Scheduler(self.interval, sleep=self.stopped.wait)
+        for tick in scheduler.ticks():
+            if self.stopped.is_set():
+                break
+            try:
+                if session.sock is None:
+                    with self.instruments.span('connect'):
+                        session.connect()
+                parser = router_poller.IfconfigParser()
+                with self.instruments.span('command'):
+                    records = session.read_interfaces(parser)
+                # parsed as it came in, so this is part of the command time
+                self.instruments.record('parse', parser.seconds)
+            except Exception as e:
+                print "%s: %s" % (session.name, e)
+                session.close() # reconnect on the next tick
+                continue
+            timestamp = int(tick)
+            self.queue.put([(r.rx_bytes, r.tx_bytes, session.addr, r.iface,
+                             timestamp) for r in records
+                            if self.ifaces is None or r.iface in self.ifaces])
+        session.close()
+
+    def write(self):
+        with TrafficWriter(self.dbfilepath) as writer:
+            while True:
+                readings = self.queue.get()
+                if readings is None:
+                    break
+                duplicates = writer.duplicates
+                with self.instruments.span('write'):
+                    for reading in readings:
+                        writer.add(*reading)
+                    writer.flush()
+                if writer.duplicates > duplicates:
+                    print "%d readings dropped, already in the database" % (
+                        writer.duplicates - duplicates)
+
+    def start(self):
+        self.threads = [threading.Thread(target=self.collect, args=(s,))
+                        for s in self.sessions]
+        self.writer = threading.Thread(target=self.write)
+        for t in self.threads + [self.writer]:
+            t.daemon = True
+            t.start()
+
+    def stop(self):
+        'stop polling and write out what was collected'
+        self.stopped.set()
+        for t in self.threads:
+            t.join()
+        self.queue.put(None)
+        self.writer.join()
+
+def test_daemon():
+    """testing is very important"""
+    # a clock that jumps ahead when slept on
+    now = [100.5]
+    def sleep(seconds):
+        now[0] += seconds + 0.01 # wakes up a little late every time
+    scheduler = Scheduler(15, lambda: now[0], sleep)
+    ticks = scheduler.ticks()
+    assert [next(ticks) for _ in range(100)] == [105 + 15 * i for i in range(100)]
+    now[0] += 40 # busy past two ticks
+    assert next(ticks) == 1635 and scheduler.missed == 2
+    ticks = Scheduler(0.25, lambda: now[0], sleep).ticks()
+    assert [next(ticks) for _ in range(3)] == [1635.25, 1635.5, 1635.75]
+
+    import os
+    import shutil
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    router = router_poller.FakeRouter()
+    try:
+        dbfilepath = os.path.join(tmpdir, 'router.db')
+        session = router_poller.RouterSession('127.0.0.1', router.port,
+                                              password='secret', timeout=2.0)
+        daemon = LoggerDaemon([session], dbfilepath, interval=1,
+                              ifaces=['ppp0.1', 'eth0'])
+        daemon.start()
+        time.sleep(2.2)
+        daemon.stop()
+        conn = sqlite3.connect(dbfilepath)
+        rows = conn.execute("""SELECT iface, timestamp FROM traffic
+                               ORDER BY timestamp, iface""").fetchall()
+        conn.close()
+        assert len(rows) in (4, 6) # 2 or 3 ticks, 2 interfaces each
+        assert rows[0][0] == 'eth0' and rows[1][0] == 'ppp0.1'
+        assert router.logins == 1 # one session for the whole run
+        stats = daemon.instruments.summary()
+        assert stats['connect']['count'] == 1
+        for name in ['command', 'parse', 'write']:
+            assert stats[name]['count'] == len(rows) // 2
+    finally:
+        router.stop()
+        shutil.rmtree(tmpdir)
+    print "All tests passed."
+
+def test_log_data():
+    """testing is very important"""
+    import os
+    import shutil
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    try:
+        dbfilepath = os.path.join(tmpdir, 'router.db')
+        # a database of the old kind gets moved to the new table
+        conn = sqlite3.connect(dbfilepath)
+        conn.execute("""CREATE TABLE traffic(timestamp TEXT PRIMARY KEY,
+                        rxbytes INTEGER, txbytes INTEGER)""")
+        conn.execute("INSERT INTO traffic VALUES('2013-09-01 10:00:00', 1, 2)")
+        conn.execute("INSERT INTO traffic VALUES('2013-09-01 09:00:00', 0, 1)")
+        conn.commit()
+        conn.close()
+        log_data((3, 4), dbfilepath)
+        stats = instrument.Instruments()
+        log_data((5, 6), dbfilepath, iface='eth0', instruments=stats)
+        assert stats.summary()['insert']['count'] == 1
+        conn = sqlite3.connect(dbfilepath)
+        rows = conn.execute("SELECT * FROM traffic ORDER BY rxbytes").fetchall()
+        assert rows[1] == (ROUTER_ADDR, WAN_IFACE, 1378029600, 1, 2)
+        assert [r[3:] for r in rows] == [(0, 1), (1, 2), (3, 4), (5, 6)]
+        assert abs(rows[2][2] - time.time()) < 5
+        rowids = conn.execute("SELECT rowid FROM traffic ORDER BY rxbytes")
+        assert [r[0] for r in rowids][:2] == [2, 1] # kept as they were
+        conn.close()
+
+        with TrafficWriter(dbfilepath, batch_size=3, flush_interval=0.1) as w:
+            assert w.conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+            w.add(10, 20, timestamp=1378080000)
+            w.add(11, 21, timestamp=1378080000, iface='eth0')
+            assert len(w.buffer) == 2
+            w.add(12, 22, timestamp=1378080000, device='10.0.0.3')
+            assert w.buffer == [] # batch full, written out
+            w.add(13, 23, timestamp=1378080001)
+            time.sleep(0.3)
+            assert w.buffer == [] # written out after flush_interval
+            w.flush_interval = 60
+            w.add(14, 24, timestamp=1378166400)
+            assert w.duplicates == 0
+        conn = sqlite3.connect(dbfilepath)
+        count = conn.execute("SELECT count(*) FROM traffic").fetchone()[0]
+        assert count == 4 + 5 # the last one written on close
+        conn.close()
+
+        # a reading already in the table is kept, and the new one counted
+        with TrafficWriter(dbfilepath, batch_size=3) as w:
+            w.add(99, 99, timestamp=1378080000)           # as 10, 20
+            w.add(15, 25, timestamp=1378166401)
+            w.add(15, 25, timestamp=1378166401)           # twice in a batch
+            assert w.buffer == [] and w.duplicates == 2
+        conn = sqlite3.connect(dbfilepath)
+        assert conn.execute("""SELECT rxbytes FROM traffic
+                               WHERE timestamp = 1378080000 AND iface = ?
+                               AND device = ?""", (WAN_IFACE, ROUTER_ADDR)
+                            ).fetchall() == [(10,)]
+        assert conn.execute("SELECT count(*) FROM traffic").fetchone()[0] == 10
+        conn.close()
+
+        # a failed flush keeps the readings, and the flusher keeps going
+        with TrafficWriter(dbfilepath, flush_interval=0.05) as w:
+            w.add(17, 27, timestamp=1378166402)
+            w.append((ROUTER_ADDR, WAN_IFACE)) # too few values
+            try:
+                w.flush()
+                assert False, 'a bad row should raise'
+            except sqlite3.Error:
+                pass
+            assert len(w.buffer) == 2
+            time.sleep(0.2)
+            assert w.flusher.is_alive() and len(w.buffer) == 2
+            w.add(18, 28, timestamp=1378166403)
+            with w.lock:
+                del w.buffer[1]
+            time.sleep(0.2)
+            assert w.buffer == []
+        conn = sqlite3.connect(dbfilepath)
+        assert conn.execute("SELECT count(*) FROM traffic").fetchone()[0] == 12
+        conn.close()
+        try:
+            # two of three in a row fall in the same second
+            for _ in range(3):
+                log_data((16, 26), dbfilepath)
+            assert False, 'a reading already in the table should raise'
+        except sqlite3.IntegrityError:
+            pass
+        conn = sqlite3.connect(dbfilepath)
+        # a table with text timestamps gets moved over to epoch seconds
+        conn.execute("DROP TABLE traffic")
+        conn.execute("""CREATE TABLE traffic(device TEXT NOT NULL,
+                        iface TEXT NOT NULL, timestamp TEXT NOT NULL,
+                        rxbytes INTEGER, txbytes INTEGER,
+                        PRIMARY KEY (device, iface, timestamp))""")
+        conn.execute("""INSERT INTO traffic
+                        VALUES('10.0.0.3', 'eth0', '2013-09-02 00:00:01', 7, 8)""")
+        conn.commit()
+        create_schema(conn)
+        assert conn.execute("SELECT * FROM traffic").fetchall() == [
+            ('10.0.0.3', 'eth0', 1378080001, 7, 8)]
+        plan = ' '.join(str(r) for r in conn.execute(
+            """EXPLAIN QUERY PLAN SELECT timestamp, rxbytes, txbytes FROM traffic
+               WHERE device = '10.0.0.3' AND iface = 'eth0'
+               AND timestamp BETWEEN 0 AND 2000000000"""))
+        assert 'COVERING INDEX' in plan
+        conn.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    print "All tests passed."
+
+def run_daemon(interval, dbfilepath, report_every=3600, stats_file=None):
+    rq = RouterQuery() # for the password, read once
+    session = router_poller.RouterSession(rq.router_addr, rq.telnet_port,
+                                          rq.username, rq.password)
+    daemon = LoggerDaemon([session], dbfilepath, interval, [WAN_IFACE],
+                          instrument.DEFAULT)
+    daemon.start()
+    try:
+        while True:
+            time.sleep(report_every)
+            print daemon.instruments.report()
+            if stats_file:
+                daemon.instruments.dump(stats_file)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.stop()
+        print daemon.instruments.report()
 
 def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--daemon', action='store_true',
+                        help='stay resident and sample every --interval')
+    parser.add_argument('--interval', type=float, default=3600,
+                        help='seconds between samples in daemon mode')
+    parser.add_argument('--db', default='router.db')
+    parser.add_argument('--stats', metavar='FILE',
+                        help='write the timings of each step to FILE as JSON')
+    parser.add_argument('--stats-port', type=int,
+                        help='serve the timings on http://127.0.0.1:PORT/')
+    args = parser.parse_args()
+    if args.stats or args.stats_port:
+        instrument.DEFAULT.enabled = True
+    if args.stats_port:
+        instrument.DEFAULT.serve(args.stats_port)
+    if args.daemon:
+        try:
+            run_daemon(args.interval, args.db, stats_file=args.stats)
+        finally:
+            if args.stats:
+                instrument.DEFAULT.dump(args.stats)
+        return
+
     rq = RouterQuery()
     #rq.run_tests()
 
@@ -155,8 +625,10 @@ def main():
     readings = rq.parse_data()
     print "readings = " , readings
 
-    log_data(readings, "router.db")
+    log_data(readings, args.db)
     print "readings logged"
+    if args.stats:
+        instrument.DEFAULT.dump(args.stats)
 
 if __name__ == '__main__':
     main()
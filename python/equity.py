@@ -0,0 +1,316 @@
+# Name:        equity
+# Purpose:     estimate the odds of poker hands against each other
+
+"""
+Monte Carlo equity calculator on top of poker.py. Given the hole cards of
+every player and the part of the board dealt so far, deal out the rest of
+the board over and over from the cards left in a Shoe and count who wins.
+
+Hands are scored by the rules of poker, where A-2-3-4-5 is a straight
+(poker.evaluate5_ace_low), not by those of Hand.rank().
+
+The trials are split into shards of a fixed size. Each shard gets its own
+seed, drawn in order from the main seed, so a given seed always gives the
+same answer no matter how many processes run the shards.
+
+When only a few cards are left to come, exact_equity() walks every
+possible rest of the board instead of sampling.
+"""
+
+import collections
+import itertools
+import math
+import multiprocessing
+import random
+import time
+
+import poker
+
+class EquityResult():
+    '''Outcome counts of an equity run, one entry per player'''
+    def __init__(self, num_players):
+        self.trials = 0
+        self.wins = [0] * num_players
+        self.ties = [0] * num_players
+        self.shares = [0.0] * num_players   # pot shares won, ties split
+        self.squares = [0.0] * num_players  # sum of squared shares
+        # 7-card evaluations found in the cache / computed, exact_equity() only
+        self.hits = 0
+        self.computed = 0
+
+    def add(self, shard):
+        'add in the counts returned by run_shard()'
+        trials, wins, ties, shares, squares = shard
+        self.trials += trials
+        for i in range(len(self.wins)):
+            self.wins[i] += wins[i]
+            self.ties[i] += ties[i]
+            self.shares[i] += shares[i]
+            self.squares[i] += squares[i]
+
+    def losses(self):
+        return [self.trials - w - t for (w, t) in zip(self.wins, self.ties)]
+
+    def equity(self):
+        'expected share of the pot for each player'
+        return [s / self.trials for s in self.shares]
+
+    def ci(self):
+        'half-width of the 95% confidence interval of each equity'
+        n = float(self.trials)
+        result = []
+        for (s, sq) in zip(self.shares, self.squares):
+            variance = max(0.0, sq / n - (s / n) ** 2)
+            result.append(1.96 * math.sqrt(variance / n))
+        return result
+
+    def __repr__(self):
+        return 'EquityResult(trials=%d, equity=%s)' % (
+            self.trials, ['%1.4f' % e for e in self.equity()])
+
+class LRUCache():
+    '''A dict of bounded size that drops the least recently used entries.
+    Each entry takes about 250 bytes, so the default size is about 25 MB.'''
+    def __init__(self, size=100000):
+        self.size = size
+        self.data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute, *args):
+        'return the value cached for key, or cache and return compute(*args)'
+        data = self.data
+        try:
+            value = data.pop(key)
+            self.hits += 1
+        except KeyError:
+            value = compute(*args)
+            self.misses += 1
+            if len(data) >= self.size:
+                data.popitem(last=False)
+        data[key] = value # (re)insert as the most recently used
+        return value
+
+    def __len__(self):
+        return len(self.data)
+
+def to_ints(cards):
+    'card strings --> card_int() values'
+    return [poker.CARD_INTS[poker.CARD_IDS[c]] for c in cards]
+
+def run_shard(args):
+    '''deal out and score trials boards.
+    args: (holes, board, deck, trials, seed), cards as card_int() values
+    returns (trials, wins, ties, shares, squares) for EquityResult.add()'''
+    holes, board, deck, trials, seed = args
+    rng = random.Random(seed)
+    sample = rng.sample
+    best_strength = poker.best_strength
+    evaluate = poker.evaluate5_ace_low
+    num_players = len(holes)
+    players = range(num_players)
+    needed = 5 - len(board)
+    wins = [0] * num_players
+    ties = [0] * num_players
+    shares = [0.0] * num_players
+    squares = [0.0] * num_players
+    for _ in xrange(trials):
+        full_board = board + sample(deck, needed)
+        strengths = [best_strength(hole + full_board, evaluate)
+                     for hole in holes]
+        best = max(strengths)
+        winners = [i for i in players if strengths[i] == best]
+        share = 1.0 / len(winners)
+        for i in winners:
+            if len(winners) == 1:
+                wins[i] += 1
+            else:
+                ties[i] += 1
+            shares[i] += share
+            squares[i] += share * share
+    return (trials, wins, ties, shares, squares)
+
+def equity(hole_cards, board=(), trials=1000000, seed=None, processes=None,
+           target_ci=None, shard_size=10000):
+    '''equity(hole_cards, board) --> EquityResult
+    hole_cards: the cards of each player, e.g. [['AS', 'AD'], ['KH', 'QH']]
+    board: the 0 to 5 board cards dealt so far
+    trials: the most boards to deal out
+    seed: makes the result reproducible. None for a random seed.
+    processes: size of the multiprocessing pool. None for one per CPU, and
+        1 runs everything in this process.
+    target_ci: stop early once the 95% confidence interval of every
+        player's equity is within +/- target_ci, e.g. 0.005'''
+    board = list(board)
+    known = [c for hole in hole_cards for c in hole] + board
+    if len(set(known)) != len(known):
+        raise Exception('The same card was dealt twice.')
+    if len(board) > 5:
+        raise Exception('The board has at most 5 cards.')
+    deck = [c for c in poker.Shoe(1).shoe if c not in known]
+    if seed is None:
+        seed = random.SystemRandom().getrandbits(64)
+    seeds = random.Random(seed)
+    holes = [to_ints(hole) for hole in hole_cards]
+    board, deck = to_ints(board), to_ints(deck)
+
+    def shards():
+        left = trials
+        while left > 0:
+            n = min(shard_size, left)
+            left -= n
+            yield (holes, board, deck, n, seeds.getrandbits(64))
+
+    result = EquityResult(len(holes))
+    pool = None
+    if processes == 1:
+        results = (run_shard(shard) for shard in shards())
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(run_shard, shards())
+    try:
+        # shards come back in order, so stopping early is reproducible too
+        for shard in results:
+            result.add(shard)
+            if target_ci is not None and max(result.ci()) <= target_ci:
+                break
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return result
+
+def exact_equity(hole_cards, board=(), cache=None):
+    '''exact_equity(hole_cards, board) --> EquityResult
+    Like equity(), but deals out every possible rest of the board once.
+    Meant for the turn and the river, when few boards are left.
+    cache: an LRUCache for the 7-card evaluations, keyed on the bitmask of
+    the card ids. By default there is a new one for each call; pass the
+    same one to calls that share hands, e.g. one hand played against
+    several others, to score the shared hands once.
+    The result also tells how many evaluations were cache hits and how
+    many were computed.'''
+    if cache is None:
+        cache = LRUCache()
+    board = list(board)
+    known = [c for hole in hole_cards for c in hole] + board
+    if len(set(known)) != len(known):
+        raise Exception('The same card was dealt twice.')
+    if len(board) > 5:
+        raise Exception('The board has at most 5 cards.')
+    # (bitmask, card_int) for each card
+    def encode(cards):
+        return [(1 << poker.CARD_IDS[c], poker.CARD_INTS[poker.CARD_IDS[c]])
+                for c in cards]
+    deck = encode(c for c in poker.Shoe(1).shoe if c not in known)
+    holes = []
+    for hole in hole_cards:
+        hole = encode(hole)
+        holes.append((sum(m for (m, c) in hole), [c for (m, c) in hole]))
+    board = encode(board)
+    board_mask = sum(m for (m, c) in board)
+    board_ints = [c for (m, c) in board]
+
+    result = EquityResult(len(holes))
+    hits, misses = cache.hits, cache.misses
+    get = cache.get
+    best_strength = poker.best_strength
+    evaluate = poker.evaluate5_ace_low
+    players = range(len(holes))
+    for rest in itertools.combinations(deck, 5 - len(board)):
+        mask = board_mask + sum(m for (m, c) in rest)
+        full_board = board_ints + [c for (m, c) in rest]
+        strengths = [get(hole_mask | mask, best_strength,
+                         hole_ints + full_board, evaluate)
+                     for (hole_mask, hole_ints) in holes]
+        best = max(strengths)
+        winners = [i for i in players if strengths[i] == best]
+        share = 1.0 / len(winners)
+        for i in winners:
+            if len(winners) == 1:
+                result.wins[i] += 1
+            else:
+                result.ties[i] += 1
+            result.shares[i] += share
+            result.squares[i] += share * share
+        result.trials += 1
+    result.hits = cache.hits - hits
+    result.computed = cache.misses - misses
+    return result
+
+def run_tests():
+    '''testing is very important'''
+    # no cards left to deal: the result is known
+    r = equity([['AS', 'AD'], ['KH', 'KD']], '2C 7D 9H JS 3C'.split(),
+               trials=100, processes=1, shard_size=30)
+    assert r.trials == 100
+    assert r.wins == [100, 0] and r.losses() == [0, 100]
+    r = equity([['AS', 'KD'], ['AH', 'KC']], '2C 7D 9H JS 3C'.split(),
+               trials=10, processes=1)
+    assert r.ties == [10, 10] and r.equity() == [0.5, 0.5]
+
+    # same seed, same answer, however many processes
+    holes = [['AS', 'AD'], ['KH', 'KD']]
+    r1 = equity(holes, trials=20000, seed=42, processes=1, shard_size=5000)
+    r2 = equity(holes, trials=20000, seed=42, processes=2, shard_size=5000)
+    assert r1.wins == r2.wins and r1.ties == r2.ties
+    # aces beat kings about 82% of the time
+    assert abs(r1.equity()[0] - 0.82) < 0.02
+
+    r = equity(holes, trials=10 ** 6, seed=1, processes=1, target_ci=0.01,
+               shard_size=1000)
+    assert r.trials < 10 ** 6 and max(r.ci()) <= 0.01
+
+    try:
+        equity([['AS', 'AD'], ['AS', 'KD']])
+        assert False, 'a card dealt twice should raise'
+    except Exception as e:
+        assert 'twice' in str(e)
+
+    # exact equity: on the turn there are 44 rivers left heads-up
+    cache = LRUCache(1000)
+    turn = '2C 7D 9H JS'.split()
+    r = exact_equity(holes, turn, cache)
+    assert r.trials == 44
+    assert r.wins == [42, 2] and r.ties == [0, 0] # two kings left
+    assert r.hits == 0 and r.computed == 88
+    # aces against another hand reuses the evaluations of the aces
+    r = exact_equity([['AS', 'AD'], ['QH', 'QD']], turn, cache)
+    # 42 of the 44 rivers were seen before; KH and KD are new
+    assert r.hits == 42 and r.computed == 2 + 44
+    r = exact_equity(holes, '2C 7D 9H JS 3C'.split(), cache)
+    assert r.trials == 1 and r.wins == [1, 0]
+    # without one, nothing is kept from call to call
+    for _ in range(2):
+        r = exact_equity(holes, turn)
+        assert r.hits == 0 and r.computed == 88 and r.wins == [42, 2]
+    # the cache stays within its size
+    r = exact_equity(holes, '2C 7D 9H'.split(), LRUCache(100))
+    assert r.trials == 990 and r.computed == 1980
+    mc = equity(holes, '2C 7D 9H'.split(), trials=20000, seed=3, processes=1)
+    assert abs(mc.equity()[0] - r.equity()[0]) < 0.01
+    # the wheel beats a pair of kings
+    wheel = [['AS', '2D'], ['KH', 'KD']]
+    r = exact_equity(wheel, '3C 4H 5S 9D JC'.split(), LRUCache(10))
+    assert r.wins == [1, 0]
+    r = equity(wheel, '3C 4H 5S 9D JC'.split(), trials=10, processes=1)
+    assert r.wins == [10, 0]
+    r = exact_equity([['AH', '2H'], ['6S', '6D']], '3H 4H 5H 6C'.split(),
+                     LRUCache(100))
+    assert r.wins == [r.trials, 0] # a straight flush, whatever the river
+    c = LRUCache(2)
+    c.get('a', int, '1'); c.get('b', int, '2'); c.get('a', int, '1')
+    c.get('c', int, '3') # drops 'b', the least recently used
+    assert sorted(c.data) == ['a', 'c'] and (c.hits, c.misses) == (1, 3)
+    print 'Tests passed.'
+
+def main():
+    holes = [['AS', 'AD'], ['KH', 'QH'], ['7C', '7D']]
+    t0 = time.time()
+    r = equity(holes, trials=10 ** 6, seed=1, target_ci=0.005)
+    print '%s in %1.3f sec.' % (r, time.time() - t0)
+    for (hole, e, ci) in zip(holes, r.equity(), r.ci()):
+        print '%s: %1.3f +/- %1.3f' % (' '.join(hole), e, ci)
+
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,8 @@
 
 import random
 import os.path # for checking if game file exists
-import pickle  # for writing and reading game file
+
+from game2_save import SaveStore, import_old_save
 
 
 def make_question():
@@ -40,21 +41,47 @@ def make_question():
         difficulty = 3
     return (question, answer, difficulty)
 
+def is_correct(true_answer, raw_answer):
+    """did the player get it right? raw_answer is what they typed"""
+    if true_answer == 'SECRET_BONUS':
+        return True # any answer will do!
+    # check if player entered something that is not a number:
+    try:
+        answer = int(raw_answer)
+    except ValueError:
+        answer = 0
+    return answer == true_answer
+
+def next_score(score, mult, difficulty, correct):
+    """the (score, mult) after answering a question"""
+    if correct:
+        score = (score + (5.0 * difficulty)) * mult
+        mult += 0.1
+    else:
+        mult = max(1.0, mult * 0.5)   # mult gets halved, but does not go below 1.0
+    return (score, mult)
+
 def main():
+    # every player's game is kept in game2.journal and game2.checkpoint
+    store = SaveStore('game2')
     gamefile = 'game2.save'
     if os.path.exists(gamefile):
-        # file exists, so load up the game and continue from last time
-        f = open(gamefile, 'rb')
-        gamedata = pickle.load(f)
-        f.close()
-        (name, score, mult, turn) = gamedata
+        # a save file from before: move it into the store
+        import_old_save(store, gamefile)
+        store.checkpoint() # on disk before the old file goes
+        os.rename(gamefile, gamefile + '.old')
+
+    name = raw_input('Enter name: ')
+    if name in store:
+        # load up the game and continue from last time
+        (score, mult, turn) = store.load(name)
         print "Welcome back, %s." % name
     else:
-        # file doesn't exist, start a new game
-        name = raw_input('Enter name: ')
+        # start a new game
         score = 1.0  # score is multiplied by mult in every turn
         mult = 1.0   # +0.1 for correct answer. gets halved for wrong answer.
         turn = 1     # +1 for every turn
+        store.create(name, score, mult, turn)
 
     print "NOTE: To quit, enter the letter 'q' as your answer. You game progress will be saved."
 
@@ -70,26 +97,20 @@ def main():
             print 'Leaving already? See ya!'
             break
 
-        # check if player entered something that is not a number:
-        try:
-            answer = int(raw_answer)
-        except ValueError:
-            answer = 0
-
-        if true_answer == 'SECRET_BONUS' or answer == true_answer:
+        correct = is_correct(true_answer, raw_answer)
+        if correct:
             print 'Correct!'
-            score = (score + (5.0 * difficulty)) * mult
-            mult += 0.1
         else:
             print 'Sorry. The correct answer is %d.' % true_answer
-            mult = max(1.0, mult * 0.5)   # mult gets halved, but does not go below 1.0
+        (score, mult) = next_score(score, mult, difficulty, correct)
 
         # save game automatically after every turn
-        gamedata = (name, score, mult, turn)
-        f = open(gamefile, 'wb')
-        pickle.dump(gamedata, f)
-        f.close()
+        store.save(name, score, mult, turn)
 
         turn +=1
 
-main()
+    store.close()
+
+if __name__ == '__main__':
+    main()
+
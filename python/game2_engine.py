@@ -0,0 +1,205 @@
+# coding: utf-8
+
+# game2 without the keyboard: questions and scores in batches, and
+# virtual players to load-test it with
+# by Herminio Gonzalez
+
+"""
+make_questions(n, rng) gives n questions like game2.make_question(), with
+the same odds, but from one random number per question. score_answers()
+runs a whole batch of answers through the game2 rules in one call.
+
+simulate() has a pool of threads play many virtual players at once and
+measures the questions per second, saving every turn, once per batch or
+not at all, so the cost of the save path shows up.
+"""
+
+import multiprocessing.pool
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import game2
+from game2_save import SaveStore
+
+OPS = [('+', 1), ('-', 2), ('x', 3)]
+A_VALUES = 51 # a from 50 to 100
+B_VALUES = 51 # b from 0 to 50
+SUMS = A_VALUES * B_VALUES * len(OPS) # all the ordinary questions
+BONUS = ('What did you eat yesterday? > ', 'SECRET_BONUS', 4)
+
+def make_questions(n, rng=random):
+    '''list of n (question, answer, difficulty), as from make_question().
+    One in 100 is the secret bonus question, as there.'''
+    draw = rng.randrange
+    questions = []
+    for _ in xrange(n):
+        k = draw(100 * SUMS)
+        if k % 100 == 99:
+            questions.append(BONUS)
+            continue
+        k //= 100
+        k, a = divmod(k, A_VALUES)
+        op, b = divmod(k, B_VALUES)
+        a += 50
+        (sign, difficulty) = OPS[op]
+        if op == 0:
+            answer = a + b
+        elif op == 1:
+            answer = a - b
+        else:
+            answer = a * b
+        questions.append(('What is  %d %s %d ?  > ' % (a, sign, b), answer,
+                          difficulty))
+    return questions
+
+def score_answers(score, mult, questions, answers):
+    '''play a batch of answers, from (score, mult) on. Returns the list of
+    (score, mult) after each answer; the last one is where the game is.'''
+    states = []
+    for ((question, true_answer, difficulty), raw_answer) in zip(questions,
+                                                                 answers):
+        (score, mult) = game2.next_score(
+            score, mult, difficulty, game2.is_correct(true_answer, raw_answer))
+        states.append((score, mult))
+    return states
+
+def answer_questions(questions, accuracy, rng):
+    'what a player who is right accuracy of the time would type'
+    return [str(true_answer) if rng.random() < accuracy else 'dunno'
+            for (question, true_answer, difficulty) in questions]
+
+def play(args):
+    '''one virtual player: turns questions, batch_size at a time.
+    Returns the questions answered.'''
+    (store, name, turns, batch_size, accuracy, save, seed) = args
+    rng = random.Random(seed)
+    score, mult, turn = 1.0, 1.0, 1
+    if store is not None:
+        store.create(name, score, mult, turn)
+    while turn <= turns:
+        questions = make_questions(min(batch_size, turns - turn + 1), rng)
+        answers = answer_questions(questions, accuracy, rng)
+        states = score_answers(score, mult, questions, answers)
+        if save == 'turn':
+            for (i, (s, m)) in enumerate(states):
+                store.save(name, s, m, turn + i)
+        elif save == 'batch':
+            store.save(name, states[-1][0], states[-1][1],
+                       turn + len(states) - 1)
+        (score, mult) = states[-1]
+        turn += len(states)
+    return turns
+
+def simulate(players=1000, turns=100, threads=32, batch_size=20,
+             accuracy=0.8, save='turn', path=None, seed=0):
+    '''play players virtual players at once on a pool of threads.
+    save: 'turn' saves every turn as the game does, 'batch' once a batch,
+    None never. path: the SaveStore, a temporary one by default.
+    Returns a dict of questions, seconds and questions/sec.'''
+    if save not in (None, 'batch', 'turn'):
+        raise Exception("save is None, 'batch' or 'turn', not %r." % (save,))
+    tmpdir = None
+    store = None
+    if save:
+        if path is None:
+            tmpdir = tempfile.mkdtemp()
+            path = os.path.join(tmpdir, 'game2')
+        store = SaveStore(path)
+    seeds = random.Random(seed)
+    jobs = [(store, 'player%d' % i, turns, batch_size, accuracy, save,
+             seeds.getrandbits(32)) for i in range(players)]
+    pool = multiprocessing.pool.ThreadPool(threads)
+    try:
+        t0 = time.time()
+        questions = sum(pool.map(play, jobs))
+        elapsed = time.time() - t0
+    finally:
+        pool.close()
+        pool.join()
+        if store is not None:
+            store.close()
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+    return {'questions': questions, 'seconds': elapsed,
+            'qps': questions / elapsed}
+
+def run_tests():
+    '''testing is very important'''
+    rng = random.Random(1)
+    questions = make_questions(20000, rng)
+    assert questions == make_questions(20000, random.Random(1))
+    bonus = [q for q in questions if q == BONUS]
+    assert 100 < len(bonus) < 300 # about 1 in 100
+    counts = [0, 0, 0]
+    for (question, answer, difficulty) in questions:
+        if answer == 'SECRET_BONUS':
+            continue
+        counts[difficulty - 1] += 1
+        # the answer goes with the question
+        a, sign, b = question.split()[2:5]
+        a, b = int(a), int(b)
+        assert 50 <= a <= 100 and 0 <= b <= 50
+        assert answer == {'+': a + b, '-': a - b, 'x': a * b}[sign]
+    assert all(6000 < c < 7200 for c in counts)
+
+    # the same scores as the game gives, one answer at a time
+    questions = [('What is  50 + 1 ?  > ', 51, 1),
+                 ('What is  60 x 2 ?  > ', 120, 3),
+                 BONUS,
+                 ('What is  70 - 5 ?  > ', 65, 2)]
+    states = score_answers(1.0, 1.0, questions, ['51', '121', 'rice', 'q'])
+    assert states[0] == (6.0, 1.1)
+    assert states[1] == (6.0, 1.0)       # wrong: mult halved, but not below 1
+    assert states[2] == (26.0, 1.1)      # bonus
+    assert states[3][0] == 26.0 and abs(states[3][1] - 1.0) < 1e-9
+    assert score_answers(1.0, 1.0, [], []) == []
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'game2')
+        r = simulate(players=50, turns=30, threads=8, batch_size=7,
+                     path=path, seed=3)
+        assert r['questions'] == 50 * 30 and r['qps'] > 0
+        store = SaveStore(path)
+        assert len(store) == 50
+        assert all(store.load(name)[2] == 30 for name in store.names())
+        # a seed plays the same games, whatever the threads and saving
+        again = os.path.join(tmpdir, 'again')
+        simulate(players=50, turns=30, threads=1, batch_size=7,
+                 save='batch', path=again, seed=3)
+        again = SaveStore(again)
+        assert all(again.load(name) == store.load(name)
+                   for name in store.names())
+        again.close()
+        store.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    assert simulate(players=5, turns=10, threads=1, save=None)['questions'] == 50
+    try:
+        simulate(players=1, turns=1, save='never')
+        assert False, 'an unknown save should raise'
+    except Exception as e:
+        assert 'never' in str(e)
+    print 'Tests passed.'
+
+def timer(players=2000, turns=50, threads=32):
+    for save in [None, 'batch', 'turn']:
+        r = simulate(players, turns, threads, save=save)
+        print '%d players x %d turns, saving %-5s: %8.0f questions/sec' % (
+            players, turns, save or 'never', r['qps'])
+    rng = random.Random(0)
+    t0 = time.time()
+    for _ in xrange(100000):
+        game2.make_question()
+    t1 = time.time()
+    make_questions(100000, rng)
+    t2 = time.time()
+    print 'make_question: %1.0f/sec, make_questions: %1.0f/sec' % (
+        100000 / (t1 - t0), 100000 / (t2 - t1))
+
+if __name__ == '__main__':
+    run_tests()
+    timer()
@@ -0,0 +1,294 @@
+# coding: utf-8
+
+# save files for game2, for any number of players
+# by Herminio Gonzalez
+
+"""
+Saving a turn appends one 32-byte record to a journal that stays open:
+
+    profile id, save number, turn, score, mult, crc32 of the rest
+
+A new player is one line appended to the names file, whose line numbers
+are the profile ids:
+
+    name, tab, score, tab, mult, tab, turn
+
+so the game it starts from is on disk as soon as the name is. A line
+with only a name starts from the defaults.
+
+The profiles themselves are in a checkpoint file. Every so often the
+checkpoint is written out to a temporary file and renamed over the old
+one, so it is always either the old or the new one, never half of each.
+The directory is synced after the rename, then the journal starts over.
+
+On startup the checkpoint is loaded and the journal replayed on top of
+it. A record only counts if its save number is newer than the profile's,
+so replaying a journal that a checkpoint already took in changes
+nothing, and a record cut short by a crash fails its crc and is dropped.
+"""
+
+import os
+import pickle
+import struct
+import threading
+import zlib
+
+RECORD = struct.Struct('<IIIddI') # id, save number, turn, score, mult, crc
+DATA = struct.Struct('<IIIdd')
+
+class SaveStore:
+    """Saved games of many players in path.names, path.journal and
+    path.checkpoint"""
+    def __init__(self, path, checkpoint_every=1000, sync=False):
+        self.path = path
+        self.checkpoint_every = checkpoint_every
+        self.sync = sync # fsync every save, not just hand it to the OS
+        self.ids = {}      # name --> id
+        self.profiles = [] # id --> [name, save number, score, mult, turn]
+        self.journaled = 0 # records in the journal
+        self.lock = threading.Lock()
+        if os.path.exists(path + '.checkpoint'):
+            with open(path + '.checkpoint', 'rb') as f:
+                self.profiles = pickle.load(f)
+        self.read_names()
+        self.ids = dict((p[0], i) for (i, p) in enumerate(self.profiles))
+        self.journal = open(path + '.journal', 'ab+')
+        self.replay()
+
+    def read_names(self):
+        'add the players not in the checkpoint yet, from the names file'
+        self.names_file = open(self.path + '.names', 'ab+')
+        self.names_file.seek(0)
+        names = self.names_file.read().split('\n')
+        if names[-1]:
+            # a name left half-written
+            self.names_file.truncate(len('\n'.join(names[:-1])) +
+                                     (len(names) > 1))
+        names.pop()
+        for line in names[len(self.profiles):]:
+            fields = line.split('\t')
+            if len(fields) == 4:
+                self.profiles.append([fields[0], 0, float(fields[1]),
+                                      float(fields[2]), int(fields[3])])
+            else:
+                self.profiles.append([line, 0, 1.0, 1.0, 1])
+        for profile in self.profiles[len(names):]:
+            self.names_file.write(profile[0] + '\n') # from before names files
+        self.names_file.flush()
+
+    def replay(self):
+        'apply the journal, and cut off a record left half-written'
+        self.journal.seek(0)
+        data = self.journal.read()
+        good = 0
+        for offset in xrange(0, len(data) - RECORD.size + 1, RECORD.size):
+            record = RECORD.unpack_from(data, offset)
+            if zlib.crc32(DATA.pack(*record[:5])) & 0xffffffff != record[5]:
+                break
+            i, number, turn, score, mult = record[:5]
+            if i < len(self.profiles) and number > self.profiles[i][1]:
+                self.profiles[i][1:] = [number, score, mult, turn]
+            good = offset + RECORD.size
+        if good < len(data):
+            self.journal.truncate(good)
+        self.journal.seek(0, os.SEEK_END)
+        self.journaled = good // RECORD.size
+
+    def names(self):
+        return [p[0] for p in self.profiles]
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def __len__(self):
+        return len(self.profiles)
+
+    def load(self, name):
+        "the saved (score, mult, turn) of a player, or None if there isn't one"
+        i = self.ids.get(name)
+        if i is None:
+            return None
+        name, number, score, mult, turn = self.profiles[i]
+        return (score, mult, turn)
+
+    def create(self, name, score=1.0, mult=1.0, turn=1):
+        'add a player, starting from score, mult and turn'
+        if '\n' in name or '\t' in name:
+            raise Exception('A name is one line, without tabs.')
+        with self.lock:
+            if name in self.ids:
+                raise Exception('There is already a player called %s.' % name)
+            self.names_file.write('%s\t%r\t%r\t%d\n' % (name, float(score),
+                                                      float(mult), turn))
+            self.names_file.flush()
+            if self.sync:
+                os.fsync(self.names_file.fileno())
+            self.ids[name] = len(self.profiles)
+            self.profiles.append([name, 0, float(score), float(mult), turn])
+
+    def save(self, name, score, mult, turn):
+        'save the state of a player after a turn: one record on the journal'
+        with self.lock:
+            self.write_record(self.ids[name], score, mult, turn)
+
+    def write_record(self, i, score, mult, turn):
+        'with the lock held'
+        profile = self.profiles[i]
+        number = profile[1] + 1
+        profile[1:] = [number, score, mult, turn]
+        data = DATA.pack(i, number, turn, score, mult)
+        crc = zlib.crc32(data) & 0xffffffff
+        self.journal.write(data + struct.pack('<I', crc))
+        self.journal.flush()
+        if self.sync:
+            os.fsync(self.journal.fileno())
+        self.journaled += 1
+        if self.journaled >= self.checkpoint_every:
+            self.write_checkpoint()
+
+    def checkpoint(self):
+        with self.lock:
+            self.write_checkpoint()
+
+    def write_checkpoint(self):
+        'with the lock held: write out every profile, and start a new journal'
+        temp = self.path + '.checkpoint.tmp'
+        with open(temp, 'wb') as f:
+            pickle.dump(self.profiles, f, 2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp, self.path + '.checkpoint')
+        # the rename only survives a crash once the directory is synced,
+        # and the journal is still needed until then
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.journal.truncate(0)
+        self.journal.seek(0)
+        self.journaled = 0
+
+    def close(self):
+        if self.journal.closed:
+            return
+        self.checkpoint()
+        self.journal.close()
+        self.names_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def import_old_save(store, gamefile):
+    '''take in a game2.save file of the old kind, a pickled (name, score,
+    mult, turn), unless that player already has a profile'''
+    with open(gamefile, 'rb') as f:
+        (name, score, mult, turn) = pickle.load(f)
+    if name not in store:
+        store.create(name, score, mult, turn)
+    return name
+
+def run_tests():
+    '''testing is very important'''
+    import shutil
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'game2')
+        with SaveStore(path, checkpoint_every=20) as store:
+            assert len(store) == 0 and store.load('Hibiki') is None
+            store.create('Hibiki')
+            store.create('Kenji', score=3.0)
+            assert store.load('Hibiki') == (1.0, 1.0, 1)
+            for turn in range(1, 8):
+                store.save('Hibiki', 10.0 * turn, 1.0 + 0.5 * turn, turn)
+            store.save('Kenji', 40.0, 1.5, 2)
+            assert store.journaled == 8 # a new player is on the names line
+            assert os.path.getsize(path + '.journal') == 8 * RECORD.size
+            assert not os.path.exists(path + '.checkpoint')
+            try:
+                store.create('Kenji')
+                assert False, 'a name used twice should raise'
+            except Exception as e:
+                assert 'already' in str(e)
+            try:
+                store.create('Ken\tji')
+                assert False, 'a tab in a name should raise'
+            except Exception as e:
+                assert 'tabs' in str(e)
+            # no close(): as if the game was killed
+            store.journal.flush()
+
+            # the journal is replayed on top of the checkpoint
+            again = SaveStore(path)
+            assert again.load('Hibiki') == (70.0, 4.5, 7)
+            assert again.load('Kenji') == (40.0, 1.5, 2)
+            assert sorted(again.names()) == ['Hibiki', 'Kenji']
+            again.journal.close()
+
+            for turn in range(8, 21): # past checkpoint_every
+                store.save('Hibiki', 10.0 * turn, 1.0, turn)
+            assert store.journaled == 1
+            assert SaveStore(path).load('Hibiki') == (200.0, 1.0, 20)
+
+        # a record cut off halfway is dropped, and the journal carries on
+        with SaveStore(path) as store:
+            store.save('Kenji', 50.0, 1.6, 3)
+            store.save('Kenji', 60.0, 1.7, 4)
+        with open(path + '.journal', 'ab') as f:
+            f.write(RECORD.pack(1, 99, 5, 70.0, 1.8, 0)[:20])
+        store = SaveStore(path)
+        assert store.load('Kenji') == (60.0, 1.7, 4)
+        assert os.path.getsize(path + '.journal') == 0 # the half record cut off
+        store.save('Kenji', 80.0, 1.9, 5)
+        store.journal.flush()
+        with open(path + '.journal', 'ab') as f:
+            f.write('\0' * 7)
+        assert SaveStore(path).load('Kenji') == (80.0, 1.9, 5)
+        store.journal.close()
+
+        # replaying a journal the checkpoint already has changes nothing
+        with open(path + '.journal', 'rb') as f:
+            old_journal = f.read()
+        store = SaveStore(path)
+        store.save('Kenji', 90.0, 2.0, 6)
+        store.close()
+        with open(path + '.journal', 'ab') as f:
+            f.write(old_journal) # as if the truncate never happened
+        assert SaveStore(path).load('Kenji') == (90.0, 2.0, 6)
+
+        # so is a name
+        with open(path + '.names', 'ab') as f:
+            f.write('Ai')
+        store = SaveStore(path)
+        assert store.names() == ['Hibiki', 'Kenji'] and len(store) == 2
+        store.create('Aiko', 2.0)
+        store.close()
+        assert SaveStore(path).load('Aiko') == (2.0, 1.0, 1)
+
+        # a new player's game is there without anything on the journal
+        store = SaveStore(path)
+        store.create('Mei', 0.1, 1.7, 3)
+        store.names_file.flush()
+        store.journal.close()
+        open(path + '.journal', 'wb').close() # as if it was lost
+        store = SaveStore(path)
+        assert store.load('Mei') == (0.1, 1.7, 3)
+        assert store.load('Aiko') == (2.0, 1.0, 1)
+        store.close()
+
+        gamefile = os.path.join(tmpdir, 'game2.save')
+        with open(gamefile, 'wb') as f:
+            pickle.dump(('Aiko', 12.5, 1.2, 4), f)
+        with SaveStore(os.path.join(tmpdir, 'new')) as store:
+            assert import_old_save(store, gamefile) == 'Aiko'
+            assert store.load('Aiko') == (12.5, 1.2, 4)
+    finally:
+        shutil.rmtree(tmpdir)
+    print 'Tests passed.'
+
+if __name__ == '__main__':
+    run_tests()
@@ -0,0 +1,326 @@
+#!/usr/bin/python
+"""
+Read the Geiger counter kit on its serial port and log the radiation
+readings to a database.
+
+The Geiger_Counter_Default sketch prints a line at the end of every sample
+period (30 seconds, or 5 above 100 CPM), at 9600 baud:
+
+    CPM = 17 / uSv/h = 0.0969
+
+Readings are stamped with the time they arrive, go into the radiation
+table in batches through a RadiationWriter, and feed 1-minute and 1-hour
+rolling windows of the CPM. With --capture the stamped lines are also
+kept in a file, which --replay pushes back through the same parse and
+insert path as fast as it will go:
+
+    python geiger_logger.py --port /dev/ttyUSB0 --capture geiger.log
+    python geiger_logger.py --replay geiger.log --db replay.db
+    cat geiger.log | python geiger_logger.py --replay -
+"""
+
+import argparse
+import os
+import sys
+import termios
+import time
+
+import broadband_logger
+
+DEVICE = 'geiger'
+
+RADIATION_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS radiation(
+    device TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    cpm INTEGER,
+    usv REAL,
+    PRIMARY KEY (device, timestamp));
+    """
+
+CPM_MARK = 'CPM = '
+USV_MARK = ' / uSv/h = '
+
+def parse_line(line):
+    '''one line of the sketch, optionally after an epoch timestamp as
+    written by --capture --> (timestamp or None, cpm, usv), or None if it
+    is not a reading, e.g. a line cut off at startup'''
+    head, mark, rest = line.partition(CPM_MARK)
+    if not mark:
+        return None
+    cpm, mark, usv = rest.partition(USV_MARK)
+    if not mark:
+        return None
+    try:
+        timestamp = float(head) if head.strip() else None
+        return (timestamp, int(cpm), float(usv))
+    except ValueError:
+        return None
+
+class GeigerParser:
+    """Incremental parser for the serial stream. feed() it what was read,
+    in pieces of any size, and it returns the readings on the lines it
+    completed, stamped with now if the line had no timestamp."""
+    def __init__(self):
+        self.line = ''
+        self.bad = 0 # lines that were not readings
+
+    def feed(self, chunk, now=None):
+        lines = (self.line + chunk).split('\n')
+        self.line = lines.pop()
+        readings = []
+        for line in lines:
+            reading = parse_line(line)
+            if reading is None:
+                if line.strip():
+                    self.bad += 1
+                continue
+            if reading[0] is None:
+                if now is None:
+                    now = time.time()
+                reading = (now,) + reading[1:]
+            readings.append(reading)
+        return readings
+
+class RollingWindow:
+    """Mean and maximum CPM over the last seconds seconds, in a fixed ring
+    of slots buckets. A reading goes in the bucket of its time; a bucket
+    left over from an earlier lap of the ring is cleared when reused, and
+    left out of the stats."""
+    def __init__(self, seconds, slots=60):
+        self.width = float(seconds) / slots
+        self.slots = slots
+        self.bucket = [-1] * slots # which bucket each slot holds
+        self.total = [0] * slots
+        self.count = [0] * slots
+        self.max = [0] * slots
+
+    def add(self, timestamp, cpm):
+        bucket = int(timestamp // self.width)
+        i = bucket % self.slots
+        if self.bucket[i] != bucket:
+            self.bucket[i] = bucket
+            self.total[i] = self.count[i] = self.max[i] = 0
+        self.total[i] += cpm
+        self.count[i] += 1
+        if cpm > self.max[i]:
+            self.max[i] = cpm
+
+    def stats(self, now):
+        '(mean, max, readings) of the window that ends at now'
+        newest = int(now // self.width)
+        total = count = biggest = 0
+        for i in xrange(self.slots):
+            if newest - self.slots < self.bucket[i] <= newest:
+                total += self.total[i]
+                count += self.count[i]
+                biggest = max(biggest, self.max[i])
+        return (float(total) / count if count else 0.0, biggest, count)
+
+class RadiationWriter(broadband_logger.TrafficWriter):
+    """Batched writer for the radiation table, see TrafficWriter"""
+    INSERT = "INSERT OR IGNORE INTO radiation VALUES(?, ?, ?, ?)"
+
+    def create_schema(self, conn):
+        conn.execute(RADIATION_SCHEMA)
+        conn.commit()
+
+    def add(self, cpm, usv, timestamp, device=DEVICE):
+        self.append((device, int(timestamp), cpm, usv))
+
+class GeigerLogger:
+    """Parses the stream into readings and sends them to the writer and
+    the 1-minute and 1-hour windows"""
+    def __init__(self, writer, capture=None):
+        self.writer = writer
+        self.capture = capture # file to copy the stamped readings to
+        self.parser = GeigerParser()
+        self.minute = RollingWindow(60, 60)
+        self.hour = RollingWindow(3600, 60)
+        self.readings = 0
+        self.last = None
+
+    def feed(self, chunk, now=None):
+        for (timestamp, cpm, usv) in self.parser.feed(chunk, now):
+            self.writer.add(cpm, usv, timestamp)
+            self.minute.add(timestamp, cpm)
+            self.hour.add(timestamp, cpm)
+            if self.capture:
+                self.capture.write('%.3f CPM = %d / uSv/h = %.4f\n' % (
+                    timestamp, cpm, usv))
+            self.readings += 1
+            self.last = timestamp
+
+    def report(self):
+        if self.last is None:
+            return 'no readings'
+        return '%d readings; last minute %5.1f CPM mean %4d max; ' \
+               'last hour %5.1f CPM mean %4d max' % (
+            (self.readings,) + self.minute.stats(self.last)[:2] +
+            self.hour.stats(self.last)[:2])
+
+def open_serial(port, baud=termios.B9600):
+    '''open a serial port raw at 9600 8N1, the comspec of the sketch,
+    as an unbuffered file'''
+    fd = os.open(port, os.O_RDONLY | os.O_NOCTTY)
+    iflag, oflag, cflag, lflag, ispeed, ospeed, cc = termios.tcgetattr(fd)
+    iflag = termios.IGNPAR
+    oflag = 0
+    cflag = termios.CS8 | termios.CREAD | termios.CLOCAL
+    lflag = 0
+    cc[termios.VMIN] = 1
+    cc[termios.VTIME] = 0
+    termios.tcsetattr(fd, termios.TCSANOW,
+                      [iflag, oflag, cflag, lflag, baud, baud, cc])
+    return os.fdopen(fd, 'rb', 0)
+
+def follow(f, logger, report_every=3600):
+    'log what comes in on f until it closes'
+    next_report = time.time() + report_every
+    while True:
+        chunk = os.read(f.fileno(), 4096)
+        if not chunk:
+            break
+        logger.feed(chunk)
+        if time.time() >= next_report:
+            print logger.report()
+            next_report += report_every
+
+def replay(f, logger, chunk_size=1 << 16):
+    '''push a captured log through the logger as fast as it goes.
+    Returns (bytes, seconds).'''
+    size = 0
+    t0 = time.time()
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        size += len(chunk)
+        logger.feed(chunk)
+    logger.writer.flush()
+    return size, time.time() - t0
+
+def make_capture(f, days=3, start=1380585600, seed=0):
+    '''write days of made-up readings in the --capture format, as the
+    sketch would give them: 30 seconds apart, or 5 above 100 CPM'''
+    import random
+    rng = random.Random(seed)
+    t = start
+    while t < start + days * 86400:
+        if rng.random() < 0.01:
+            cpm = rng.randint(100, 400) # a hot spell
+        else:
+            cpm = max(0, int(rng.gauss(20, 6)))
+        f.write('%.3f CPM = %d / uSv/h = %.4f\n' % (t, cpm, cpm / 175.43))
+        t += 5 if cpm > 99 else 30
+
+def run_tests():
+    """testing is very important"""
+    assert parse_line('CPM = 17 / uSv/h = 0.0969\r') == (None, 17, 0.0969)
+    assert parse_line('1380585600.250 CPM = 5 / uSv/h = 0.0285') == (
+        1380585600.25, 5, 0.0285)
+    assert parse_line('PM = 17 / uSv/h = 0.0969') is None # cut off
+    assert parse_line('CPM = 17 / uSv') is None
+    assert parse_line('CPM = x / uSv/h = 0.0969') is None
+    assert parse_line('') is None
+
+    stream = 'uSv/h = 0.1\r\nCPM = 17 / uSv/h = 0.0969\r\nCPM = 120 / uSv/h = 0.6840\r\n'
+    for size in [1, 5, len(stream)]:
+        parser = GeigerParser()
+        readings = []
+        for i in range(0, len(stream), size):
+            readings += parser.feed(stream[i:i + size], now=100.0)
+        assert readings == [(100.0, 17, 0.0969), (100.0, 120, 0.684)]
+        assert parser.bad == 1
+
+    w = RollingWindow(60, 6) # 10-second buckets
+    w.add(0, 10); w.add(5, 20); w.add(30, 60)
+    assert w.stats(30) == (30.0, 60, 3)
+    assert w.stats(65) == (60.0, 60, 1)  # the first bucket dropped out
+    w.add(65, 0)                           # and reused
+    assert w.stats(65) == (30.0, 60, 2)
+    assert w.stats(1000) == (0.0, 0, 0)
+
+    import shutil
+    import sqlite3
+    import StringIO
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    try:
+        dbfilepath = os.path.join(tmpdir, 'geiger.db')
+        capture = StringIO.StringIO()
+        with RadiationWriter(dbfilepath, batch_size=100) as writer:
+            logger = GeigerLogger(writer, capture)
+            logger.feed('CPM = 17 / uSv/h = 0.0969\r\nCPM = 1', now=1380585600.5)
+            logger.feed('9 / uSv/h = 0.1083\r\n', now=1380585630.5)
+        assert logger.readings == 2
+        assert logger.minute.stats(1380585630.5) == (18.0, 19, 2)
+        assert 'last minute  18.0 CPM mean' in logger.report()
+        conn = sqlite3.connect(dbfilepath)
+        assert conn.execute("SELECT * FROM radiation ORDER BY timestamp").fetchall() == [
+            ('geiger', 1380585600, 17, 0.0969), ('geiger', 1380585630, 19, 0.1083)]
+        conn.close()
+
+        # the capture replays to the same readings
+        capture.seek(0)
+        with RadiationWriter(os.path.join(tmpdir, 'replay.db')) as writer:
+            again = GeigerLogger(writer)
+            replay(capture, again, chunk_size=7)
+        assert again.readings == 2 and again.report() == logger.report()
+        capture.seek(0)
+        with RadiationWriter(dbfilepath) as writer: # already there
+            replay(capture, GeigerLogger(writer))
+        assert writer.duplicates == 2
+
+        log = StringIO.StringIO()
+        make_capture(log, days=1)
+        log.seek(0)
+        with RadiationWriter(os.path.join(tmpdir, 'day.db')) as writer:
+            day = GeigerLogger(writer)
+            replay(log, day)
+        assert 86400 / 30 <= day.readings <= 86400 / 5
+        assert day.parser.bad == 0
+        conn = sqlite3.connect(os.path.join(tmpdir, 'day.db'))
+        assert conn.execute("SELECT count(*) FROM radiation").fetchone() == (
+            day.readings,)
+        conn.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    print "All tests passed."
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', default='/dev/ttyUSB0',
+                        help='serial port of the Geiger counter')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='push a --capture file (- for stdin) through '
+                             'at full speed instead')
+    parser.add_argument('--capture', metavar='FILE',
+                        help='also keep the stamped readings in FILE')
+    parser.add_argument('--db', default='geiger.db')
+    parser.add_argument('--make-capture', metavar='FILE',
+                        help='write DAYS days of made-up readings to FILE')
+    parser.add_argument('--days', type=int, default=7)
+    args = parser.parse_args()
+
+    if args.make_capture:
+        with open(args.make_capture, 'w') as f:
+            make_capture(f, args.days)
+        return
+    capture = open(args.capture, 'a', 1) if args.capture else None
+    with RadiationWriter(args.db, batch_size=5000) as writer:
+        logger = GeigerLogger(writer, capture)
+        if args.replay:
+            f = sys.stdin if args.replay == '-' else open(args.replay, 'rb')
+            size, elapsed = replay(f, logger)
+            print '%d readings, %1.1f MB in %1.2f sec: %1.0f readings/sec' % (
+                logger.readings, size / 1e6, elapsed, logger.readings / elapsed)
+        else:
+            try:
+                follow(open_serial(args.port), logger)
+            except KeyboardInterrupt:
+                pass
+        print logger.report()
+
+if __name__ == '__main__':
+    main()
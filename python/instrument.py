@@ -0,0 +1,254 @@
+# Name:        instrument
+# Purpose:     time the steps of a program into latency histograms
+
+"""
+Lightweight instrumentation. Wrap a step in a span and its latency goes
+into a histogram of that name, or its error into the error count:
+
+    stats = Instruments()
+    with stats.span('connect'):
+        sock.connect(addr)
+    print stats.report()         # count, errors, mean, p50, p90, p99, max
+
+Each histogram keeps counts in buckets that grow by a quarter of a power
+of 2, from 1 microsecond up, so adding a latency is a log and an integer
+increment, and the percentiles are within 19% of the true values.
+
+Hooks added with add_hook() are called with (name, seconds, error) after
+every span. A disabled Instruments hands out the same do-nothing span
+every time, so leaving the spans in costs one method call each.
+
+The stats can be written to a file with dump(), or served as JSON on
+localhost with serve().
+"""
+
+import BaseHTTPServer
+import json
+import math
+import threading
+import time
+
+BUCKETS_PER_DOUBLING = 4
+NUM_BUCKETS = 40 * BUCKETS_PER_DOUBLING # 1 microsecond to 300 hours
+SMALLEST = 1e-6
+
+def bucket_of(seconds):
+    if seconds <= SMALLEST:
+        return 0
+    i = int(math.log(seconds / SMALLEST, 2) * BUCKETS_PER_DOUBLING) + 1
+    return min(i, NUM_BUCKETS - 1)
+
+def bucket_top(i):
+    'the largest latency that goes in bucket i'
+    return SMALLEST * 2 ** (float(i) / BUCKETS_PER_DOUBLING)
+
+class Histogram:
+    """Latencies of one step, in log-sized buckets"""
+    def __init__(self):
+        self.buckets = [0] * NUM_BUCKETS
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[bucket_of(seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        'the latency that p percent of the samples are no slower than'
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * p / 100.0)
+        seen = 0
+        for (i, n) in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min(bucket_top(i), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self):
+        return {'count': self.count, 'errors': self.errors,
+                'mean': self.mean(), 'max': self.max,
+                'p50': self.percentile(50), 'p90': self.percentile(90),
+                'p99': self.percentile(99)}
+
+class NullSpan:
+    'what a disabled Instruments hands out'
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Span:
+    def __init__(self, instruments, name):
+        self.instruments = instruments
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instruments.record(self.name, time.time() - self.start, exc_value)
+        return False
+
+class Instruments:
+    """A set of named latency histograms"""
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.histograms = {}
+        self.hooks = []
+        self.lock = threading.Lock()
+
+    def span(self, name):
+        "context manager that times its block as a name step"
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def record(self, name, seconds, error=None):
+        '''add a latency, or an error if error is not None. A step that
+        failed is counted as an error and its latency left out.'''
+        with self.lock:
+            h = self.histograms.get(name)
+            if h is None:
+                h = self.histograms[name] = Histogram()
+            if error is None:
+                h.add(seconds)
+            else:
+                h.errors += 1
+        for hook in self.hooks:
+            hook(name, seconds, error)
+
+    def add_hook(self, hook):
+        'call hook(name, seconds, error) after each span'
+        self.hooks.append(hook)
+
+    def summary(self):
+        'dict of step name --> dict of its stats, in seconds'
+        with self.lock:
+            return dict((name, h.summary())
+                        for (name, h) in self.histograms.items())
+
+    def report(self):
+        lines = []
+        for (name, s) in sorted(self.summary().items()):
+            lines.append('%-10s %6d x %4d errors  mean %8.2f  p50 %8.2f  '
+                         'p90 %8.2f  p99 %8.2f  max %8.2f ms' % (
+                name, s['count'], s['errors'], 1000 * s['mean'],
+                1000 * s['p50'], 1000 * s['p90'], 1000 * s['p99'],
+                1000 * s['max']))
+        return '\n'.join(lines)
+
+    def dump(self, filename):
+        'write the summary to filename as JSON'
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=1, sort_keys=True)
+
+    def serve(self, port=8642):
+        '''serve the summary as JSON on http://127.0.0.1:port/ from a
+        background thread. Returns the server; shutdown() stops it.'''
+        instruments = self
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(instruments.summary(), sort_keys=True)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass # not on stderr for every request
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), Handler)
+        thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        return server
+
+# The instruments of the router logger. Off until enabled.
+DEFAULT = Instruments(enabled=False)
+
+def run_tests():
+    '''testing is very important'''
+    assert bucket_of(0) == 0 and bucket_of(1e-6) == 0
+    assert bucket_of(2e-6) == 1 + BUCKETS_PER_DOUBLING
+    for seconds in [3e-6, 0.001, 0.0123, 1.5, 100.0]:
+        i = bucket_of(seconds)
+        assert bucket_top(i - 1) < seconds <= bucket_top(i) * 1.0000001
+
+    h = Histogram()
+    for ms in range(1, 101):
+        h.add(ms / 1000.0)
+    assert h.count == 100 and h.max == 0.1
+    assert abs(h.mean() - 0.0505) < 1e-9
+    for p in [50, 90, 99]:
+        assert p / 1000.0 <= h.percentile(p) < p / 1000.0 * 1.19
+    assert h.percentile(100) == 0.1
+    assert Histogram().percentile(50) == 0.0
+
+    stats = Instruments()
+    calls = []
+    stats.add_hook(lambda name, seconds, error: calls.append((name, error)))
+    with stats.span('connect'):
+        pass
+    try:
+        with stats.span('connect'):
+            raise IOError('refused')
+    except IOError:
+        pass
+    s = stats.summary()['connect']
+    assert s['count'] == 1 and s['errors'] == 1
+    assert [c[0] for c in calls] == ['connect', 'connect']
+    assert calls[0][1] is None and isinstance(calls[1][1], IOError)
+    assert 'connect' in stats.report()
+
+    off = Instruments(enabled=False)
+    assert off.span('connect') is NULL_SPAN
+    with off.span('connect'):
+        pass
+    assert off.summary() == {}
+
+    # switched off, a span costs next to nothing next to the step it wraps
+    n = 100000
+    t0 = time.time()
+    for _ in xrange(n):
+        with off.span('x'):
+            pass
+    per_span = (time.time() - t0) / n
+    assert per_span < 20e-6, per_span
+
+    import os
+    import shutil
+    import tempfile
+    import urllib2
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'stats.json')
+        stats.dump(filename)
+        with open(filename) as f:
+            assert json.load(f)['connect']['errors'] == 1
+    finally:
+        shutil.rmtree(tmpdir)
+    server = stats.serve(0)
+    try:
+        url = 'http://127.0.0.1:%d/' % server.server_address[1]
+        assert json.load(urllib2.urlopen(url))['connect']['count'] == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+    print 'Tests passed.'
+
+if __name__ == '__main__':
+    run_tests()
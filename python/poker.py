@@ -5,6 +5,7 @@
 #
 # Created:     19/09/2013
 
+import itertools
 import random
 import time
 
@@ -12,31 +13,197 @@ def count_items(list):
     'return a dictionary with the number of times something occurs in list'
     dic = {}
     for item in list:
-        if item in dict:
+        if item in dic:
             dic[item] += 1
         else:
             dic[item] = 1
     return dic
 
+# Card encoding for the lookup-table evaluator.
+# Card ids 0-51 follow the order of a fresh deck in Shoe: by suit, 2 to ace.
+RANKS = '23456789TJQKA'
+SUITS = 'HDSC'
+CARDS = [r+s for s in SUITS for r in RANKS]
+CARD_IDS = dict((card, i) for (i, card) in enumerate(CARDS))
+PRIMES = [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41]
+
+def card_int(card_id):
+    '''card_int(id) --> int
+    Pack a card into one integer, laid out as
+    rank bit (bits 16-28) | suit bit (12-15) | rank (8-11) | rank prime (0-7)
+    ANDing the suit bits of 5 cards tells a flush, ORing the rank bits gives
+    the set of ranks and multiplying the primes identifies the rank counts.'''
+    r, s = card_id % 13, card_id // 13
+    return (1 << (16 + r)) | (1 << (12 + s)) | (r << 8) | PRIMES[r]
+
+CARD_INTS = [card_int(i) for i in range(52)]
+CARD_RANKS = [i % 13 + 2 for i in range(52)] # as in Hand.card_rank()
+RANK_BITS = [1 << (i % 13) for i in range(52)]
+SUIT_BITS = [1 << (i // 13) for i in range(52)]
+# rank bits (0-12) and suit bits (13-16) of a card in one int, by card id
+# and by the 1-char string that card id is read as from a memoryview
+CARD_MASKS = [RANK_BITS[i] | SUIT_BITS[i] << 13 for i in range(52)]
+CHAR_MASKS = dict((chr(i), CARD_MASKS[i]) for i in range(52))
+CHAR_INTS = dict((chr(i), CARD_INTS[i]) for i in range(52))
+
+def rank_tuple(ranks, flush, ace_low=False):
+    '''return the (category, ranks) tuple of Hand.rank() for a list of
+    card ranks; flush tells if the cards are all of the same suit.
+    Hand.rank() has no A-2-3-4-5 straight; with ace_low it is one, five
+    high, as in the rules of poker (see best_hand in udacity/hw1-1.py).'''
+    dic = count_items(ranks) # build a dictionary of rank counts
+    # list of groups of equal-ranked cards, in decreasing counts
+    # e.g. [(4,9), (1,11)] --> four 9's and one jack
+    items = sorted(dic.items(), key=lambda (r,c): (c,r), reverse=True)
+    ranks_ = [r for (r,c) in items]
+    counts = [c for (r,c) in items]
+    rs = sorted(ranks)
+    if ace_low and rs == [2, 3, 4, 5, 14]:
+        rs = [1, 2, 3, 4, 5] # the wheel: the ace plays low
+    straight = all(b-a == 1 for (a,b) in zip(rs, rs[1:]))
+
+    if straight and flush:
+        return (8, max(rs))
+    elif counts[0] == 4:
+        return (7, ranks_)
+    elif counts[0] == 3 and counts[1] == 2:
+        return (6, ranks_)
+    elif flush:
+        return (5, sorted(ranks_, reverse=True))
+    elif straight:
+        return (4, max(rs))
+    elif counts[0] == 3:
+        return (3, ranks_)
+    elif counts[0] == 2 and counts[1] == 2:
+        return (2, ranks_)
+    elif counts[0] == 2:
+        return (1, ranks_)
+    else:
+        return (0, ranks_)
+
+def build_tables(ace_low=False):
+    '''precompute the evaluator tables from rank_tuple(), for every
+    5-card rank combination. Returns (flushes, products, flush_products, tuples)
+        flushes: list indexed by the 13-bit rank mask of a flush
+            of 5 different ranks
+        products: dict of rank-prime product --> strength (no flush)
+        flush_products: dict of rank-prime product --> strength (flush with
+            repeated ranks, only possible with more than one deck)
+        tuples: list of strength --> (category, ranks) tuple
+    Strengths are numbered 1 and up in the same order as the tuples.'''
+    hands = []
+    # shoes can hold several decks, so all rank repeats are possible
+    for combo in itertools.combinations_with_replacement(range(13), 5):
+        ranks = [r+2 for r in combo]
+        hands.append((rank_tuple(ranks, False, ace_low), False, combo))
+        hands.append((rank_tuple(ranks, True, ace_low), True, combo))
+    flushes = [0] * (1 << 13)
+    products = {}
+    flush_products = {}
+    tuples = [None]
+    for (t, flush, combo) in sorted(hands):
+        if t != tuples[-1]:
+            tuples.append(t)
+        strength = len(tuples) - 1
+        product = 1
+        for r in combo:
+            product *= PRIMES[r]
+        if not flush:
+            products[product] = strength
+        elif len(set(combo)) == 5:
+            flushes[sum(1 << r for r in combo)] = strength
+        else:
+            flush_products[product] = strength
+    return flushes, products, flush_products, tuples
+
+FLUSHES, PRODUCTS, FLUSH_PRODUCTS, STRENGTH_TUPLES = build_tables()
+# by the rules of poker, for equity and the simulator: the same but for
+# the wheel. The strengths are numbered apart from the ones above.
+(ACE_LOW_FLUSHES, ACE_LOW_PRODUCTS, ACE_LOW_FLUSH_PRODUCTS,
+ ACE_LOW_TUPLES) = build_tables(ace_low=True)
+
+def make_evaluate5(flushes, products, flush_products):
+    'an evaluate5() on the given tables'
+    def evaluate5(c1, c2, c3, c4, c5):
+        '''strength of a 5-card hand given as card_int() values.
+        The higher the number, the better the hand.'''
+        if c1 & c2 & c3 & c4 & c5 & 0xF000:
+            strength = flushes[(c1 | c2 | c3 | c4 | c5) >> 16]
+            if strength:
+                return strength
+            return flush_products[(c1 & 0xFF) * (c2 & 0xFF) * (c3 & 0xFF) *
+                                  (c4 & 0xFF) * (c5 & 0xFF)]
+        return products[(c1 & 0xFF) * (c2 & 0xFF) * (c3 & 0xFF) *
+                        (c4 & 0xFF) * (c5 & 0xFF)]
+    return evaluate5
+
+evaluate5 = make_evaluate5(FLUSHES, PRODUCTS, FLUSH_PRODUCTS)
+evaluate5_ace_low = make_evaluate5(ACE_LOW_FLUSHES, ACE_LOW_PRODUCTS,
+                                   ACE_LOW_FLUSH_PRODUCTS)
+
+def hand_strength(cards):
+    '''hand_strength(cards) --> int
+    Strength of the best 5-card hand that can be made from cards,
+    e.g. ['TD', 'TH', '2H', '2S', '2C']. Comparable between hands.'''
+    return best_strength([CARD_INTS[CARD_IDS[c]] for c in cards])
+
+def best_strength(ints, evaluate=evaluate5):
+    '''strength of the best 5-card hand among card_int() values.
+    evaluate: evaluate5, or evaluate5_ace_low for the rules of poker'''
+    if len(ints) == 5:
+        return evaluate(*ints)
+    return max(evaluate(*hand5) for hand5 in itertools.combinations(ints, 5))
+
+def strength_tuple(strength, tuples=STRENGTH_TUPLES):
+    '''the (category, ranks) tuple, as given by Hand.rank(), for a strength.
+    tuples: ACE_LOW_TUPLES for a strength from evaluate5_ace_low'''
+    (category, ranks) = tuples[strength]
+    if isinstance(ranks, list):
+        ranks = ranks[:] # don't hand out the table's own list
+    return (category, ranks)
+
+def fisher_yates(cards, start=0, stop=None, rng=None):
+    'shuffle cards[start:stop] in place, drawing from rng (see Shoe.shuffle3)'
+    if stop is None:
+        stop = len(cards)
+    rand = (rng or random).random
+    for i in xrange(stop - 1, start, -1):
+        # pick one of the cards not placed yet, cards[start..i]
+        j = start + int(rand() * (i - start + 1))
+        cards[i], cards[j] = cards[j], cards[i]
+
 class Shoe():
-    'A shoe of playing cards, for shuffling and dealing out cards'
-    def __init__(self, num_decks=1):
+    '''A shoe of playing cards, for shuffling and dealing out cards.
+    In compact mode the shoe is a bytearray of card ids (see CARDS) and
+    dealt hands are views into it, so no card is copied when dealing.'''
+    def __init__(self, num_decks=1, compact=False):
         'initialize with a given number of decks'
-        a_deck = [r+s for s in 'HDSC' for r in '23456789TJQKA']
-        self.shoe = [card for card in a_deck for i in range(num_decks)]
+        if compact:
+            self.shoe = bytearray(i for i in range(52) for _ in range(num_decks))
+            self.left = len(self.shoe) # cards left, shoe[left:] is dealt
+        else:
+            a_deck = [r+s for s in 'HDSC' for r in '23456789TJQKA']
+            self.shoe = [card for card in a_deck for i in range(num_decks)]
+            self.left = None
+
+    def __len__(self):
+        'number of cards left in the shoe'
+        if self.left is None:
+            return len(self.shoe)
+        return self.left
 
     def shuffle1(self):
         'shuffle the cards in the shoe'
+        n = len(self)
         tmp_shoe = []
-        for card in self.shoe:
+        for card in self.shoe[:n]:
             tmp_shoe.append((random.randint(0, 9999), card))
         # tmp_shoe is now a list of the form [(534,'2H'), (9035:'2H')...]
-        del self.shoe
-        self.shoe = [card for (r, card) in sorted(tmp_shoe)]
+        self.shoe[:n] = [card for (r, card) in sorted(tmp_shoe)]
 
     def shuffle2(self):
         'shuffle the cards in the shoe using a swapping method'
-        n = len(self.shoe)
+        n = len(self)
         for _ in range(n/2):
             # pick two random cards and swap them
             i = random.randint(0, n-1)
@@ -45,23 +212,67 @@ class Shoe():
             self.shoe[i] = self.shoe[j]
             self.shoe[j] = tmp
 
+    def shuffle3(self, rng=None):
+        '''shuffle the cards in place with the Fisher-Yates method. O(n), and
+        every order of the cards is equally likely.
+        rng: random.Random(seed), random.SystemRandom() or anything else with
+        a random() method. Defaults to the random module.'''
+        fisher_yates(self.shoe, 0, len(self), rng)
+
     def deal(self, size=5):
-        '''deal(size, default 5) --> list of cards
+        '''deal(size, default 5) --> Hand
         Deal cards from the shoe '''
-        if len(self.shoe) < size:
+        if len(self) < size:
             raise Exception('Not enough cards in shoe.')
+        if self.left is not None:
+            # the dealt cards stay put at the end of the shoe, out of the
+            # way of the shuffles, and the hand only gets a view of them
+            self.left -= size
+            return Hand(memoryview(self.shoe)[self.left:self.left + size])
         hand = []
         for _ in range(size):
             hand.append( self.shoe.pop() )
         return Hand(hand)
 
-class Hand():
+class Hand(object):
     '''A poker hand. This is basically a list of cards,
-    e.g. ['TD', 'TH', '2H', '2S', '2C'] (full house)'''
+    e.g. ['TD', 'TH', '2H', '2S', '2C'] (full house),
+    or a memoryview of card ids when dealt from a compact Shoe.
+    The ranks and suits are kept as bitmasks, worked out once.'''
+    __slots__ = ('cards', '_ids', '_card_ranks', 'rank_mask', 'suit_mask')
+
     def __init__(self, cards):
         self.cards = cards
-        self.card_ranks = [self.card_rank(c[0]) for c in self.cards]
-        self.card_suits = [c[1] for c in self.cards]
+        self._card_ranks = None
+        mask = 0
+        if isinstance(cards, memoryview):
+            self._ids = None # copied out of the view only if asked for
+            masks = CHAR_MASKS
+            for c in cards: # 1-char strings
+                mask |= masks[c]
+        else:
+            self._ids = [CARD_IDS[c] for c in cards]
+            for i in self._ids:
+                mask |= CARD_MASKS[i]
+        self.rank_mask = mask & 0x1FFF
+        self.suit_mask = mask >> 13
+
+    @property
+    def ids(self):
+        'the card ids, copied out of the view the first time they are needed'
+        if self._ids is None:
+            self._ids = self.cards.tolist()
+        return self._ids
+
+    @property
+    def card_ranks(self):
+        if self._card_ranks is None:
+            self._card_ranks = [CARD_RANKS[i] for i in self.ids]
+        return self._card_ranks
+
+    @property
+    def card_suits(self):
+        return [CARDS[i][1] for i in self.ids]
 
     def card_rank(self, rank):
         '''take a card (e.g. four of spades: '4S') and return its rank (4)'''
@@ -81,19 +292,14 @@ class Hand():
 
     def is_straight(self):
         'return True if cards form an unbroken sequence'
-        rs = sorted(self.card_ranks)
-        diffs = [a-b for (a,b) in zip(rs[1:], rs)]
-        # diffs is a list that holds the differences between a card and the next
-        # if it is a sequence, the list should be [1, 1, 1, 1, 1]
-        for diff in diffs:
-            if diff <> 1:
-                return False
-        return True
+        # all ranks different, and their bits in one unbroken run
+        m = self.rank_mask
+        run = m // (m & -m) if m else 0 # shifted down to bit 0
+        return bin(m).count('1') == len(self.cards) and run & (run + 1) == 0
 
     def is_flush(self):
         'return True if all cards are of the same suit'
-        ss = sorted(self.card_suits)
-        return ss[0] == ss[-1] # if first and last match, then all are the same.
+        return self.suit_mask & (self.suit_mask - 1) == 0 # only one suit bit
 
     def rank(self):
         '''return a tuple that gives a metric of how strong the poker hand is
@@ -108,31 +314,18 @@ class Hand():
         (0, [6, 5, 4, 3, 2]) --> got nothin'! 6 high...
         '''
 
-        dic = count_items(self.card_ranks) # build a dictionary of rank counts
-        # list of groups of equal-ranked cards, in decreasing counts
-        # e.g. [(4,9), (1,11)] --> four 9's and one jack
-        items = sorted(dic.items(), key=lambda (r,c): (c,r), reverse=True)
-        ranks = [r for (r,c) in items]
-        counts = [c for (r,c) in items]
-
-        if self.is_straight() and self.is_flush():
-            return (8, max(self.card_ranks))
-        elif counts[0] == 4:
-            return (7, ranks)
-        elif counts[0] == 3 and counts[1] == 2:
-            return (6, ranks)
-        elif self.is_flush():
-            return (5, sorted(ranks, reverse=True))
-        elif self.is_straight():
-            return (4, max(ranks))
-        elif counts[0] == 3:
-            return (3, ranks)
-        elif counts[0] == 2 and counts[1] == 2:
-            return (2, ranks)
-        elif counts[0] == 2:
-            return (1, ranks)
+        if len(self.cards) != 5:
+            return rank_tuple(self.card_ranks, self.is_flush())
+        return strength_tuple(self.strength())
+
+    def strength(self, ace_low=False):
+        '''return the hand strength as one integer (see hand_strength).
+        ace_low: by the rules of poker, where A-2-3-4-5 is a straight'''
+        if self._ids is None:
+            ints = [CHAR_INTS[c] for c in self.cards]
         else:
-            return (0, ranks)
+            ints = [CARD_INTS[i] for i in self._ids]
+        return best_strength(ints, evaluate5_ace_low if ace_low else evaluate5)
 
 
 def run_tests():
@@ -146,6 +339,9 @@ def run_tests():
         assert(len(s.shoe)) == num_decks * 52
         s.shuffle2()
         assert(len(s.shoe)) == num_decks * 52
+        s.shuffle3()
+        assert(len(s.shoe)) == num_decks * 52
+        s.shuffle3(random.SystemRandom())
         assert sorted(tmp_shoe) == sorted(s.shoe)
         if num_decks > 0:
             hand = s.deal()
@@ -204,21 +400,110 @@ def run_tests():
     h3 = Hand('2D 7H 3S 5D 4S'.split(' '))  # nothing
     assert h3.rank() == (0, [7, 5, 4, 3, 2])
 
-    print 'Tests passed.'
-    print 'Tests took %1.3f sec.' % (time.clock() - t0)
-
-def timer():
-    'measure time it takes to run stuff'
-    s = Shoe(5)
-    t0 = time.clock()
+    # same seed, same order
+    s1, s2 = Shoe(2), Shoe(2)
+    s1.shuffle3(random.Random(7))
+    s2.shuffle3(random.Random(7))
+    assert s1.shoe == s2.shoe and s1.shoe != Shoe(2).shoe
+    # compact shoes deal views of the card ids
+    s = Shoe(6, compact=True)
+    assert len(s) == len(s.shoe) == 6 * 52
+    s.shuffle3(random.Random(7))
     s.shuffle1()
-    t_shuf1 = time.clock() - t0
-
-    t0 = time.clock()
     s.shuffle2()
-    t_shuf2 = time.clock() - t0
+    assert sorted(s.shoe) == sorted(Shoe(6, compact=True).shoe)
+    hand = s.deal()
+    assert len(s) == 6 * 52 - 5 and isinstance(hand.cards, memoryview)
+    assert hand._ids is None # not copied out of the view until asked for
+    assert hand.ids == list(s.shoe[-5:])
+    strings = Hand([CARDS[i] for i in hand.ids])
+    assert hand.card_ranks is hand.card_ranks # worked out once
+    assert (hand.rank_mask, hand.suit_mask) == (strings.rank_mask,
+                                                strings.suit_mask)
+    h = s.deal()
+    assert h.strength() == Hand([CARDS[i] for i in h.cards.tolist()]).strength()
+    assert hand.card_ranks == strings.card_ranks
+    assert hand.card_suits == strings.card_suits
+    assert hand.rank() == strings.rank()
+    s.shuffle3() # only the cards left get shuffled
+    assert hand.ids == list(s.shoe[-5:]) == hand.cards.tolist()
+    while len(s) >= 7:
+        hand = s.deal(7)
+    assert len(hand.cards) == 7
+    try:
+        s.deal(7)
+        assert False, 'dealing from an empty shoe should raise'
+    except Exception as e:
+        assert 'Not enough' in str(e)
+    assert not hasattr(hand, '__dict__')
+
+    # all 6 orders of 3 cards come up about equally often
+    rng = random.Random(1)
+    counts = {}
+    for _ in range(6000):
+        cards = ['a', 'b', 'c']
+        fisher_yates(cards, rng=rng)
+        counts[''.join(cards)] = counts.get(''.join(cards), 0) + 1
+    assert len(counts) == 6
+    assert all(900 < n < 1100 for n in counts.values())
+
+    # the lookup tables must agree with the (category, ranks) tuples
+    s = Shoe(3)
+    hands = []
+    for _ in range(2000):
+        if len(s.shoe) < 5:
+            s = Shoe(3)
+        s.shuffle1()
+        hand = s.deal()
+        assert hand.rank() == rank_tuple(hand.card_ranks, hand.is_flush())
+        hands.append(hand)
+    for (ha, hb) in zip(hands, hands[1:]):
+        assert ((ha.strength() < hb.strength()) ==
+                (ha.rank() < hb.rank()))
+    assert (hand_strength('TD TH 9H 6S 7C 2D 2H'.split()) ==
+            Hand('TD TH 2D 2H 9H'.split()).strength())
+
+    # by the rules of poker A-2-3-4-5 is a straight, five high; Hand.rank()
+    # keeps to the rules of the game, where it is ace high
+    wheel = Hand('AS 2D 3C 4H 5S'.split())
+    steel = Hand('AH 2H 3H 4H 5H'.split())
+    assert wheel.rank() == (0, [14, 5, 4, 3, 2]) and steel.rank()[0] == 5
+    assert ACE_LOW_TUPLES[wheel.strength(ace_low=True)] == (4, 5)
+    assert ACE_LOW_TUPLES[steel.strength(ace_low=True)] == (8, 5)
+    assert rank_tuple(wheel.card_ranks, False, ace_low=True) == (4, 5)
+    trips = Hand('KS KD KC 9H 2S'.split())
+    assert (trips.strength(True) < wheel.strength(True) <
+            Hand('2S 3D 4C 5H 6S'.split()).strength(True))
+    assert (Hand('KH QH JH TH 9H'.split()).strength(True) >
+            steel.strength(True) > Hand('KS KD KC KH 2S'.split()).strength(True))
+    # 10 straights among the 1287 sets of 5 different ranks, not 9
+    for (tuples, flushes, straights) in [(STRENGTH_TUPLES, FLUSHES, 9),
+                                         (ACE_LOW_TUPLES, ACE_LOW_FLUSHES, 10)]:
+        assert sum(1 for x in flushes if x and tuples[x][0] == 8) == straights
+    for hand in hands: # nothing else changes
+        assert (ACE_LOW_TUPLES[hand.strength(True)] == hand.rank() or
+                sorted(hand.card_ranks) == [2, 3, 4, 5, 14])
+
+    print 'Tests passed.'
+    print 'Tests took %1.3f sec.' % (time.clock() - t0)
 
-    print 'shuffle1: %1.4f sec. shuffle2: %1.4f sec.' % (t_shuf1, t_shuf2)
+def timer(deck_counts=(1, 2, 4, 6, 8), repeat=20):
+    '''measure time it takes to run stuff: best and mean time per shuffle
+    over a number of runs, for each shuffle method and shoe size'''
+    methods = [('shuffle1', Shoe.shuffle1), ('shuffle2', Shoe.shuffle2),
+               ('shuffle3', Shoe.shuffle3)]
+    print '%6s  %-10s %12s %12s' % ('decks', 'method', 'best (ms)', 'mean (ms)')
+    for num_decks in deck_counts:
+        for (name, shuffle) in methods:
+            s = Shoe(num_decks)
+            shuffle(s) # warm up
+            times = []
+            for _ in range(repeat):
+                t0 = time.clock()
+                shuffle(s)
+                times.append(time.clock() - t0)
+            print '%6d  %-10s %12.4f %12.4f' % (
+                num_decks, name, 1000 * min(times), 1000 * sum(times) / repeat)
 
 def main():
     #run_tests()
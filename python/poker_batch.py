@@ -0,0 +1,254 @@
+# Name:        poker_batch
+# Purpose:     rank many poker hands at once with NumPy
+
+"""
+Batch version of the poker.py hand evaluator. Hands are rows of an integer
+array of card ids (0-51, see poker.CARDS), and rank_hands() returns the
+same strengths as poker.hand_strength() for every row in one call.
+
+Everything is done with array ops: flushes by comparing the suits of a
+row, rank counting with the rank-prime product and the rank bitmask of
+each row, and straights fall out of the table lookup on the bitmask.
+
+shuffle_shoes() shuffles many shoes in the same way, one shoe per row.
+"""
+
+import collections
+import itertools
+import random
+import time
+
+import numpy as np
+
+import poker
+
+RANK_OF = np.arange(52) % 13
+SUIT_OF = np.arange(52) // 13
+PRIME_OF = np.array(poker.PRIMES, dtype=np.int64)[RANK_OF]
+POPCOUNT = np.array([bin(m).count('1') for m in range(1 << 13)])
+
+def make_tables():
+    '''turn the poker.py evaluator tables into arrays:
+        flushes: strength by rank mask, flush of 5 different ranks
+        uniques: strength by rank mask, 5 different ranks but no flush
+        (keys, values): sorted prime products of the hands with repeated
+            ranks and their strengths, for np.searchsorted()
+        (flush_keys, flush_values): same for flushes with repeated ranks'''
+    flushes = np.array(poker.FLUSHES, dtype=np.int32)
+    uniques = np.zeros(1 << 13, dtype=np.int32)
+    for combo in itertools.combinations(range(13), 5):
+        product = 1
+        for r in combo:
+            product *= poker.PRIMES[r]
+        uniques[sum(1 << r for r in combo)] = poker.PRODUCTS[product]
+    def sorted_table(table):
+        keys = np.array(sorted(table), dtype=np.int64)
+        values = np.array([table[k] for k in keys], dtype=np.int32)
+        return keys, values
+    return (flushes, uniques, sorted_table(poker.PRODUCTS),
+            sorted_table(poker.FLUSH_PRODUCTS))
+
+FLUSHES, UNIQUES, (KEYS, VALUES), (FLUSH_KEYS, FLUSH_VALUES) = make_tables()
+
+def encode_hands(hands, size=5):
+    '''encode_hands(hands) --> (N, k) array of card ids
+    hands is a list of hands, each a list of cards like ['TD', '9H', ...]
+    or a string like 'TD 9H ...'. No hands give a (0, size) array.'''
+    rows = []
+    for hand in hands:
+        if isinstance(hand, basestring):
+            hand = hand.split()
+        rows.append([poker.CARD_IDS[c] for c in hand])
+    if not rows:
+        return np.zeros((0, size), dtype=np.uint8)
+    return np.array(rows, dtype=np.uint8).reshape(len(rows), -1)
+
+def rank5(cards):
+    '''rank5(cards) --> N-length array of strengths
+    cards: (N, 5) array of card ids'''
+    cards = np.asarray(cards, dtype=np.intp)
+    suits = SUIT_OF[cards]
+    flush = (suits == suits[:, :1]).all(axis=1)
+    mask = np.bitwise_or.reduce(np.left_shift(1, RANK_OF[cards]), axis=1)
+    unique = POPCOUNT[mask] == 5
+    strengths = np.empty(len(cards), dtype=np.int32)
+
+    rows = flush & unique
+    strengths[rows] = FLUSHES[mask[rows]]
+    rows = ~flush & unique
+    strengths[rows] = UNIQUES[mask[rows]]
+    # repeated ranks: the prime product tells how many of each
+    for (rows, keys, values) in [(~flush & ~unique, KEYS, VALUES),
+                                 (flush & ~unique, FLUSH_KEYS, FLUSH_VALUES)]:
+        if rows.any():
+            products = PRIME_OF[cards[rows]].prod(axis=1)
+            strengths[rows] = values[np.searchsorted(keys, products)]
+    return strengths
+
+def rank_hands(cards):
+    '''rank_hands(cards) --> N-length array of strengths
+    cards: (N, 5) to (N, 7) array of card ids. For more than 5 cards the
+    strength is that of the best 5-card hand in the row.'''
+    cards = np.asarray(cards)
+    if cards.ndim != 2 or cards.shape[1] < 5:
+        raise ValueError('Expected an (N, 5) to (N, 7) array of cards.')
+    if cards.shape[1] == 5:
+        return rank5(cards)
+    best = None
+    for columns in itertools.combinations(range(cards.shape[1]), 5):
+        strengths = rank5(cards[:, columns])
+        best = strengths if best is None else np.maximum(best, strengths)
+    return best
+
+def shuffle_shoes(shoes, rng=None):
+    '''shuffle the cards left in many shoes at once, with the Fisher-Yates
+    method of Shoe.shuffle3 run on all of them together. The shoes with
+    the same number of cards left are the rows of one array, and for each
+    place i from the last one down, every row swaps its card i with one
+    of the cards 0 to i, all rows in one array op. O(n) per shoe, and
+    every order is equally likely.
+    rng: as for Shoe.shuffle3, anything with a random() method; the
+    random numbers are drawn in the same order, so shoes of the same size
+    come out as from shuffle3 on each in turn. A numpy RandomState is
+    drawn from with random_sample() instead, all in one call.
+    Compact shoes are read and written in place; shoes of card strings
+    are turned into ids and back, which costs more than the shuffle.'''
+    if rng is None:
+        rng = random
+    sizes = []
+    by_size = {}
+    for s in shoes:
+        if len(s) not in by_size:
+            sizes.append(len(s))
+            by_size[len(s)] = []
+        by_size[len(s)].append(s)
+    for n in sizes:
+        group = by_size[n]
+        if n < 2:
+            continue
+        cards = np.empty((len(group), n), dtype=np.uint8)
+        for (row, s) in zip(cards, group):
+            if s.left is None:
+                row[:] = [poker.CARD_IDS[c] for c in s.shoe[:n]]
+            else:
+                row[:] = np.frombuffer(s.shoe, np.uint8, n)
+        # row r, column k: the draw that places card n - 1 - k of shoe r
+        draws = len(group) * (n - 1)
+        if hasattr(rng, 'random_sample'):
+            u = rng.random_sample(draws)
+        else:
+            rand = rng.random
+            u = np.fromiter((rand() for _ in xrange(draws)), np.float64, draws)
+        u = u.reshape(len(group), n - 1)
+        rows = np.arange(len(group))
+        for (k, i) in enumerate(xrange(n - 1, 0, -1)):
+            j = (u[:, k] * (i + 1)).astype(np.intp)
+            picked = cards[rows, j]
+            cards[rows, j] = cards[:, i]
+            cards[:, i] = picked
+        for (row, s) in zip(cards, group):
+            if s.left is None:
+                s.shoe[:n] = [poker.CARDS[i] for i in row]
+            else:
+                np.frombuffer(s.shoe, np.uint8, n)[:] = row
+
+def run_tests():
+    '''testing is very important'''
+    hands = encode_hands(['TD 8H 9H 6S 7C', 'TD TD 9D 6D 7D'])
+    assert hands.shape == (2, 5)
+    assert list(hands[0]) == [poker.CARD_IDS[c] for c in 'TD 8H 9H 6S 7C'.split()]
+    assert encode_hands([]).shape == (0, 5)
+    assert encode_hands([], 7).shape == (0, 7)
+    assert len(rank_hands(encode_hands([]))) == 0
+
+    for size in [5, 6, 7]:
+        for num_decks in [1, 3]:
+            s = poker.Shoe(num_decks)
+            hands = []
+            while len(s.shoe) >= size:
+                s.shuffle1()
+                hands.append(s.deal(size).cards)
+            strengths = rank_hands(encode_hands(hands))
+            assert list(strengths) == [poker.hand_strength(h) for h in hands]
+    try:
+        rank_hands(np.zeros((3, 4), dtype=np.uint8))
+        assert False, 'too few cards should raise'
+    except ValueError:
+        pass
+
+    shoes = [poker.Shoe(6, compact=True) for _ in range(4)] + [poker.Shoe(1)]
+    hand = shoes[0].deal(7)
+    dealt = hand.ids
+    shuffle_shoes(shoes, random.Random(7))
+    for s in shoes[1:4]:
+        assert sorted(s.shoe) == sorted(poker.Shoe(6, compact=True).shoe)
+    assert shoes[1].shoe != shoes[2].shoe
+    assert sorted(shoes[4].shoe) == sorted(poker.Shoe(1).shoe)
+    assert shoes[4].shoe != poker.Shoe(1).shoe
+    assert len(shoes[0]) == 6 * 52 - 7 and hand.ids == dealt # left alone
+    again = [poker.Shoe(6, compact=True) for _ in range(4)]
+    again[0].deal(7)
+    shuffle_shoes(again, random.Random(7))
+    assert [s.shoe for s in again] == [s.shoe for s in shoes[:4]]
+    # the same as shuffle3 on one shoe after the other, from the same rng
+    one_by_one = [poker.Shoe(2, compact=True) for _ in range(5)]
+    rng = random.Random(3)
+    for s in one_by_one:
+        s.shuffle3(rng)
+    together = [poker.Shoe(2, compact=True) for _ in range(5)]
+    shuffle_shoes(together, random.Random(3))
+    assert [s.shoe for s in together] == [s.shoe for s in one_by_one]
+    shuffle_shoes(together, random.SystemRandom())
+    assert sorted(together[0].shoe) == sorted(poker.Shoe(2, compact=True).shoe)
+    # each card is as likely to end up in any place
+    for rng in [random.Random(1), np.random.RandomState(1)]:
+        shoes = [poker.Shoe(1, compact=True) for _ in range(5200)]
+        shuffle_shoes(shoes, rng)
+        places = np.bincount([s.shoe.index(chr(0)) for s in shoes],
+                             minlength=52)
+        assert places.min() > 50 and places.max() < 160
+    # and all 6 orders of 3 cards come up about equally often
+    shoes = [poker.Shoe(1, compact=True) for _ in range(6000)]
+    for s in shoes:
+        s.left = 3
+    shuffle_shoes(shoes, random.Random(1))
+    counts = collections.Counter(str(s.shoe[:3]) for s in shoes)
+    assert len(counts) == 6 and all(900 < c < 1100 for c in counts.values())
+    print 'Tests passed.'
+
+def timer(n=100000):
+    'compare the batch ranking with ranking one Hand at a time'
+    cards = np.array([random.sample(range(52), 7) for _ in range(n)],
+                     dtype=np.uint8)
+    for size in [5, 7]:
+        hands = [[poker.CARDS[c] for c in row[:size]] for row in cards]
+        t0 = time.clock()
+        for hand in hands:
+            poker.hand_strength(hand)
+        t_one = time.clock() - t0
+
+        t0 = time.clock()
+        rank_hands(cards[:, :size])
+        t_batch = time.clock() - t0
+        print '%d cards: one at a time %1.3f sec. batch %1.3f sec.' % (
+            size, t_one, t_batch)
+
+    for num_decks in [1, 6]:
+        shoes = [poker.Shoe(num_decks, compact=True) for _ in range(1000)]
+        t0 = time.clock()
+        for s in shoes:
+            s.shuffle3()
+        t_one = time.clock() - t0
+        t0 = time.clock()
+        shuffle_shoes(shoes)
+        t_batch = time.clock() - t0
+        t0 = time.clock()
+        shuffle_shoes(shoes, np.random.RandomState())
+        t_numpy = time.clock() - t0
+        print ('1000 %d-deck shoes: shuffle3 %1.3f sec. shuffle_shoes %1.3f '
+               'sec, %1.3f sec. from a RandomState' % (
+                   num_decks, t_one, t_batch, t_numpy))
+
+if __name__ == '__main__':
+    run_tests()
+    timer()
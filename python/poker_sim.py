@@ -0,0 +1,155 @@
+# Name:        poker_sim
+# Purpose:     deal and rank millions of poker hands without a player
+
+"""
+Headless poker simulation, built as a pipeline of generators:
+
+    shoes --> shuffled --> deal_batches --> rank_batches --> tally
+
+Hands are dealt in batches from a compact Shoe and only the running
+counts are kept, so memory stays the same however many hands are dealt.
+When a shoe runs low a fresh one is shuffled in.
+
+Run from the command line to print category frequencies and hands/sec:
+    python poker_sim.py --hands 1000000 --decks 6
+"""
+
+import argparse
+import itertools
+import random
+import time
+
+import poker
+
+CATEGORIES = ['high card', 'one pair', 'two pair', 'three of a kind',
+              'straight', 'flush', 'full house', 'four of a kind',
+              'straight flush']
+
+# hand strength by the rules of poker, A-2-3-4-5 a straight -->
+# category number, 0 (high card) to 8 (straight flush)
+STRENGTH_CATEGORY = [t and t[0] for t in poker.ACE_LOW_TUPLES]
+
+def shoes(num_decks):
+    'an endless supply of fresh compact shoes'
+    while True:
+        yield poker.Shoe(num_decks, compact=True)
+
+def shuffled(shoes, rng=None):
+    'shuffle each shoe as it goes by'
+    for s in shoes:
+        s.shuffle3(rng)
+        yield s
+
+def deal_batches(shoes, size=5, batch_size=1000, reshuffle_at=None):
+    '''deal hands of size cards, batch_size hands at a time, moving on to
+    the next shoe once no more than reshuffle_at cards are left
+    (default: when there are not enough for another hand). Once the shoes
+    run out, what is left is dealt as a last, shorter batch.'''
+    if reshuffle_at is None:
+        reshuffle_at = size - 1
+    batch = []
+    for s in shoes:
+        while len(s) > reshuffle_at and len(s) >= size:
+            batch.append(s.deal(size))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+def rank_batches(batches):
+    'turn batches of hands into lists of hand categories'
+    category = STRENGTH_CATEGORY
+    for batch in batches:
+        yield [category[hand.strength(ace_low=True)] for hand in batch]
+
+def tally(batches, num_hands):
+    '''count the categories of num_hands hands, yielding the running
+    counts (a list indexed by category) after every batch'''
+    counts = [0] * len(CATEGORIES)
+    seen = 0
+    for batch in batches:
+        if seen + len(batch) > num_hands:
+            batch = batch[:num_hands - seen]
+        for c in batch:
+            counts[c] += 1
+        seen += len(batch)
+        yield counts[:]
+        if seen >= num_hands:
+            break
+
+def simulate(num_hands, num_decks=6, size=5, batch_size=1000,
+             reshuffle_at=None, seed=None):
+    '''simulate(num_hands) --> generator of running category counts
+    Deal and rank num_hands hands. See deal_batches for the options.'''
+    rng = random.Random(seed)
+    hands = deal_batches(shuffled(shoes(num_decks), rng), size, batch_size,
+                         reshuffle_at)
+    return tally(rank_batches(hands), num_hands)
+
+def frequencies(counts):
+    'category counts --> list of (name, count, fraction)'
+    total = float(sum(counts)) or 1.0
+    return [(name, n, n / total) for (name, n) in zip(CATEGORIES, counts)]
+
+def run_tests():
+    '''testing is very important'''
+    runs = list(simulate(2500, num_decks=1, batch_size=1000, seed=1))
+    assert len(runs) == 3 # 1000 + 1000 + 500 hands
+    counts = runs[-1]
+    assert sum(counts) == 2500
+    # about half of all 5-card hands are high card, 42% one pair
+    assert 0.45 < counts[0] / 2500.0 < 0.55
+    assert 0.38 < counts[1] / 2500.0 < 0.47
+    assert list(simulate(2500, num_decks=1, seed=1))[-1] == counts
+    wheels = [poker.Hand('AS 2D 3C 4H 5S'.split()),
+              poker.Hand('AH 2H 3H 4H 5H'.split())]
+    assert next(rank_batches([wheels])) == [4, 8]
+
+    # a 1-deck shoe dealt in 5s is replaced after 10 hands
+    used = []
+    def counted(shoes):
+        for s in shoes:
+            used.append(s)
+            yield s
+    batch = next(deal_batches(counted(shuffled(shoes(1))), 5, 15))
+    assert len(batch) == 15 and len(used) == 2
+    # or sooner, with reshuffle_at
+    used = []
+    next(deal_batches(counted(shuffled(shoes(1))), 5, 15, reshuffle_at=26))
+    assert len(used) == 3
+    # the hands dealt when the shoes run out still come through
+    batches = list(deal_batches(itertools.islice(shuffled(shoes(1)), 2), 5, 15))
+    assert [len(b) for b in batches] == [15, 5]
+    print 'Tests passed.'
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--hands', type=int, default=1000000)
+    parser.add_argument('--decks', type=int, default=6)
+    parser.add_argument('--size', type=int, default=5,
+                        help='cards per hand (best 5 are ranked)')
+    parser.add_argument('--batch', type=int, default=1000)
+    parser.add_argument('--reshuffle-at', type=int, default=None,
+                        help='cards left when a fresh shoe is brought in')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--every', type=int, default=100,
+                        help='print running counts every this many batches')
+    args = parser.parse_args()
+
+    t0 = time.time()
+    counts = [0] * len(CATEGORIES)
+    for (i, counts) in enumerate(simulate(args.hands, args.decks, args.size,
+                                          args.batch, args.reshuffle_at,
+                                          args.seed)):
+        if (i + 1) % args.every == 0:
+            print '%d hands, %1.0f hands/sec' % (
+                sum(counts), sum(counts) / (time.time() - t0))
+    elapsed = time.time() - t0
+    for (name, n, fraction) in frequencies(counts):
+        print '%-16s %10d  %8.4f%%' % (name, n, 100 * fraction)
+    print '%d hands in %1.3f sec, %1.0f hands/sec' % (
+        sum(counts), elapsed, sum(counts) / elapsed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,384 @@
+#!/usr/bin/python
+"""
+A ring buffer of counter readings in a memory-mapped file, for sampling
+faster than SQLite can take one insert per reading.
+
+The file is a 64-byte header followed by capacity records of three
+little-endian 64-bit ints: timestamp in milliseconds, rxbytes, txbytes.
+Record n of all those ever written lives in slot n % capacity, so once
+the ring is full every reading overwrites the oldest one.
+
+There is one writer, and it takes no locks: it writes the record first
+and only then the count of records written, so a reader never sees a
+count that covers a record not written yet. While record n is being
+written the count still says n, but slot n % capacity, which held record
+n - capacity, is already half overwritten; so only the newest
+capacity - 1 records can be counted on. A reader that was slower than
+the writer checks the count again after reading and drops the records
+that were overwritten in the meantime.
+
+Readers get at the records without copying them: segments() gives
+buffer()s over the mmap, and array() a numpy record array on top of it.
+compact() drains the readings into the SQLite traffic table, and
+Compactor does that every so often from a thread.
+"""
+
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import broadband_logger
+
+MAGIC = 'TRAFRING'
+HEADER_SIZE = 64
+HEADER = struct.Struct('<8sqqq') # magic, capacity, written, drained
+WRITTEN_AT = 16
+DRAINED_AT = 24
+COUNT = struct.Struct('<q')
+RECORD = struct.Struct('<qqq')   # timestamp in ms, rxbytes, txbytes
+
+class RingStore:
+    """A ring buffer file of (timestamp ms, rxbytes, txbytes) records.
+    Opens path if it exists, or creates it to hold capacity records."""
+    def __init__(self, path, capacity=1 << 20):
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, capacity, 0, 0).ljust(HEADER_SIZE, '\0'))
+                f.truncate(HEADER_SIZE + capacity * RECORD.size)
+        self.file = open(path, 'r+b')
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        magic, self.capacity, written, drained = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise Exception('%s is not a ring store.' % path)
+        if len(self.mm) != HEADER_SIZE + self.capacity * RECORD.size:
+            raise Exception('%s is the wrong size.' % path)
+        self.path = path
+
+    def written(self):
+        'number of records ever appended'
+        return COUNT.unpack_from(self.mm, WRITTEN_AT)[0]
+
+    def drained(self):
+        'number of records compact() has moved to the database'
+        return COUNT.unpack_from(self.mm, DRAINED_AT)[0]
+
+    def oldest(self):
+        'number of the oldest record that can still be read'
+        return max(0, self.written() - self.capacity + 1)
+
+    def append(self, rxbytes, txbytes, timestamp=None):
+        '''add a reading. timestamp: epoch milliseconds, defaults to now.
+        Only one thread or process may append to a store.'''
+        if timestamp is None:
+            timestamp = int(time.time() * 1000)
+        n = self.written()
+        RECORD.pack_into(self.mm, HEADER_SIZE + n % self.capacity * RECORD.size,
+                         timestamp, rxbytes, txbytes)
+        COUNT.pack_into(self.mm, WRITTEN_AT, n + 1) # publish it
+
+    def segments(self, start=None, stop=None):
+        '''[(first record number, buffer)] holding records start to stop,
+        by default all of them. At most two segments, as the range may wrap
+        around the end of the file. The buffers point into the mmap, so
+        check valid() after using them.'''
+        start, stop = self.range(start, stop)
+        result = []
+        while start < stop:
+            slot = start % self.capacity
+            n = min(stop - start, self.capacity - slot)
+            offset = HEADER_SIZE + slot * RECORD.size
+            result.append((start, buffer(self.mm, offset, n * RECORD.size)))
+            start += n
+        return result
+
+    def range(self, start, stop):
+        written = self.written()
+        if stop is None or stop > written:
+            stop = written
+        if start is None or start < written - self.capacity + 1:
+            start = max(0, written - self.capacity + 1)
+        return start, max(start, stop)
+
+    def valid(self, start):
+        '''the first record number from start that has not been overwritten,
+        nor is being overwritten by an append going on now'''
+        return max(start, self.written() - self.capacity + 1)
+
+    def read_from(self, start=None, stop=None):
+        '''(number of the first record, list of the (timestamp, rxbytes,
+        txbytes) records from there to stop). The first is after start if
+        the records in between were overwritten, before or while being read.'''
+        start, stop = self.range(start, stop)
+        segments = self.segments(start, stop)
+        if not segments:
+            return stop, []
+        first = segments[0][0] # later than start if the writer got past it
+        unpack = RECORD.unpack_from
+        records = []
+        for (n, data) in segments:
+            records.extend(unpack(data, i)
+                           for i in xrange(0, len(data), RECORD.size))
+        valid = min(self.valid(first), stop)
+        return valid, records[valid - first:]
+
+    def read(self, start=None, stop=None):
+        '''list of the (timestamp, rxbytes, txbytes) records from start to
+        stop that were not overwritten while being read'''
+        return self.read_from(start, stop)[1]
+
+    def array(self, start=None, stop=None):
+        '''records start to stop as a numpy record array with fields
+        timestamp, rxbytes and txbytes. It is a view on the mmap unless the
+        range wraps around, when the two parts are copied into one.'''
+        dtype = numpy.dtype([('timestamp', '<i8'), ('rxbytes', '<i8'),
+                             ('txbytes', '<i8')])
+        parts = [numpy.frombuffer(data, dtype)
+                 for (first, data) in self.segments(start, stop)]
+        if not parts:
+            return numpy.zeros(0, dtype)
+        if len(parts) == 1:
+            return parts[0]
+        return numpy.concatenate(parts)
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def compact(store, conn, device=broadband_logger.ROUTER_ADDR,
+            iface=broadband_logger.WAN_IFACE):
+    '''move the records appended since the last compact() into the traffic
+    table, keeping the last reading of each second, as its timestamps are
+    in seconds. Records overwritten before they were drained are lost.
+    A second already in the table keeps the reading there, as with
+    TrafficWriter. Returns (records drained, readings dropped as already
+    in the table).'''
+    broadband_logger.create_schema(conn)
+    start, stop = store.range(store.drained(), None)
+    first, records = store.read_from(start, stop)
+    readings = {}
+    for (ms, rx, tx) in records:
+        readings[ms // 1000] = (rx, tx)
+    changes = conn.total_changes
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO traffic VALUES(?, ?, ?, ?, ?)",
+                         [(device, iface, ts, rx, tx)
+                          for (ts, (rx, tx)) in sorted(readings.items())])
+    # after the commit: should this crash in between, the same readings
+    # are written again next time, which changes nothing
+    COUNT.pack_into(store.mm, DRAINED_AT, first + len(records))
+    return len(records), len(readings) - (conn.total_changes - changes)
+
+class Compactor:
+    """Runs compact() on a store every interval seconds, and on close()"""
+    def __init__(self, store, dbfilepath, device=broadband_logger.ROUTER_ADDR,
+                 iface=broadband_logger.WAN_IFACE, interval=60.0):
+        self.store = store
+        self.dbfilepath = dbfilepath
+        self.device = device
+        self.iface = iface
+        self.interval = interval
+        self.drained = 0
+        self.duplicates = 0 # readings dropped as already in the table
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        conn = sqlite3.connect(self.dbfilepath)
+        try:
+            while True:
+                stopping = self.closed.wait(self.interval)
+                drained, duplicates = compact(self.store, conn, self.device,
+                                              self.iface)
+                self.drained += drained
+                if duplicates:
+                    self.duplicates += duplicates
+                    print "%d readings dropped, already in the database" % (
+                        duplicates)
+                if stopping:
+                    break
+        finally:
+            conn.close()
+
+    def close(self):
+        self.closed.set()
+        self.thread.join()
+
+def run_tests():
+    """testing is very important"""
+    import shutil
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'traffic.ring')
+        with RingStore(path, capacity=8) as store:
+            assert store.written() == 0 and store.read() == []
+            for i in range(5):
+                store.append(100 * i, 10 * i, timestamp=1000 * i)
+            assert store.read() == [(1000 * i, 100 * i, 10 * i) for i in range(5)]
+            assert store.read(1, 3) == [(1000, 100, 10), (2000, 200, 20)]
+            for i in range(5, 20):
+                store.append(100 * i, 10 * i, timestamp=1000 * i)
+            # 12 is in the slot the next append writes over
+            assert store.written() == 20 and store.oldest() == 13
+            assert store.read() == [(1000 * i, 100 * i, 10 * i)
+                                    for i in range(13, 20)]
+            # 13..15 sit at the end of the file, 16..19 at the start
+            assert [(first, len(data)) for (first, data) in store.segments()] == [
+                (13, 3 * RECORD.size), (16, 4 * RECORD.size)]
+            if numpy is not None:
+                a = store.array(13, 16)
+                assert list(a['rxbytes']) == [1300, 1400, 1500]
+                assert not a.flags.owndata # a view on the file
+                assert list(store.array()['timestamp']) == range(13000, 20000, 1000)
+        # reopened, it carries on
+        with RingStore(path) as store:
+            assert store.capacity == 8 and store.written() == 20
+            store.append(2000, 200, timestamp=20000)
+            store.append(2100, 210, timestamp=20500) # in the same second
+            conn = sqlite3.connect(':memory:')
+            assert compact(store, conn) == (7, 0) # 15..21, the rest was overwritten
+            assert store.drained() == 22
+            rows = conn.execute("""SELECT timestamp, rxbytes FROM traffic
+                                   ORDER BY timestamp""").fetchall()
+            assert rows == [(15 + i, 1500 + 100 * i) for i in range(5)] + [(20, 2100)]
+            assert compact(store, conn) == (0, 0)
+            # a second already in the table keeps its reading
+            conn.execute("INSERT INTO traffic VALUES(?, ?, 22, 1, 1)",
+                         (broadband_logger.ROUTER_ADDR,
+                          broadband_logger.WAN_IFACE))
+            store.append(2200, 220, timestamp=22000)
+            store.append(2300, 230, timestamp=23000)
+            assert compact(store, conn) == (2, 1)
+            assert conn.execute("""SELECT timestamp, rxbytes FROM traffic
+                                   WHERE timestamp > 21 ORDER BY timestamp"""
+                                ).fetchall() == [(22, 1), (23, 2300)]
+
+        # a reader racing the writer only ever sees whole records
+        with RingStore(os.path.join(tmpdir, 'race.ring'), capacity=64) as store:
+            done = threading.Event()
+            def write():
+                for i in xrange(20000):
+                    store.append(i, 2 * i, timestamp=3 * i)
+                done.set()
+            writer = threading.Thread(target=write)
+            writer.start()
+            reads = 0
+            while not done.is_set() or reads == 0:
+                for (ts, rx, tx) in store.read():
+                    assert tx == 2 * rx and ts == 3 * rx
+                reads += 1
+            writer.join()
+
+        # the writer gets past the end of the ring while a read is going on:
+        # only the records it overwrote are dropped
+        class Racing(RingStore):
+            def segments(self, start=None, stop=None):
+                self.append(1000, 100, timestamp=10000)
+                self.append(1100, 110, timestamp=11000)
+                return RingStore.segments(self, start, stop)
+        with Racing(os.path.join(tmpdir, 'lapped.ring'), capacity=8) as store:
+            for i in range(10):
+                RingStore.append(store, 100 * i, 10 * i, timestamp=1000 * i)
+            # 3 and 4 went, as 11 was written over 3 and 12 could be over 4
+            assert store.read_from(0, 10) == (5, [(1000 * i, 100 * i, 10 * i)
+                                                  for i in range(5, 10)])
+        with Racing(os.path.join(tmpdir, 'lapped2.ring'), capacity=8) as store:
+            for i in range(10):
+                RingStore.append(store, 100 * i, 10 * i, timestamp=1000 * i)
+            conn = sqlite3.connect(':memory:')
+            assert compact(store, conn) == (5, 0) # 5..9; 10 and 11 next time
+            assert store.drained() == 10
+            assert conn.execute("SELECT min(timestamp), count(*) FROM traffic"
+                                ).fetchone() == (5, 5)
+
+        # and with the writer in another process, where the GIL does not
+        # keep it from being in the middle of an append while the count is read
+        path = os.path.join(tmpdir, 'process.ring')
+        RingStore(path, capacity=16).close()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                with RingStore(path) as store:
+                    for i in xrange(1, 200001):
+                        store.append(i, 2 * i, timestamp=3 * i)
+            finally:
+                os._exit(0)
+        with RingStore(path) as store:
+            while store.written() < 200000:
+                for (ts, rx, tx) in store.read():
+                    assert tx == 2 * rx and ts == 3 * rx
+        os.waitpid(pid, 0)
+
+        with RingStore(os.path.join(tmpdir, 'compact.ring'), capacity=100) as store:
+            dbfilepath = os.path.join(tmpdir, 'router.db')
+            compactor = Compactor(store, dbfilepath, interval=0.05)
+            for i in range(30):
+                store.append(i, i, timestamp=1000 * i)
+            time.sleep(0.2)
+            store.append(30, 30, timestamp=30000)
+            compactor.close()
+            assert compactor.drained == 31 and compactor.duplicates == 0
+            conn = sqlite3.connect(dbfilepath)
+            assert conn.execute("SELECT count(*) FROM traffic").fetchone() == (31,)
+            conn.close()
+
+        try:
+            open(os.path.join(tmpdir, 'junk'), 'w').write('x' * 100)
+            RingStore(os.path.join(tmpdir, 'junk'))
+            assert False, 'a file that is not a ring should raise'
+        except Exception as e:
+            assert 'not a ring' in str(e)
+    finally:
+        shutil.rmtree(tmpdir)
+    print "All tests passed."
+
+def timer(n=100000):
+    'appends/sec to a ring against log_data() inserts/sec'
+    import shutil
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with RingStore(os.path.join(tmpdir, 'traffic.ring')) as store:
+            t0 = time.time()
+            for i in xrange(n):
+                store.append(i, i)
+            elapsed = time.time() - t0
+            print 'RingStore.append: %1.0f readings/sec' % (n / elapsed)
+            t0 = time.time()
+            store.read()
+            print 'RingStore.read: %1.0f readings/sec' % (n / (time.time() - t0))
+            conn = sqlite3.connect(os.path.join(tmpdir, 'router.db'))
+            t0 = time.time()
+            compact(store, conn)
+            print 'compact: %1.0f readings/sec' % (n / (time.time() - t0))
+            conn.close()
+        dbfilepath = os.path.join(tmpdir, 'log.db')
+        t0 = time.time()
+        for i in xrange(100):
+            broadband_logger.log_data((i, i), dbfilepath)
+        print 'log_data: %1.0f readings/sec' % (100 / (time.time() - t0))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    run_tests()
+    timer()
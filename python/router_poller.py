@@ -0,0 +1,534 @@
+#!/usr/bin/python
+"""
+Poll many routers over telnet, keeping one logged-in session open per
+router instead of logging in for every reading like
+RouterQuery.retrieve_data() does.
+
+Replies are read until the router's '>' prompt shows up, rather than
+sleeping and hoping a single recv() got all of it. Each sweep polls all
+the routers at once, one thread per router with its own timeout, so a
+sweep takes about as long as the slowest router. A router that fails is
+disconnected and retried after a growing back-off delay.
+
+IfconfigParser reads the output of a full 'ifconfig' as it comes off
+the socket and gives the counters of every interface, so one round-trip
+collects them all. A router still busy with the last poll is left out of
+the next one, so two threads never share its session.
+
+FakeRouter is a local telnet server that behaves like the D-Link router,
+for the tests.
+"""
+
+import collections
+import re
+import socket
+import SocketServer
+import threading
+import time
+
+PROMPT = '>'
+
+def split_telnet(data):
+    """Remove telnet IAC command sequences, e.g. the option negotiation
+    '\\xff\\xfd\\x01' the router sends first. Returns (text, rest) where
+    rest is a command cut off at the end of data, to go before the next
+    chunk."""
+    if '\xff' not in data:
+        return data, ''
+    out = []
+    i = 0
+    while True:
+        j = data.find('\xff', i)
+        if j < 0:
+            out.append(data[i:])
+            return ''.join(out), ''
+        out.append(data[i:j])
+        command = data[j+1:j+2]
+        if command in ('\xfb', '\xfc', '\xfd', '\xfe'):
+            size = 3 # WILL/WONT/DO/DONT option
+        else:
+            size = 2
+        if j + size > len(data):
+            return ''.join(out), data[j:]
+        if command == '\xff': # escaped 0xff data byte
+            out.append('\xff')
+        i = j + size
+
+def strip_telnet(data):
+    "Remove telnet IAC command sequences from data"
+    return split_telnet(data)[0]
+
+InterfaceStats = collections.namedtuple('InterfaceStats', [
+    'iface', 'rx_bytes', 'tx_bytes', 'rx_packets', 'rx_errors', 'rx_dropped',
+    'tx_packets', 'tx_errors', 'tx_dropped'])
+
+PACKETS_RE = re.compile(r'([RT]X) packets:(\d+) errors:(\d+) dropped:(\d+)')
+BYTES_RE = re.compile(r'RX bytes:(\d+).*TX bytes:(\d+)')
+
+class IfconfigParser:
+    """Incremental parser for the output of ifconfig, e.g.
+
+    ppp0.1  Link encap:Point-Point Protocol
+            ...
+            RX packets:29697256 errors:0 dropped:0 overruns:0 frame:0
+            TX packets:25851485 errors:0 dropped:0 overruns:0 carrier:0
+            collisions:0 txqueuelen:3
+            RX bytes:2815336009 (2.6 GiB)  TX bytes:931425720 (888.2 MiB)
+
+    feed() it the chunks as they are received, telnet commands and all,
+    and it returns an InterfaceStats for each interface it has finished
+    reading. close() returns the last one. self.seconds is the time spent
+    in both."""
+    def __init__(self):
+        self.telnet = '' # a telnet command cut off at the end of a chunk
+        self.line = ''   # the line read so far
+        self.fields = None
+        self.seconds = 0.0
+
+    def feed(self, chunk):
+        t0 = time.time()
+        text, self.telnet = split_telnet(self.telnet + chunk)
+        lines = (self.line + text).split('\n')
+        self.line = lines.pop()
+        records = []
+        for line in lines:
+            record = self.parse_line(line)
+            if record:
+                records.append(record)
+        self.seconds += time.time() - t0
+        return records
+
+    def close(self):
+        t0 = time.time()
+        records = [r for r in [self.parse_line(self.line), self.finish()] if r]
+        self.line = ''
+        self.seconds += time.time() - t0
+        return records
+
+    def finish(self):
+        'the record of the interface being read, if it is complete'
+        fields, self.fields = self.fields, None
+        if fields and len(fields) == len(InterfaceStats._fields):
+            return InterfaceStats(**fields)
+        return None
+
+    def parse_line(self, line):
+        line = line.rstrip()
+        if not line:
+            return self.finish() # a blank line ends an interface
+        if not line[0].isspace():
+            done = self.finish()
+            if 'Link encap' in line:
+                self.fields = {'iface': line.split(None, 1)[0]}
+            return done
+        if self.fields is None:
+            return None
+        if 'packets:' in line:
+            m = PACKETS_RE.search(line)
+            if m:
+                d = m.group(1).lower()
+                self.fields[d + '_packets'] = long(m.group(2))
+                self.fields[d + '_errors'] = long(m.group(3))
+                self.fields[d + '_dropped'] = long(m.group(4))
+        elif 'bytes:' in line:
+            m = BYTES_RE.search(line)
+            if m:
+                self.fields['rx_bytes'] = long(m.group(1))
+                self.fields['tx_bytes'] = long(m.group(2))
+        return None
+
+def parse_ifconfig(output):
+    'list of InterfaceStats in the whole output of ifconfig'
+    parser = IfconfigParser()
+    return parser.feed(output) + parser.close()
+
+class RouterSession:
+    """A logged-in telnet session with one router"""
+    def __init__(self, addr, port=23, username='admin', password='',
+                 timeout=5.0):
+        self.addr = addr
+        self.port = port
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.name = '%s:%d' % (addr, port)
+        self.sock = None
+        self.telnet = '' # a telnet command cut off at the end of a chunk
+
+    def connect(self):
+        'open the connection and log in'
+        self.telnet = ''
+        self.sock = socket.create_connection((self.addr, self.port),
+                                             self.timeout)
+        try:
+            self.read_until(lambda d: 'login:' in d.lower())
+            self.sock.sendall(self.username + '\n')
+            self.read_until(lambda d: 'password:' in d.lower())
+            self.sock.sendall(self.password + '\n')
+            reply = self.read_until(lambda d: 'Login incorrect' in d or
+                                    d.rstrip().endswith(PROMPT))
+            if 'Login incorrect' in reply:
+                raise Exception('Login incorrect.')
+        except:
+            self.close()
+            raise
+
+    def read_until(self, done, on_chunk=None):
+        '''read from the socket until done(data_so_far) is True and return
+        what was read, telnet commands removed. Gives up with socket.timeout
+        after self.timeout seconds.
+        on_chunk: called with each chunk as it is received, telnet commands
+        and all, e.g. IfconfigParser.feed'''
+        deadline = time.time() + self.timeout
+        data = ''
+        while not done(data):
+            left = deadline - time.time()
+            if left <= 0:
+                raise socket.timeout('No prompt from %s.' % self.addr)
+            self.sock.settimeout(left)
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise socket.error('Connection closed by %s.' % self.addr)
+            if on_chunk is not None:
+                on_chunk(chunk)
+            text, self.telnet = split_telnet(self.telnet + chunk)
+            data += text
+        return data
+
+    def run(self, command, on_chunk=None):
+        '''run a command on the router and return its output.
+        on_chunk: see read_until()'''
+        if self.sock is None:
+            self.connect()
+        self.sock.sendall(command + '\n')
+        return self.read_until(lambda d: d.rstrip().endswith(PROMPT),
+                               on_chunk)
+
+    def read_interfaces(self, parser=None):
+        '''run ifconfig, parsing its output as it comes in, and return the
+        list of InterfaceStats. parser: the IfconfigParser to use'''
+        if parser is None:
+            parser = IfconfigParser()
+        records = []
+        self.run('ifconfig', lambda chunk: records.extend(parser.feed(chunk)))
+        return records + parser.close()
+
+    def close(self):
+        if self.sock is None:
+            return
+        try:
+            self.sock.sendall('quit\n')
+        except socket.error:
+            pass
+        self.sock.close()
+        self.sock = None
+
+class RouterPoller:
+    """Keeps a RouterSession per router and polls them all at once"""
+    def __init__(self, sessions, backoff=1.0, max_backoff=300.0):
+        self.sessions = sessions
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failures = dict((s.name, 0) for s in sessions)
+        self.retry_at = dict((s.name, 0.0) for s in sessions)
+        self.threads = {} # router --> thread of its last poll
+
+    def poll_one(self, session, work, results):
+        addr = session.name
+        if time.time() < self.retry_at[addr]:
+            results[addr] = Exception('Waiting to reconnect.')
+            return
+        try:
+            results[addr] = work(session)
+            self.failures[addr] = 0
+        except Exception as e:
+            results[addr] = e
+            session.close() # the next poll reconnects
+            self.failures[addr] += 1
+            delay = self.backoff * 2 ** (self.failures[addr] - 1)
+            self.retry_at[addr] = time.time() + min(delay, self.max_backoff)
+
+    def poll_interfaces(self):
+        '''run ifconfig on every router. Returns a dict of router
+        'addr:port' --> list of InterfaceStats, or the exception if it failed'''
+        return self.poll_all(lambda session: session.read_interfaces())
+
+    def poll(self, command='ifconfig ppp0.1'):
+        '''run command on every router at the same time. Returns a dict of
+        router 'addr:port' --> output, or the exception if it failed'''
+        return self.poll_all(lambda session: session.run(command))
+
+    def poll_all(self, work):
+        '''call work(session) for every router at the same time, each in a
+        thread. A router whose thread from an earlier poll is still going
+        is skipped, and a thread that takes too long is left to finish on
+        its own; either way that router gets an exception this time.'''
+        results = {}
+        started = []
+        polled = {}
+        for s in self.sessions:
+            t = self.threads.get(s.name)
+            if t is not None and t.is_alive():
+                polled[s.name] = Exception('Still busy with the last poll.')
+                continue
+            t = threading.Thread(target=self.poll_one, args=(s, work, results))
+            t.daemon = True
+            t.start()
+            self.threads[s.name] = t
+            started.append((t, s))
+        for (t, s) in started:
+            # each read is bounded by the session timeout; allow for login
+            # too. A reconnect can take longer, but then its thread is busy
+            # and the next poll skips the router.
+            t.join(4 * s.timeout)
+            # a copy: a thread that finishes late writes to results only
+            polled[s.name] = results.get(s.name,
+                                         socket.timeout('Poll timed out.'))
+        return polled
+
+    def close(self):
+        for s in self.sessions:
+            s.close()
+
+# ------------------
+# A fake router, for testing
+
+IFCONFIG = ('ppp0.1          Link encap:Point-Point Protocol  \r\n'
+            '                inet addr:105.228.74.129  P-t-P:105.224.96.1  Mask:255.255.255.255\r\n'
+            '                UP POINTOPOINT RUNNING NOARP MULTICAST  MTU:1492  Metric:1\r\n'
+            '                RX packets:29697256 errors:0 dropped:0 overruns:0 frame:0\r\n'
+            '                TX packets:25851485 errors:0 dropped:0 overruns:0 carrier:0\r\n'
+            '                collisions:0 txqueuelen:3 \r\n'
+            '                RX bytes:%d (2.6 GiB)  TX bytes:%d (888.2 MiB)\r\n\r\n')
+
+# a full ifconfig as captured from the router, bar the addresses
+CAPTURED_IFCONFIG = ('\xff\xfd\x01\xff\xfd!\xff\xfb\x01\xff\xfb\x03ifconfig\r\n'
+    'br0             Link encap:Ethernet  HWaddr 00:11:22:33:44:55  \r\n'
+    '                inet addr:10.0.0.2  Bcast:10.0.0.255  Mask:255.255.255.0\r\n'
+    '                UP BROADCAST RUNNING MULTICAST  MTU:1500  Metric:1\r\n'
+    '                RX packets:8843563 errors:0 dropped:0 overruns:0 frame:0\r\n'
+    '                TX packets:12283101 errors:0 dropped:0 overruns:0 carrier:0\r\n'
+    '                collisions:0 txqueuelen:0 \r\n'
+    '                RX bytes:1223473941 (1.1 GiB)  TX bytes:3270452001 (3.0 GiB)\r\n'
+    '\r\n'
+    'eth0            Link encap:Ethernet  HWaddr 00:11:22:33:44:55  \r\n'
+    '                UP BROADCAST RUNNING MULTICAST  MTU:1500  Metric:1\r\n'
+    '                RX packets:2516 errors:3 dropped:7 overruns:0 frame:0\r\n'
+    '                TX packets:1833 errors:0 dropped:1 overruns:0 carrier:0\r\n'
+    '                collisions:0 txqueuelen:1000 \r\n'
+    '                RX bytes:333110 (325.3 KiB)  TX bytes:1215547 (1.1 MiB)\r\n'
+    '                Interrupt:13 \r\n'
+    '\r\n'
+    'lo              Link encap:Local Loopback  \r\n'
+    '                inet addr:127.0.0.1  Mask:255.0.0.0\r\n'
+    '                UP LOOPBACK RUNNING  MTU:16436  Metric:1\r\n'
+    '                RX packets:1203 errors:0 dropped:0 overruns:0 frame:0\r\n'
+    '                TX packets:1203 errors:0 dropped:0 overruns:0 carrier:0\r\n'
+    '                collisions:0 txqueuelen:0 \r\n'
+    '                RX bytes:118402 (115.6 KiB)  TX bytes:118402 (115.6 KiB)\r\n'
+    '\r\n' +
+    IFCONFIG % (2815336009, 931425720) + ' > ')
+
+def parse_benchmark(repeat=2000, chunk_size=4096):
+    """Time IfconfigParser on the captured output, fed in socket-sized
+    chunks, against RouterQuery's re.findall() on the same text."""
+    data = CAPTURED_IFCONFIG * repeat
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    t0 = time.time()
+    parser = IfconfigParser()
+    records = 0
+    for chunk in chunks:
+        records += len(parser.feed(chunk))
+    records += len(parser.close())
+    t_parser = time.time() - t0
+    t0 = time.time()
+    re.findall(r'bytes:(\d+)', strip_telnet(data))
+    t_findall = time.time() - t0
+    mb = len(data) / 1e6
+    print 'IfconfigParser: %d records, %1.1f MB/s, %1.0f records/s' % (
+        records, mb / t_parser, records / t_parser)
+    print 're.findall bytes only: %1.1f MB/s' % (mb / t_findall)
+
+class FakeSocket:
+    'hands out data size bytes at a time, like a socket'
+    def __init__(self, data, size):
+        self.data = data
+        self.size = size
+
+    def settimeout(self, timeout):
+        pass
+
+    def recv(self, n):
+        chunk, self.data = self.data[:self.size], self.data[self.size:]
+        return chunk
+
+class FakeRouterHandler(SocketServer.BaseRequestHandler):
+    def send(self, data):
+        # dribble the reply out in small pieces, like a slow router might
+        step = self.server.chunk_size
+        for i in range(0, len(data), step):
+            self.request.sendall(data[i:i + step])
+
+    def readline(self):
+        line = ''
+        while not line.endswith('\n'):
+            c = self.request.recv(1)
+            if not c:
+                return None
+            line += c
+        return line.strip()
+
+    def handle(self):
+        server = self.server
+        server.logins += 1
+        self.send('\xff\xfd\x01\xff\xfd!\xff\xfb\x01\xff\xfb\x03'
+                  'BCM96328 Broadband Router\r\nLogin: ')
+        username = self.readline()
+        self.send('Password: ')
+        password = self.readline()
+        if (username, password) != ('admin', server.password):
+            self.send('Login incorrect\r\n')
+            return
+        self.send('\r\n > ')
+        while True:
+            command = self.readline()
+            if command is None or command == 'quit':
+                return
+            time.sleep(server.delay)
+            server.rxbytes += 1000
+            server.txbytes += 100
+            output = command + '\r\n'
+            if command == 'ifconfig':
+                output = CAPTURED_IFCONFIG[:-len(' > ')].split('\n', 1)[1]
+            elif command.startswith('ifconfig'):
+                output += IFCONFIG % (server.rxbytes, server.txbytes)
+            self.send(output + ' > ')
+
+class FakeRouter(SocketServer.ThreadingTCPServer):
+    '''Telnet server on localhost that answers like the D-Link router.
+    delay: seconds to wait before answering a command'''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, password='secret', delay=0.0, chunk_size=64):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 FakeRouterHandler)
+        self.password = password
+        self.delay = delay
+        self.chunk_size = chunk_size
+        self.logins = 0
+        self.rxbytes = 2815336009
+        self.txbytes = 931425720
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def run_tests():
+    '''testing is very important'''
+    assert strip_telnet('\xff\xfd\x01\xff\xfd!\xff\xfb\x01Login: ') == 'Login: '
+    assert strip_telnet('a\xff\xffb') == 'a\xffb'
+    assert split_telnet('ab\xff\xfd') == ('ab', '\xff\xfd')
+
+    records = parse_ifconfig(CAPTURED_IFCONFIG)
+    assert [r.iface for r in records] == ['br0', 'eth0', 'lo', 'ppp0.1']
+    assert records[1] == InterfaceStats('eth0', 333110, 1215547,
+                                        2516, 3, 7, 1833, 0, 1)
+    assert records[3].rx_bytes == 2815336009 and records[3].tx_bytes == 931425720
+    # any way the output is cut into chunks gives the same records
+    for size in [1, 2, 3, 7, 64, 4096]:
+        parser = IfconfigParser()
+        got = []
+        for i in range(0, len(CAPTURED_IFCONFIG), size):
+            got += parser.feed(CAPTURED_IFCONFIG[i:i + size])
+        assert got + parser.close() == records
+    assert parse_ifconfig('') == []
+    parser = IfconfigParser()
+    assert parser.feed(CAPTURED_IFCONFIG) + parser.close() == records
+    assert parser.seconds > 0
+    # an interface with no byte counts is left out
+    assert parse_ifconfig('eth1 Link encap:Ethernet\n UP\n\n') == []
+
+    routers = [FakeRouter(delay=0.2) for _ in range(5)]
+    try:
+        sessions = [RouterSession('127.0.0.1', r.port, password='secret',
+                                  timeout=2) for r in routers]
+        poller = RouterPoller(sessions)
+        for _ in range(3):
+            t0 = time.time()
+            results = poller.poll()
+            # all at once: about one delay, not five
+            assert time.time() - t0 < 0.6, time.time() - t0
+            assert sorted(results) == sorted(s.name for s in sessions)
+            for output in results.values():
+                assert 'RX bytes:' in output and output.rstrip().endswith('>')
+        assert [r.logins for r in routers] == [1] * 5 # stayed logged in
+        results = poller.poll_interfaces()
+        assert all(r == records for r in results.values())
+        poller.close()
+
+        # parsed as it comes in
+        session = RouterSession('127.0.0.1', routers[0].port,
+                                password='secret')
+        chunks = []
+        output = session.run('ifconfig ppp0.1', chunks.append)
+        assert 'RX bytes:' in output and ''.join(chunks) == output
+        parser = IfconfigParser()
+        assert session.read_interfaces(parser) == records and parser.seconds > 0
+        session.close()
+    finally:
+        for r in routers:
+            r.stop()
+    # a telnet command cut in two by a chunk edge doesn't leak into the text
+    for size in [1, 2, 4]:
+        session = RouterSession('127.0.0.1', 0)
+        session.sock = FakeSocket(CAPTURED_IFCONFIG, size)
+        text = session.read_until(lambda d: d.rstrip().endswith(PROMPT))
+        assert text == strip_telnet(CAPTURED_IFCONFIG).rstrip() # up to the >
+        assert text.startswith('ifconfig\r\n')
+
+    # a poll that outlasts its wait: the router sits out the next poll
+    # instead of getting a second thread on the same session
+    class SlowSession(RouterSession):
+        runs = 0
+        def run(self, command, on_chunk=None):
+            SlowSession.runs += 1
+            time.sleep(0.3)
+            return 'done >'
+    slow = SlowSession('127.0.0.1', 0, timeout=0.05)
+    poller = RouterPoller([slow])
+    results = poller.poll()
+    assert isinstance(results[slow.name], socket.timeout)
+    assert 'busy' in str(poller.poll()[slow.name])
+    assert SlowSession.runs == 1
+    time.sleep(0.35)
+    assert isinstance(results[slow.name], socket.timeout) # not written late
+    slow.timeout = 1.0
+    assert poller.poll()[slow.name] == 'done >' and SlowSession.runs == 2
+
+    # wrong password, then a router going away: back off, then reconnect
+    router = FakeRouter()
+    session = RouterSession('127.0.0.1', router.port, password='wrong',
+                            timeout=1)
+    poller = RouterPoller([session], backoff=0.2)
+    assert 'Login incorrect' in str(poller.poll()[session.name])
+    assert 'reconnect' in str(poller.poll()[session.name])
+    time.sleep(0.25)
+    session.password = 'secret'
+    assert 'RX bytes:' in poller.poll()[session.name]
+    session.close()
+    router.stop()
+    assert isinstance(poller.poll()[session.name], socket.error)
+    assert poller.failures[session.name] == 1
+    print "All tests passed."
+
+if __name__ == '__main__':
+    run_tests()
+    parse_benchmark()
@@ -0,0 +1,329 @@
+#!/usr/bin/python
+"""
+Read back the traffic that broadband_logger writes.
+
+    usage(conn, '2013-09-01', '2013-10-01')   # (rxbytes, txbytes) in September
+    busiest_hours(conn, 10)                   # [(hour, rxbytes, txbytes), ...]
+    export_csv(conn, f, start, end)           # the readings, as CSV
+    export_columns(conn, directory, start, end)
+
+Times are UTC, given as epoch seconds or as 'YYYY-MM-DD[ HH:MM:SS]', and
+ranges include their start but not their end. Readings are read through
+the covering index on traffic and streamed out a batch at a time, so an
+export never holds the whole table in memory. usage() adds up the whole
+hours from the hourly rollup and only reads the readings of the part
+hours at either end, which keeps it to milliseconds over a year.
+
+The queries only read, so they work on a read-only connection, and take
+the rollups as traffic_rollup last left them. Pass refresh=True to roll
+up the new readings first.
+"""
+
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import struct
+import time
+
+import broadband_logger
+import traffic_rollup
+
+DEVICE = broadband_logger.ROUTER_ADDR
+IFACE = broadband_logger.WAN_IFACE
+COLUMNS = ['timestamp', 'rxbytes', 'txbytes']
+
+def to_epoch(when):
+    "epoch seconds, or UTC 'YYYY-MM-DD[ HH:MM:SS]' --> epoch seconds"
+    if isinstance(when, (int, long)):
+        return when
+    if len(when) == len('YYYY-MM-DD'):
+        when += ' 00:00:00'
+    return traffic_rollup.to_epoch(when)
+
+def samples(conn, start, end, device=DEVICE, iface=IFACE, batch_size=1000):
+    'generator of the (timestamp, rxbytes, txbytes) readings from start to end'
+    c = conn.execute("""SELECT timestamp, rxbytes, txbytes FROM traffic
+                        WHERE device = ? AND iface = ?
+                        AND timestamp >= ? AND timestamp < ?
+                        ORDER BY timestamp""",
+                     (device, iface, to_epoch(start), to_epoch(end)))
+    while True:
+        rows = c.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+def raw_usage(conn, start, end, device=DEVICE, iface=IFACE,
+              wrap=traffic_rollup.WRAP):
+    '''(rxbytes, txbytes) from the readings alone: how much the counters
+    went up at each reading from start to end, since the one before it'''
+    start, end = to_epoch(start), to_epoch(end)
+    previous = conn.execute("""SELECT rxbytes, txbytes FROM traffic
+                               WHERE device = ? AND iface = ? AND timestamp < ?
+                               ORDER BY timestamp DESC LIMIT 1""",
+                            (device, iface, start)).fetchone()
+    rx = tx = 0
+    delta = traffic_rollup.counter_delta
+    for (ts, r, t) in samples(conn, start, end, device, iface):
+        if previous is not None:
+            rx += delta(previous[0], r, wrap)
+            tx += delta(previous[1], t, wrap)
+        previous = (r, t)
+    return (rx, tx)
+
+def rolled_up(conn):
+    'whether traffic_rollup has made its tables yet'
+    return conn.execute("""SELECT 1 FROM sqlite_master WHERE type = 'table'
+                           AND name = 'traffic_hourly'""").fetchone() is not None
+
+def usage(conn, start, end, device=DEVICE, iface=IFACE, refresh=False):
+    '''(rxbytes, txbytes) transferred from start to end, as of the last
+    rollup; refresh=True rolls up the new readings first, which writes.
+    Without any rollup it reads all the readings from start to end.'''
+    if refresh:
+        traffic_rollup.rollup(conn)
+    start, end = to_epoch(start), to_epoch(end)
+    first = -(-start // 3600) * 3600 # the whole hours in between
+    last = end // 3600 * 3600
+    if first >= last or not rolled_up(conn):
+        return raw_usage(conn, start, end, device, iface)
+    row = conn.execute("""SELECT total(rxbytes), total(txbytes)
+                          FROM traffic_hourly
+                          WHERE device = ? AND iface = ?
+                          AND period >= ? AND period < ?""",
+                       (device, iface, traffic_rollup.hour_of(first),
+                        traffic_rollup.hour_of(last))).fetchone()
+    rx, tx = int(row[0]), int(row[1])
+    for (a, b) in [(start, first), (last, end)]:
+        if a < b:
+            r, t = raw_usage(conn, a, b, device, iface)
+            rx += r
+            tx += t
+    return (rx, tx)
+
+def busiest_hours(conn, n=10, start=None, end=None, device=DEVICE, iface=IFACE,
+                  refresh=False):
+    '''the n hours with the most traffic from start to end, busiest first,
+    as (UTC 'YYYY-MM-DD HH', rxbytes, txbytes), as of the last rollup;
+    refresh=True rolls up the new readings first, which writes'''
+    if refresh:
+        traffic_rollup.rollup(conn)
+    if not rolled_up(conn):
+        return []
+    low = traffic_rollup.hour_of(to_epoch(start)) if start is not None else ''
+    high = traffic_rollup.hour_of(to_epoch(end)) if end is not None else '~'
+    return conn.execute("""SELECT period, rxbytes, txbytes FROM traffic_hourly
+                           WHERE device = ? AND iface = ?
+                           AND period >= ? AND period < ?
+                           ORDER BY rxbytes + txbytes DESC, period LIMIT ?""",
+                        (device, iface, low, high, n)).fetchall()
+
+def export_csv(conn, f, start, end, device=DEVICE, iface=IFACE):
+    'write the readings from start to end to file f. Returns the row count.'
+    writer = csv.writer(f)
+    writer.writerow(COLUMNS)
+    n = 0
+    for row in samples(conn, start, end, device, iface):
+        writer.writerow(row)
+        n += 1
+    return n
+
+def export_columns(conn, directory, start, end, device=DEVICE, iface=IFACE,
+                   batch_size=10000):
+    '''write the readings from start to end column by column: one file per
+    column of little-endian 64-bit ints, e.g. directory/rxbytes.i64, and
+    directory/columns.json describing them. numpy reads a column with
+    numpy.fromfile(path, '<i8'). Returns the row count.'''
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    files = [open(os.path.join(directory, name + '.i64'), 'wb')
+             for name in COLUMNS]
+    n = 0
+    try:
+        rows = samples(conn, start, end, device, iface)
+        while True:
+            batch = [row for (_, row) in zip(xrange(batch_size), rows)]
+            if not batch:
+                break
+            fmt = '<%dq' % len(batch)
+            for (f, column) in zip(files, zip(*batch)):
+                f.write(struct.pack(fmt, *column))
+            n += len(batch)
+    finally:
+        for f in files:
+            f.close()
+    with open(os.path.join(directory, 'columns.json'), 'w') as f:
+        json.dump({'rows': n, 'type': '<i8', 'columns': COLUMNS,
+                   'device': device, 'iface': iface,
+                   'start': to_epoch(start), 'end': to_epoch(end)},
+                  f, indent=1, sort_keys=True)
+    return n
+
+def read_column(directory, name):
+    'a column written by export_columns(), as a tuple of ints'
+    with open(os.path.join(directory, name + '.i64'), 'rb') as f:
+        data = f.read()
+    return struct.unpack('<%dq' % (len(data) // 8), data)
+
+def year_of_minutes(conn, year=2013, device=DEVICE, iface=IFACE):
+    'fill traffic with a reading every minute of a year, for testing'
+    broadband_logger.create_schema(conn)
+    start = to_epoch('%d-01-01' % year)
+    end = to_epoch('%d-01-01' % (year + 1))
+    def readings():
+        rx = tx = 0
+        for ts in xrange(start, end, 60):
+            yield (device, iface, ts, rx % traffic_rollup.WRAP,
+                   tx % traffic_rollup.WRAP)
+            rx += 5000 + ts % 7000
+            tx += 1000
+    with conn:
+        conn.executemany("INSERT INTO traffic VALUES(?, ?, ?, ?, ?)",
+                         readings())
+
+def run_tests():
+    """testing is very important"""
+    assert to_epoch('2013-09-01') == 1377993600
+    assert to_epoch('2013-09-01 00:00:10') == 1377993610 == to_epoch(1377993610)
+
+    conn = sqlite3.connect(':memory:')
+    broadband_logger.create_schema(conn)
+    def add(ts, rx, tx, iface=IFACE):
+        conn.execute("INSERT INTO traffic VALUES(?, ?, ?, ?, ?)",
+                     (DEVICE, iface, to_epoch(ts), rx, tx))
+    add('2013-09-30 22:50:00', 1000, 100)
+    add('2013-09-30 23:10:00', 3000, 200)
+    add('2013-09-30 23:30:00', 4000, 300)
+    add('2013-10-01 00:20:00', 10000, 400)
+    add('2013-10-01 01:40:00', 500, 500)       # router rebooted
+    add('2013-10-01 02:00:00', 900, 700)
+    add('2013-10-01 00:00:00', 7, 7, iface='eth0')
+
+    assert list(samples(conn, '2013-09-30 23:10:00', '2013-10-01 00:20:00')) == [
+        (to_epoch('2013-09-30 23:10:00'), 3000, 200),
+        (to_epoch('2013-09-30 23:30:00'), 4000, 300)]
+    assert list(samples(conn, '2013-10-02', '2013-10-03')) == []
+    # the queries only read: before any rollup, usage() reads the readings
+    conn.execute("PRAGMA query_only = ON")
+    assert usage(conn, '2013-09-30', '2013-10-02') == raw_usage(
+        conn, '2013-09-30', '2013-10-02')
+    assert busiest_hours(conn, 2) == []
+    conn.execute("PRAGMA query_only = OFF")
+    assert busiest_hours(conn, 1, refresh=True) == [('2013-10-01 00', 6000, 100)]
+    conn.execute("PRAGMA query_only = ON")
+    # from the rollups and the readings, the same as from readings alone
+    for (start, end) in [('2013-09-30', '2013-10-02'),
+                         ('2013-09-30 23:00:00', '2013-10-01 02:00:00'),
+                         ('2013-09-30 23:20:00', '2013-10-01 01:50:00'),
+                         ('2013-09-30 23:20:00', '2013-09-30 23:40:00'),
+                         ('2013-10-01 00:10:00', '2013-10-01 01:00:00')]:
+        assert usage(conn, start, end) == raw_usage(conn, start, end), (start, end)
+    assert usage(conn, '2013-09-30', '2013-10-02') == (
+        2000 + 1000 + 6000 + 500 + 400, 100 + 100 + 100 + 100 + 200)
+    assert usage(conn, '2013-09-30 23:20:00', '2013-09-30 23:40:00') == (1000, 100)
+    assert usage(conn, '2013-10-01', '2013-10-02', iface='eth0') == (0, 0)
+
+    assert busiest_hours(conn, 2) == [('2013-10-01 00', 6000, 100),
+                                      ('2013-09-30 23', 3000, 200)]
+    assert busiest_hours(conn, 5, '2013-10-01 01:00:00') == [
+        ('2013-10-01 01', 500, 100), ('2013-10-01 02', 400, 200)]
+    # a reading since the rollup only counts once rolled up
+    conn.execute("PRAGMA query_only = OFF")
+    add('2013-10-02 02:30:00', 1900, 700)
+    assert usage(conn, '2013-10-02 02:00:00', '2013-10-02 03:00:00') == (0, 0)
+    assert usage(conn, '2013-10-02 02:00:00', '2013-10-02 03:00:00',
+                 refresh=True) == (1000, 0)
+
+    # the time-range reads come from the covering index alone
+    plan = ' '.join(str(r) for r in conn.execute(
+        """EXPLAIN QUERY PLAN SELECT timestamp, rxbytes, txbytes FROM traffic
+           WHERE device = ? AND iface = ? AND timestamp >= ? AND timestamp < ?
+           ORDER BY timestamp""", (DEVICE, IFACE, 0, 1)))
+    assert 'COVERING INDEX' in plan and 'TEMP B-TREE' not in plan, plan
+
+    import shutil
+    import StringIO
+    import tempfile
+    f = StringIO.StringIO()
+    assert export_csv(conn, f, '2013-09-30', '2013-10-01') == 3
+    lines = f.getvalue().splitlines()
+    assert lines[0] == 'timestamp,rxbytes,txbytes'
+    assert lines[1] == '%d,1000,100' % to_epoch('2013-09-30 22:50:00')
+    tmpdir = tempfile.mkdtemp()
+    try:
+        assert export_columns(conn, tmpdir, '2013-09-30', '2013-10-02',
+                              batch_size=4) == 6
+        assert read_column(tmpdir, 'rxbytes') == (1000, 3000, 4000, 10000, 500, 900)
+        with open(os.path.join(tmpdir, 'columns.json')) as meta:
+            assert json.load(meta)['rows'] == 6
+    finally:
+        shutil.rmtree(tmpdir)
+    print "All tests passed."
+
+def timer():
+    'time the queries over a year of readings a minute apart'
+    conn = sqlite3.connect(':memory:')
+    t0 = time.time()
+    year_of_minutes(conn)
+    traffic_rollup.rollup(conn)
+    print 'a year of minutes written and rolled up in %1.1f sec' % (
+        time.time() - t0)
+    for (name, query) in [
+            ('usage, a year', lambda: usage(conn, '2013-01-01 00:00:30',
+                                            '2013-12-31 23:59:30')),
+            ('usage, a day', lambda: usage(conn, '2013-06-01 00:00:30',
+                                           '2013-06-01 23:59:30')),
+            ('raw_usage, a day', lambda: raw_usage(conn, '2013-06-01',
+                                                   '2013-06-02')),
+            ('busiest_hours', lambda: busiest_hours(conn, 10))]:
+        t0 = time.time()
+        for _ in range(10):
+            query()
+        print '%-18s %8.2f ms' % (name, (time.time() - t0) * 100)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--db', default='router.db')
+    parser.add_argument('--device', default=DEVICE)
+    parser.add_argument('--iface', default=IFACE)
+    parser.add_argument('--refresh', action='store_true',
+                        help='roll up the new readings first')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('usage', help='bytes transferred from START to END')
+    p.add_argument('start')
+    p.add_argument('end')
+    p = sub.add_parser('top', help='the N busiest hours')
+    p.add_argument('n', type=int, nargs='?', default=10)
+    p = sub.add_parser('csv', help='write the readings to FILE as CSV')
+    p.add_argument('start')
+    p.add_argument('end')
+    p.add_argument('file')
+    p = sub.add_parser('columns', help='write the readings to DIRECTORY '
+                                       'a file per column')
+    p.add_argument('start')
+    p.add_argument('end')
+    p.add_argument('directory')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    where = (args.device, args.iface)
+    if args.command == 'usage':
+        print 'rx %d bytes, tx %d bytes' % usage(conn, args.start, args.end,
+                                                 *where, refresh=args.refresh)
+    elif args.command == 'top':
+        for (hour, rx, tx) in busiest_hours(conn, args.n, None, None, *where,
+                                            refresh=args.refresh):
+            print '%s:00  rx %12d  tx %12d' % (hour, rx, tx)
+    elif args.command == 'csv':
+        with open(args.file, 'wb') as f:
+            print '%d rows' % export_csv(conn, f, args.start, args.end, *where)
+    elif args.command == 'columns':
+        print '%d rows' % export_columns(conn, args.directory, args.start,
+                                         args.end, *where)
+    conn.close()
+
+if __name__ == '__main__':
+    main()
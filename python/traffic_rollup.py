@@ -0,0 +1,234 @@
+#!/usr/bin/python
+"""
+Turn the cumulative rxbytes/txbytes counters in the traffic table into
+bytes transferred per hour, day and month.
+
+Each run only looks at the traffic rows added since the last run (a
+high-water mark on the rowid), works out how much each counter went up
+since the previous reading of the same device and interface, and adds
+that to the hourly, daily and monthly tables. The counters are 32 bits
+on the router, so a counter that goes down either wrapped around or was
+reset by a reboot; counter_delta() tells the two apart.
+
+The usage of a month is then one lookup on the primary key of
+traffic_monthly instead of a scan over all of traffic.
+"""
+
+import calendar
+import sqlite3
+import time
+
+import broadband_logger
+
+WRAP = 2 ** 32
+
+# table --> length of the prefix of the UTC 'YYYY-MM-DD HH' hour of a
+# reading that names its period
+PERIODS = [('traffic_hourly', len('YYYY-MM-DD HH')),
+           ('traffic_daily', len('YYYY-MM-DD')),
+           ('traffic_monthly', len('YYYY-MM'))]
+
+ROLLUP_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS rollup_state(
+    name TEXT PRIMARY KEY,
+    value INTEGER);
+
+    CREATE TABLE IF NOT EXISTS rollup_last(
+    device TEXT NOT NULL,
+    iface TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    rxbytes INTEGER,
+    txbytes INTEGER,
+    PRIMARY KEY (device, iface));
+    """ + "".join("""
+    CREATE TABLE IF NOT EXISTS %s(
+    device TEXT NOT NULL,
+    iface TEXT NOT NULL,
+    period TEXT NOT NULL,
+    rxbytes INTEGER,
+    txbytes INTEGER,
+    samples INTEGER,
+    PRIMARY KEY (device, iface, period));
+    """ % table for (table, length) in PERIODS)
+
+def create_schema(conn):
+    """Create the rollup tables. The last readings of a rollup_last table
+    from when timestamps were text are moved over to epoch seconds."""
+    broadband_logger.create_schema(conn)
+    types = dict((row[1], row[2].upper())
+                 for row in conn.execute("PRAGMA table_info(rollup_last)"))
+    if types.get('timestamp', 'INTEGER') != 'INTEGER':
+        conn.executescript("""
+            BEGIN;
+            ALTER TABLE rollup_last RENAME TO rollup_last_old;
+            %s
+            INSERT INTO rollup_last
+            SELECT device, iface, CAST(strftime('%%s', timestamp) AS INTEGER),
+                   rxbytes, txbytes
+            FROM rollup_last_old;
+            DROP TABLE rollup_last_old;
+            COMMIT;
+            """ % ROLLUP_SCHEMA)
+    else:
+        conn.executescript(ROLLUP_SCHEMA)
+
+def hour_of(timestamp):
+    "epoch seconds --> UTC 'YYYY-MM-DD HH'"
+    return time.strftime('%Y-%m-%d %H', time.gmtime(timestamp))
+
+def to_epoch(text):
+    "UTC 'YYYY-MM-DD HH:MM:SS' --> epoch seconds"
+    return calendar.timegm(time.strptime(text, '%Y-%m-%d %H:%M:%S'))
+
+def counter_delta(previous, current, wrap=WRAP):
+    """How much a counter went up from previous to current. If it went
+    down, it either wrapped around past wrap, which leaves it small after
+    being close to the top, or the router rebooted and it started over
+    from 0, in which case everything since the reboot is current."""
+    if current >= previous:
+        return current - previous
+    if previous > wrap * 3 // 4 and current < wrap // 4 and previous < wrap:
+        return current + wrap - previous
+    return current
+
+def rollup(conn, wrap=WRAP):
+    """Add the traffic rows that arrived since the last rollup to the
+    hourly, daily and monthly tables. Returns the number of rows done."""
+    create_schema(conn)
+    row = conn.execute(
+        "SELECT value FROM rollup_state WHERE name = 'traffic_rowid'").fetchone()
+    high_water = row[0] if row else 0
+    last = dict(((device, iface), (ts, rx, tx)) for (device, iface, ts, rx, tx)
+                in conn.execute("SELECT * FROM rollup_last"))
+
+    totals = {} # (table, device, iface, period) --> [rx, tx, samples]
+    hours = {}  # epoch hour --> its name
+    done = 0
+    for (rowid, device, iface, ts, rx, tx) in conn.execute(
+            # NOT INDEXED: a range on the rowid, not a walk through the
+            # whole of traffic_samples for its order
+            """SELECT rowid, device, iface, timestamp, rxbytes, txbytes
+               FROM traffic NOT INDEXED WHERE rowid > ?
+               ORDER BY device, iface, timestamp""", (high_water,)):
+        high_water = max(high_water, rowid)
+        done += 1
+        previous = last.get((device, iface))
+        if previous is not None and ts <= previous[0]:
+            continue # older than what was already counted
+        last[(device, iface)] = (ts, rx, tx)
+        if previous is None:
+            continue # the first reading only sets the starting point
+        d_rx = counter_delta(previous[1], rx, wrap)
+        d_tx = counter_delta(previous[2], tx, wrap)
+        hour = hours.get(ts // 3600)
+        if hour is None:
+            hour = hours[ts // 3600] = hour_of(ts)
+        for (table, length) in PERIODS:
+            total = totals.setdefault((table, device, iface, hour[:length]),
+                                      [0, 0, 0])
+            total[0] += d_rx
+            total[1] += d_tx
+            total[2] += 1
+
+    with conn:
+        for (table, length) in PERIODS:
+            rows = [(rx, tx, n, device, iface, period)
+                    for ((t, device, iface, period), (rx, tx, n))
+                    in totals.items() if t == table]
+            conn.executemany("""INSERT OR IGNORE INTO %s
+                                VALUES(?, ?, ?, 0, 0, 0)""" % table,
+                             [r[3:] for r in rows])
+            conn.executemany("""UPDATE %s SET rxbytes = rxbytes + ?,
+                                txbytes = txbytes + ?, samples = samples + ?
+                                WHERE device = ? AND iface = ? AND period = ?
+                                """ % table, rows)
+        conn.executemany("INSERT OR REPLACE INTO rollup_last VALUES(?, ?, ?, ?, ?)",
+                         [k + v for (k, v) in last.items()])
+        conn.execute("INSERT OR REPLACE INTO rollup_state VALUES('traffic_rowid', ?)",
+                     (high_water,))
+    return done
+
+def usage(conn, table, period, device=broadband_logger.ROUTER_ADDR,
+          iface=broadband_logger.WAN_IFACE):
+    """(rxbytes, txbytes) of one period of a rollup table, e.g.
+    usage(conn, 'traffic_monthly', '2013-09')"""
+    row = conn.execute("""SELECT rxbytes, txbytes FROM %s
+                          WHERE device = ? AND iface = ? AND period = ?"""
+                       % table, (device, iface, period)).fetchone()
+    return tuple(row) if row else (0, 0)
+
+def monthly_usage(conn, month, device=broadband_logger.ROUTER_ADDR,
+                  iface=broadband_logger.WAN_IFACE):
+    "(rxbytes, txbytes) in a month, e.g. '2013-09'"
+    return usage(conn, 'traffic_monthly', month, device, iface)
+
+def run_tests():
+    """testing is very important"""
+    assert counter_delta(100, 150) == 50
+    assert counter_delta(WRAP - 10, 5) == 15 # wrapped
+    assert counter_delta(1000000, 300) == 300 # rebooted
+
+    conn = sqlite3.connect(':memory:')
+    create_schema(conn)
+    def add(ts, rx, tx, iface='ppp0.1'):
+        conn.execute("INSERT INTO traffic VALUES('10.0.0.2', ?, ?, ?, ?)",
+                     (iface, to_epoch(ts), rx, tx))
+    add('2013-09-30 22:00:00', 1000, 100)
+    add('2013-09-30 23:00:00', 3000, 200)
+    add('2013-09-30 23:30:00', 4000, 300)
+    add('2013-09-30 22:00:00', 7, 7, iface='eth0')
+    assert rollup(conn) == 4
+    assert monthly_usage(conn, '2013-09') == (3000, 200)
+    assert usage(conn, 'traffic_hourly', '2013-09-30 23') == (3000, 200)
+    assert usage(conn, 'traffic_hourly', '2013-09-30 22') == (0, 0)
+    assert rollup(conn) == 0 # nothing new
+
+    add('2013-10-01 00:00:00', WRAP - 1000, 400) # crosses into October
+    add('2013-10-01 01:00:00', 500, 500)         # rx wraps
+    add('2013-10-01 02:00:00', 100, 50)          # router rebooted
+    add('2013-10-01 01:00:00', 17, 8, iface='eth0')
+    assert rollup(conn) == 4
+    assert monthly_usage(conn, '2013-09') == (3000, 200)
+    assert monthly_usage(conn, '2013-10') == (
+        (WRAP - 5000) + 1500 + 100, 100 + 100 + 50)
+    assert usage(conn, 'traffic_daily', '2013-10-01', iface='eth0') == (10, 1)
+    row = conn.execute("""SELECT samples FROM traffic_monthly
+                          WHERE iface = 'ppp0.1' AND period = '2013-10'
+                          """).fetchone()
+    assert row == (3,)
+    # a monthly lookup is a primary key search, not a scan
+    plan = ' '.join(str(r) for r in conn.execute(
+        """EXPLAIN QUERY PLAN SELECT rxbytes, txbytes FROM traffic_monthly
+           WHERE device = '10.0.0.2' AND iface = 'ppp0.1' AND period = '2013-10'
+           """))
+    assert 'SEARCH' in plan
+    # and picking up the new readings is a range on the rowid
+    plan = ' '.join(str(r) for r in conn.execute(
+        """EXPLAIN QUERY PLAN SELECT * FROM traffic NOT INDEXED
+           WHERE rowid > 5 ORDER BY device, iface, timestamp"""))
+    assert 'INTEGER PRIMARY KEY' in plan, plan
+
+    # the last readings kept with text timestamps are moved over
+    conn = sqlite3.connect(':memory:')
+    conn.execute("""CREATE TABLE rollup_last(device TEXT NOT NULL,
+                    iface TEXT NOT NULL, timestamp TEXT NOT NULL,
+                    rxbytes INTEGER, txbytes INTEGER,
+                    PRIMARY KEY (device, iface))""")
+    conn.execute("""INSERT INTO rollup_last
+                    VALUES('10.0.0.2', 'ppp0.1', '2013-09-30 23:30:00', 4000, 300)""")
+    conn.commit()
+    create_schema(conn)
+    add('2013-09-30 23:45:00', 4500, 350)
+    assert rollup(conn) == 1
+    assert monthly_usage(conn, '2013-09') == (500, 50)
+    assert conn.execute("SELECT timestamp FROM rollup_last").fetchone() == (
+        to_epoch('2013-09-30 23:45:00'),)
+    print "All tests passed."
+
+def main():
+    conn = sqlite3.connect("router.db")
+    print "rolled up %d readings" % rollup(conn)
+    conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -88,6 +88,208 @@ def two_pair(ranks):
     else:
         return None 
     
+# ------------------
+# Faster hand_rank
+#
+# hand_rank_fast gives the same tuples as hand_rank, but finds every
+# n-of-a-kind in one pass over the sorted ranks instead of calling kind()
+# (an O(n**2) count) up to seven times, and tells a flush from a bitmask
+# of the suits. Hands it has seen are kept in a bounded cache.
+
+RANK_OF = dict((r, i) for (i, r) in enumerate('--23456789TJQKA') if r != '-')
+SUIT_BIT = {'S': 1, 'H': 2, 'D': 4, 'C': 8}
+CACHE_SIZE = 100000
+RANK_CACHE = {} # tuple(sorted(hand)) --> hand_rank
+
+def hand_rank_fast(hand):
+    """Return the same value as hand_rank(hand), from the cache if the
+    same cards were ranked before, in any order. The lists in the value
+    are shared with the cache, so don't change them."""
+    key = tuple(sorted(hand))
+    value = RANK_CACHE.get(key)
+    if value is None:
+        value = rank_features(key)
+        if len(RANK_CACHE) >= CACHE_SIZE:
+            RANK_CACHE.popitem() # make room: drop any one hand
+        RANK_CACHE[key] = value
+    return value
+
+def rank_features(hand):
+    "hand_rank, worked out from one pass over the ranks and the suit mask"
+    ranks = [RANK_OF[r] for r, s in hand]
+    ranks.sort(reverse=True)
+    suits = 0
+    for r, s in hand:
+        suits |= SUIT_BIT[s]
+    flush = suits & (suits - 1) == 0 # only one suit bit set
+    if ranks == [14, 5, 4, 3, 2]:
+        ranks = [5, 4, 3, 2, 1]
+    # the highest rank with exactly 1, 2, 3 and 4 cards, the lowest pair,
+    # and the number of different ranks
+    four = three = two = one = low_pair = None
+    distinct = 0
+    i = 0
+    n = len(ranks)
+    while i < n:
+        r = ranks[i]
+        j = i + 1
+        while j < n and ranks[j] == r:
+            j += 1
+        count = j - i
+        distinct += 1
+        if count == 1:
+            if one is None: one = r
+        elif count == 2:
+            if two is None: two = r
+            low_pair = r
+        elif count == 3:
+            if three is None: three = r
+        elif count == 4:
+            if four is None: four = r
+        i = j
+    straight = distinct == 5 and ranks[0] - ranks[-1] == 4
+    if straight and flush:
+        return (8, ranks[0])
+    elif four:
+        return (7, four, one)
+    elif three and two:
+        return (6, three, two)
+    elif flush:
+        return (5, ranks)
+    elif straight:
+        return (4, ranks[0])
+    elif three:
+        return (3, three, ranks)
+    elif two and low_pair != two:
+        return (2, (two, low_pair), ranks)
+    elif two:
+        return (1, two, ranks)
+    else:
+        return (0, ranks)
+
+def test_hand_rank_fast():
+    for hand in ["6C 7C 8C 9C TC", "5S 5D 5H 5C 9S", "TD TC TH 7C 7D",
+                 "2H 7H 9H JH AH", "AC 2D 3H 4S 5C", "JD JC JH 7C 8D",
+                 "JD JC 7H 7C 8D", "JD JC 2H 7C 8D", "2D 4C 6H 8C TD",
+                 "TH JH QH KH AH", "AS 2S 3S 4S 5S"]:
+        hand = hand.split()
+        assert hand_rank_fast(hand) == hand_rank(hand)
+        assert hand_rank_fast(list(reversed(hand))) == hand_rank(hand) # cached
+    # same answers on random hands, of 5 to 7 cards
+    import random
+    deck = [r+s for r in '23456789TJQKA' for s in 'SHDC']
+    for _ in range(2000):
+        hand = random.sample(deck, random.randint(5, 7))
+        assert hand_rank_fast(hand) == hand_rank(hand)
+    return 'test_hand_rank_fast passes'
+
+def test_all_hands():
+    """hand_rank_fast against hand_rank on every one of the 2,598,960
+    5-card hands. Takes a minute or two, so it is not run on import:
+        python hw1-1.py --all"""
+    deck = [r+s for r in '23456789TJQKA' for s in 'SHDC']
+    n = 0
+    for hand in itertools.combinations(deck, 5):
+        assert hand_rank_fast(hand) == hand_rank(hand), hand
+        n += 1
+    assert n == 2598960 and len(RANK_CACHE) <= CACHE_SIZE
+    return 'test_all_hands passes'
+
+# ------------------
+# Direct 7-card evaluation
+#
+# best_hand calls hand_rank on all 21 5-card combinations. evaluate7
+# makes one pass over the cards to build a rank histogram and a rank
+# bitmask per suit, then reads the best category and kickers straight
+# off them. It gives the same answer as hand_rank(best_hand(hand)).
+
+def straight_high(mask):
+    """Return the high card of the best straight in a rank bitmask
+    (bit r set when rank r is present), or None. An ace can play low."""
+    if mask & (1 << 14):
+        mask |= 1 << 1
+    for high in range(14, 4, -1):
+        run = 0x1F << (high - 4)
+        if mask & run == run:
+            return high
+    return None
+
+def straight_ranks(high):
+    "Return the card ranks (ace as 14) of a straight with this high card."
+    return [14 if r == 1 else r for r in range(high, high - 5, -1)]
+
+def evaluate7(hand):
+    """From a hand of 5 to 7 cards, return (rank, cards): the hand_rank of
+    the best 5-card hand and the 5 cards that make it up."""
+    counts = [0] * 15
+    by_rank = [[] for _ in range(15)] # the cards of each rank
+    rank_mask = 0
+    suit_masks = {}
+    for card in hand:
+        r = '--23456789TJQKA'.index(card[0])
+        counts[r] += 1
+        by_rank[r].append(card)
+        rank_mask |= 1 << r
+        suit_masks[card[1]] = suit_masks.get(card[1], 0) | (1 << r)
+    present = [r for r in range(14, 1, -1) if counts[r]]
+
+    def of_kind(n, exclude=()):
+        "ranks with at least n cards, highest first"
+        return [r for r in present if counts[r] >= n and r not in exclude]
+    def cards(ranks):
+        "one card for every entry of ranks, taking each rank in turn"
+        taken = {}
+        for r in ranks:
+            taken[r] = taken.get(r, 0) + 1
+        return [c for r in taken for c in by_rank[r][:taken[r]]]
+
+    flush_suit = None
+    for (suit, mask) in suit_masks.items():
+        if bin(mask).count('1') >= 5:
+            flush_suit = suit
+    if flush_suit:
+        high = straight_high(suit_masks[flush_suit])
+        if high:
+            return ((8, high), ['--23456789TJQKA'[r] + flush_suit
+                                for r in straight_ranks(high)])
+    quads = of_kind(4)
+    if quads:
+        kicker = of_kind(1, quads[:1])[0]
+        return ((7, quads[0], kicker), cards([quads[0]] * 4 + [kicker]))
+    trips = of_kind(3)
+    if trips:
+        pairs = of_kind(2, trips[:1])
+        if pairs:
+            return ((6, trips[0], pairs[0]),
+                    cards([trips[0]] * 3 + [pairs[0]] * 2))
+    if flush_suit:
+        mask = suit_masks[flush_suit]
+        ranks = [r for r in range(14, 1, -1) if mask & (1 << r)][:5]
+        return ((5, ranks), ['--23456789TJQKA'[r] + flush_suit for r in ranks])
+    high = straight_high(rank_mask)
+    if high:
+        return ((4, high), cards(straight_ranks(high)))
+    if trips:
+        ranks = [trips[0]] * 3 + of_kind(1, trips[:1])[:2]
+        return ((3, trips[0], sorted(ranks, reverse=True)), cards(ranks))
+    pairs = of_kind(2)
+    if len(pairs) >= 2:
+        ranks = pairs[:2] * 2 + of_kind(1, pairs[:2])[:1]
+        return ((2, tuple(pairs[:2]), sorted(ranks, reverse=True)),
+                cards(ranks))
+    if pairs:
+        ranks = pairs[:1] * 2 + of_kind(1, pairs[:1])[:3]
+        return ((1, pairs[0], sorted(ranks, reverse=True)), cards(ranks))
+    return ((0, present[:5]), cards(present[:5]))
+
+def hand_rank7(hand):
+    "Return the hand_rank of the best 5-card hand in a 5 to 7 card hand."
+    return evaluate7(hand)[0]
+
+def best_hand7(hand):
+    "From a 7-card hand, return the best 5 card hand, like best_hand."
+    return evaluate7(hand)[1]
+
 def test_best_hand():
     assert (sorted(best_hand("6C 7C 8C 9C TC 5C JS".split()))
             == ['6C', '7C', '8C', '9C', 'TC'])
@@ -97,4 +299,30 @@ def test_best_hand():
             == ['7C', '7D', '7H', '7S', 'JD'])
     return 'test_best_hand passes'
 
+def test_best_hand7():
+    for hand in ["6C 7C 8C 9C TC 5C JS", "TD TC TH 7C 7D 8C 8S",
+                 "JD TC TH 7C 7D 7S 7H"]:
+        hand = hand.split()
+        assert sorted(best_hand7(hand)) == sorted(best_hand(hand))
+    assert hand_rank7("AC 2D 3H 4S 5C 9D KD".split()) == (4, 5)
+    assert hand_rank7("AC 2C 3C 4C 5C 9D KD".split()) == (8, 5)
+    assert hand_rank7("AC AD 3H 3S 5C 5D KD".split()) == (
+        2, (14, 5), [14, 14, 13, 5, 5])
+    # same answer as best_hand on random hands
+    import random
+    deck = [r+s for r in '23456789TJQKA' for s in 'SHDC']
+    for _ in range(2000):
+        hand = random.sample(deck, 7)
+        rank, cards = evaluate7(hand)
+        assert rank == hand_rank(best_hand(hand)) == hand_rank(cards)
+        assert set(cards) <= set(hand)
+    return 'test_best_hand7 passes'
+
 print test_best_hand()
+print test_best_hand7()
+print test_hand_rank_fast()
+
+if __name__ == '__main__':
+    import sys
+    if '--all' in sys.argv[1:]:
+        print test_all_hands()
@@ -17,6 +17,9 @@
 # five floor numbers denoting the floor of Hopper, Kay,
 # Liskov, Perlis, and Ritchie.import itertools
 
+import multiprocessing
+import time
+
 def top_floor(f): return f == 5
 def bottom_floor(f): return f == 1
 def adjacent_floor(f1, f2): return abs(f1 - f2) == 1
@@ -36,8 +39,249 @@ def floor_puzzle():
             if not adjacent_floor(Liskov, Kay)
             if len(set([Hopper, Kay, Liskov, Perlis, Ritchie])) == 5)
     #return [Hopper, Kay, Liskov, Perlis, Ritchie]
+
+# ------------------
+# A small constraint solver
+#
+# floor_puzzle tries every floor for every person and checks the
+# constraints as late as the generator expression lets it. Solver binds
+# the variables one at a time, in an order that brings constrained
+# variables together, and checks each constraint as soon as all its
+# variables have a value. With all_different it also drops the values
+# already taken from the other domains (forward checking), and backs off
+# as soon as some variable has no value left.
+
+class Solver(object):
+    """Backtracking search for assignments of variables to values.
+    variables: list of variable names
+    domains: dict of variable --> list of possible values
+    constraints: list of (names, predicate). predicate is called with the
+        values of the variables in names, and returns True if they are ok.
+    all_different: True if no two variables can share a value
+    After solve(), nodes holds the number of partial assignments tried."""
+    def __init__(self, variables, domains, constraints, all_different=False):
+        self.variables = list(variables)
+        self.all_different = all_different
+        # constraints on one variable only just cut down its domain
+        self.domains = {}
+        for v in self.variables:
+            self.domains[v] = [x for x in domains[v]
+                               if all(pred(x) for (names, pred) in constraints
+                                      if list(names) == [v])]
+        constraints = [(list(names), pred) for (names, pred) in constraints
+                       if len(names) > 1]
+        self.order = self.variable_order(constraints)
+        # the constraints to check when the variable at depth d gets a value
+        self.checks = []
+        for (d, v) in enumerate(self.order):
+            bound = set(self.order[:d + 1])
+            self.checks.append([(names, pred) for (names, pred) in constraints
+                                if v in names and set(names) <= bound])
+        self.nodes = 0
+
+    def variable_order(self, constraints):
+        """Order the variables so each one comes as soon as possible after
+        the ones it shares constraints with. Ties go to smaller domains."""
+        order = []
+        left = list(self.variables)
+        while left:
+            def score(v):
+                linked = sum(1 for (names, pred) in constraints if v in names
+                             and set(names) - set([v]) <= set(order))
+                return (-linked, len(self.domains[v]), self.variables.index(v))
+            v = min(left, key=score)
+            order.append(v)
+            left.remove(v)
+        return order
+
+    def solve(self, first=False, assignment=None):
+        """Return a list of all the solutions, as dicts of variable --> value,
+        or only the first one found if first is True. The search can start
+        from an assignment of the first variables in order, from prefixes()."""
+        self.nodes = 0
+        solutions = []
+        assignment = dict(assignment or {})
+        self.search(len(assignment), assignment, solutions, first)
+        return solutions
+
+    def prefixes(self, depth):
+        """Return all the assignments of the first depth variables in order
+        that pass the constraints. Each one starts a part of the search."""
+        self.nodes = 0
+        found = []
+        self.search(0, {}, found, False, depth)
+        return found
+
+    def search(self, depth, assignment, solutions, first, stop=None):
+        """Bind the variables from depth on, up to stop (default: all of
+        them). Return True to stop searching."""
+        if depth == (len(self.order) if stop is None else stop):
+            solutions.append(dict(assignment))
+            return first
+        v = self.order[depth]
+        used = set(assignment.values()) if self.all_different else ()
+        for x in self.domains[v]:
+            if x in used:
+                continue
+            self.nodes += 1
+            assignment[v] = x
+            if (all(pred(*[assignment[n] for n in names])
+                    for (names, pred) in self.checks[depth])
+                and self.forward_check(depth, used, x)
+                and self.search(depth + 1, assignment, solutions, first, stop)):
+                return True
+            del assignment[v]
+        return False
+
+    def forward_check(self, depth, used, x):
+        "With all_different, check every unbound variable has a value left."
+        if not self.all_different:
+            return True
+        taken = set(used)
+        taken.add(x)
+        return all(any(y not in taken for y in self.domains[v])
+                   for v in self.order[depth + 1:])
+
+# ------------------
+# Parallel search
+#
+# The search space is split by the values of the first variables in the
+# solver's order (prefixes), and each part is searched in a process of
+# its own. The workers get the solver by forking, so the predicates can
+# be any function, lambdas included.
+
+SHARED_SOLVER = None # the solver the worker processes search
+
+def solve_shard(args):
+    "Search one part of SHARED_SOLVER's space. Returns (solutions, nodes)."
+    prefix, first = args
+    solutions = SHARED_SOLVER.solve(first, prefix)
+    return solutions, SHARED_SOLVER.nodes
+
+def parallel_solve(solver, first=False, prefix_len=1, processes=None):
+    """Like solver.solve(first), with the parts of the search for each
+    assignment of the first prefix_len variables run in a process pool.
+    In first-solution mode the remaining parts are cancelled as soon as one
+    finds a solution. Returns (solutions, nodes visited)."""
+    global SHARED_SOLVER
+    SHARED_SOLVER = solver
+    shards = [(prefix, first) for prefix in solver.prefixes(prefix_len)]
+    nodes = solver.nodes
+    solutions = []
+    pool = multiprocessing.Pool(processes)
+    try:
+        if first:
+            results = pool.imap_unordered(solve_shard, shards)
+        else:
+            results = pool.imap(solve_shard, shards) # same order as solve()
+        for (found, n) in results:
+            solutions.extend(found)
+            nodes += n
+            if first and found:
+                break
+    finally:
+        pool.terminate()
+        pool.join()
+        SHARED_SOLVER = None
+    return solutions, nodes
+
+FLOOR_PEOPLE = ['Hopper', 'Kay', 'Liskov', 'Perlis', 'Ritchie']
+
+def floor_constraints():
+    "The rules of floor_puzzle, for Solver."
+    return [(['Hopper'], lambda h: not top_floor(h)),
+            (['Kay'], lambda k: not bottom_floor(k)),
+            (['Liskov'], lambda l: not top_floor(l) and not bottom_floor(l)),
+            (['Perlis', 'Kay'], lambda p, k: p > k),
+            (['Ritchie', 'Liskov'], lambda r, l: not adjacent_floor(r, l)),
+            (['Liskov', 'Kay'], lambda l, k: not adjacent_floor(l, k))]
+
+def floor_puzzle_solver(first=True, floors=5):
+    """Same answer as floor_puzzle, using Solver, or None if there is none.
+    With first=False, return every solution. Also returns the number of
+    nodes visited."""
+    solver = Solver(FLOOR_PEOPLE,
+                    dict((p, range(1, floors + 1)) for p in FLOOR_PEOPLE),
+                    floor_constraints(), all_different=True)
+    solutions = [[s[p] for p in FLOOR_PEOPLE] for s in solver.solve(first)]
+    if first:
+        return (solutions[0] if solutions else None), solver.nodes
+    return solutions, solver.nodes
+
+def test_solver():
+    answer, nodes = floor_puzzle_solver()
+    assert answer == floor_puzzle()
+    assert nodes < 5**5
+    solutions, nodes = floor_puzzle_solver(first=False)
+    assert solutions == [answer] # the puzzle has only one answer
+    # five people don't fit on four floors
+    assert floor_puzzle_solver(floors=4)[0] is None
+    assert floor_puzzle_solver(first=False, floors=4)[0] == []
+
+    # no two people with neighbouring names on adjacent floors, 12 floors
+    people = range(12)
+    solver = Solver(people, dict((p, range(1, 13)) for p in people),
+                    [([p, p + 1], lambda a, b: not adjacent_floor(a, b))
+                     for p in people[:-1]], all_different=True)
+    [solution] = solver.solve(first=True)
+    assert sorted(solution.values()) == range(1, 13)
+    assert not any(adjacent_floor(solution[p], solution[p + 1])
+                   for p in people[:-1])
+    assert solver.nodes < 1000 # out of 12**12
+    assert Solver(['a', 'b'], {'a': [1], 'b': [1]}, [],
+                  all_different=True).solve() == []
+    return 'test_solver passes'
+
+def neighbour_solver(n):
+    """n people on n floors, and no two people with neighbouring numbers
+    on adjacent floors"""
+    people = range(n)
+    return Solver(people, dict((p, range(1, n + 1)) for p in people),
+                  [([p, p + 1], lambda a, b: not adjacent_floor(a, b))
+                   for p in people[:-1]], all_different=True)
+
+def test_parallel():
+    solver = Solver(FLOOR_PEOPLE, dict((p, range(1, 6)) for p in FLOOR_PEOPLE),
+                    floor_constraints(), all_different=True)
+    solutions, nodes = parallel_solve(solver, processes=2)
+    assert [[s[p] for p in FLOOR_PEOPLE] for s in solutions] == [floor_puzzle()]
+    solver = neighbour_solver(6)
+    everything = solver.solve()
+    for prefix_len in [1, 2]:
+        solutions, nodes = parallel_solve(solver, prefix_len=prefix_len,
+                                          processes=2)
+        assert solutions == everything
+    [solution], nodes = parallel_solve(solver, first=True, processes=2)
+    assert solution in everything
+    return 'test_parallel passes'
+
+def speedup(n=8, processes=None):
+    """Time floor_puzzle's generator expression against the parallel
+    search, and the serial solver against the parallel one on n floors."""
+    def timed(f, *args):
+        t0 = time.time()
+        result = f(*args)
+        return result, time.time() - t0
+    solver = Solver(FLOOR_PEOPLE, dict((p, range(1, 6)) for p in FLOOR_PEOPLE),
+                    floor_constraints(), all_different=True)
+    answer, t_gen = timed(floor_puzzle)
+    _, t_par = timed(parallel_solve, solver, True, 1, processes)
+    print 'floor_puzzle: generator %1.4f sec, parallel %1.4f sec (x%1.2f)' % (
+        t_gen, t_par, t_gen / t_par)
+    solver = neighbour_solver(n)
+    serial, t_ser = timed(solver.solve)
+    (parallel, _), t_par = timed(parallel_solve, solver, False, 2, processes)
+    assert parallel == serial
+    print '%d floors, %d solutions: serial %1.3f sec, parallel %1.3f sec (x%1.2f)' % (
+        n, len(serial), t_ser, t_par, t_ser / t_par)
+
 def main():
     print floor_puzzle()
+    print test_solver()
+    print test_parallel()
+    answer, nodes = floor_puzzle_solver()
+    print '%s found after %d nodes, out of %d assignments' % (
+        answer, nodes, 5**5)
 
 if __name__ == '__main__':
     main()
@@ -15,6 +15,11 @@
 #
 # Please do not use regular expressions to solve this quiz!
 
+from array import array
+import functools
+import mmap
+import multiprocessing
+
 def is_palindrome(s):
     "Return true if string s is a palindrome. Case does not matter."
     s = s.lower()
@@ -40,6 +45,166 @@ def longest_subpalindrome_slice(text):
                 maxlen = j-i
     return answer
 
+# --------------
+# Linear time version (Manacher's algorithm)
+#
+# longest_subpalindrome_slice grows around every center, which is O(n**2)
+# on text like 'xxxxx...'. Manacher's algorithm reuses what it learned
+# about the palindromes to the left: inside a palindrome, the radius at
+# a position mirrors the radius on the other side of the center, so every
+# character is compared O(1) times overall.
+
+def manacher(char, n):
+    """Return (i, j) such that text[i:j] is the longest palindrome of the
+    n characters of a text, where char(k) gives the k-th character. Ties
+    go to the leftmost palindrome, like longest_subpalindrome_slice."""
+    if n == 0:
+        return (0, 0)
+    radius = array('i', [0]) * n
+    # odd lengths: text[k-m+1 : k+m] is a palindrome, m = radius[k]
+    odd = (0, 1)
+    l, r = 0, -1 # the palindrome reaching furthest right so far
+    for k in xrange(n):
+        m = 1 if k > r else min(radius[l + r - k], r - k + 1)
+        while k - m >= 0 and k + m < n and char(k - m) == char(k + m):
+            m += 1
+        radius[k] = m
+        if k + m - 1 > r:
+            l, r = k - m + 1, k + m - 1
+        if 2*m - 1 > odd[1] - odd[0]:
+            odd = (k - m + 1, k + m)
+    # even lengths: text[k-m : k+m] is a palindrome, m = radius[k]
+    even = (0, 0)
+    l, r = 0, -1
+    for k in xrange(n):
+        m = 0 if k > r else min(radius[l + r - k + 1], r - k + 1)
+        while k - m - 1 >= 0 and k + m < n and char(k - m - 1) == char(k + m):
+            m += 1
+        radius[k] = m
+        if k + m - 1 > r:
+            l, r = k - m, k + m - 1
+        if 2*m > even[1] - even[0]:
+            even = (k - m, k + m)
+    return even if even[1] - even[0] > odd[1] - odd[0] else odd
+
+def longest_subpalindrome_fast(text):
+    "Same as longest_subpalindrome_slice, in O(n) time."
+    return manacher(text.upper().__getitem__, len(text))
+
+# upper case of every byte, like str.upper()
+FOLD = [ord(chr(b).upper()) for b in range(256)]
+
+def longest_subpalindrome_buffer(data):
+    """Same as longest_subpalindrome_fast for str, bytearray, memoryview or
+    mmap data. Bytes are upper-cased one at a time as they are compared,
+    so large inputs are not copied before the scan."""
+    n = len(data)
+    if n and isinstance(data[0], str):
+        # str, mmap and memoryview give 1-character strings
+        char = lambda k: FOLD[ord(data[k])]
+    else:
+        char = lambda k: FOLD[data[k]]
+    return manacher(char, n)
+
+def longest_subpalindrome_file(filename):
+    "Return (i, j) of the longest palindrome in a file, which is mmap'ed."
+    with open(filename, 'rb') as f:
+        f.seek(0, 2)
+        if f.tell() == 0:
+            return (0, 0)
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return longest_subpalindrome_buffer(data)
+        finally:
+            data.close()
+
+# --------------
+# All the palindromes of a text (palindromic tree, or eertree)
+#
+# Every distinct palindromic substring is a node of the tree, and a node
+# for 'xAx' hangs off the node for 'A' by the edge 'x'. The tree is built
+# in one O(n) pass over the text, after which questions about the
+# palindromes of the text need no further scans of it.
+
+class PalindromeIndex(object):
+    """Palindromic tree of a text. Case does not matter, as in is_palindrome.
+    Slices (i, j) returned by the methods are such that text[i:j] is the
+    palindrome."""
+    def __init__(self, text):
+        s = text.lower()
+        # two roots: node 0 of length -1 (so that a single character is
+        # 'x' around it) and node 1, the empty string
+        length = [-1, 0]
+        link = [0, 0]  # node of the longest proper palindromic suffix
+        edges = [{}, {}]
+        first_end = [0, 0] # where the palindrome first ends in the text
+        ends = array('i', [0]) * len(s) # longest palindrome ending at k
+        last = 1
+        for (k, c) in enumerate(s):
+            node = last
+            while k - length[node] - 1 < 0 or s[k - length[node] - 1] != c:
+                node = link[node]
+            if c in edges[node]:
+                last = edges[node][c]
+            else:
+                new = len(length)
+                length.append(length[node] + 2)
+                first_end.append(k)
+                edges.append({})
+                if length[new] == 1:
+                    link.append(1)
+                else:
+                    suffix = link[node]
+                    while (k - length[suffix] - 1 < 0 or
+                           s[k - length[suffix] - 1] != c):
+                        suffix = link[suffix]
+                    link.append(edges[suffix][c])
+                edges[node][c] = new
+                last = new
+            ends[k] = length[last]
+        self.text = text
+        self.length = length
+        self.link = link
+        self.first_end = first_end
+        self.ends = ends
+
+    def count(self):
+        "Return the number of distinct palindromic substrings."
+        return len(self.length) - 2
+
+    def longest_ending_at(self, k):
+        "Return the slice of the longest palindrome that ends at text[k]."
+        return (k + 1 - self.ends[k], k + 1)
+
+    def top(self, n):
+        """Return the slices of the n longest distinct palindromes, longest
+        first. Equal lengths are in the order they first show up."""
+        nodes = sorted(range(2, len(self.length)),
+                       key=lambda v: (-self.length[v], self.first_end[v]))
+        return [(self.first_end[v] + 1 - self.length[v], self.first_end[v] + 1)
+                for v in nodes[:n]]
+
+    def longest(self):
+        "Same as longest_subpalindrome_slice(text)."
+        return (self.top(1) or [(0, 0)])[0]
+
+def palindrome_stats(text, n=5):
+    """Return (count, top, ends) for text: the number of distinct
+    palindromes, the slices of the n longest, and the length of the
+    longest palindrome ending at each position."""
+    index = PalindromeIndex(text)
+    return (index.count(), index.top(n), index.ends.tolist())
+
+def batch_palindrome_stats(texts, n=5, processes=None):
+    """Return palindrome_stats for every text in texts, shared out over a
+    pool of processes (one per CPU by default)."""
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(functools.partial(palindrome_stats, n=n), texts)
+    finally:
+        pool.close()
+        pool.join()
+
 def test():
     L = longest_subpalindrome_slice
     assert L('racecar') == (0, 7)
@@ -52,8 +217,66 @@ def test():
     assert L('Mad am I ma dam.') == (0, 15)
     return 'tests pass'
 
+def test_fast():
+    import random, tempfile, os
+    texts = ['racecar', 'Racecar', 'RacecarX', 'Race carr', '',
+             'something rac e car going', 'xxxxx', 'Mad am I ma dam.',
+             'a', 'ab', 'abba', 'aaab', 'baaa']
+    for _ in range(500):
+        texts.append(''.join(random.choice('aAb ')
+                             for _ in range(random.randint(0, 30))))
+    for text in texts:
+        answer = longest_subpalindrome_slice(text)
+        assert longest_subpalindrome_fast(text) == answer
+        assert longest_subpalindrome_buffer(text) == answer
+        assert longest_subpalindrome_buffer(bytearray(text)) == answer
+        assert longest_subpalindrome_buffer(memoryview(text)) == answer
+    L = longest_subpalindrome_fast
+    assert L('x' * 100000) == (0, 100000)
+    f = tempfile.NamedTemporaryFile(delete=False)
+    f.write('something rac e car going')
+    f.close()
+    try:
+        assert longest_subpalindrome_file(f.name) == (8, 21)
+        open(f.name, 'w').close()
+        assert longest_subpalindrome_file(f.name) == (0, 0)
+    finally:
+        os.remove(f.name)
+    return 'test_fast passes'
+
+def test_index():
+    import random
+    index = PalindromeIndex('abacaba')
+    assert index.count() == 7 # a b c aba aca bacab abacaba
+    assert index.top(3) == [(0, 7), (1, 6), (0, 3)]
+    assert [index.longest_ending_at(k) for k in range(4)] == [
+        (0, 1), (1, 2), (0, 3), (3, 4)]
+    assert PalindromeIndex('').count() == 0
+    assert PalindromeIndex('').longest() == (0, 0)
+    assert PalindromeIndex('Aa').count() == 2 # case does not matter
+    for _ in range(300):
+        text = ''.join(random.choice('aAb ')
+                       for _ in range(random.randint(0, 30)))
+        index = PalindromeIndex(text)
+        assert index.longest() == longest_subpalindrome_slice(text)
+        found = set(text[i:j].lower() for i in range(len(text))
+                    for j in range(i + 1, len(text) + 1)
+                    if is_palindrome(text[i:j]))
+        assert index.count() == len(found)
+        for k in range(len(text)):
+            i, j = index.longest_ending_at(k)
+            assert is_palindrome(text[i:j])
+            assert not any(is_palindrome(text[h:j]) for h in range(i))
+    texts = ['racecar', 'Mad am I ma dam.', 'xxxxx', '']
+    stats = batch_palindrome_stats(texts, n=2, processes=2)
+    assert stats == [palindrome_stats(text, 2) for text in texts]
+    assert stats[2] == (5, [(0, 5), (0, 4)], [1, 2, 3, 4, 5])
+    return 'test_index passes'
+
 def main():
     print test()
+    print test_fast()
+    print test_index()
 
 if __name__ == '__main__':
     main()